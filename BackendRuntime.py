@@ -0,0 +1,1382 @@
+# BackendRuntime.py
+# Process-level plumbing shared by both pipelines.
+
+import os
+import re
+import math
+import time
+import heapq
+import asyncio
+import itertools
+import pickle
+import random
+import sqlite3
+import hashlib
+import logging
+import threading
+from functools import wraps
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar, Union
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger("backend.runtime")
+T = TypeVar("T")
+
+# Configuration below is read at import, which happens before the backends'
+# own load_dotenv() call; load .env here too (it never overrides real env vars).
+load_dotenv()
+
+
+# ---------------------------
+# CONFIG
+# ---------------------------
+# Gemini keys shared by every pipeline in the process (comma-separated allowed)
+GEMINI_API_KEYS_RAW = (
+    os.environ.get("GEMINI_API_KEYS")
+    or os.environ.get("GOOGLE_API_KEYS")
+    or os.environ.get("GOOGLE_API_KEY")
+    or os.environ.get("GEMINI_API_KEY")
+)
+
+# "memory": per-process state (single worker). "sqlite": state shared by every
+# worker on the host through SHARED_STATE_PATH (set by gunicorn.conf.py).
+SHARED_STATE_MODE = os.environ.get("SHARED_STATE_MODE", "memory").strip().lower()
+SHARED_STATE_PATH = os.environ.get("SHARED_STATE_PATH", "shared_state.db")
+
+# Per-key Gemini quotas (0 disables the check) and how long to wait for a free key
+GEMINI_KEY_RPM = int(os.environ.get("GEMINI_KEY_RPM", "15"))
+GEMINI_KEY_RPD = int(os.environ.get("GEMINI_KEY_RPD", "0"))
+GEMINI_ACQUIRE_WAIT_S = float(os.environ.get("GEMINI_ACQUIRE_WAIT_S", "5"))
+GEMINI_429_COOLDOWN_S = float(os.environ.get("GEMINI_429_COOLDOWN_S", "30"))
+
+# Shared HTTP connection pool for Yelp calls
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "32"))
+
+# Per-request time budget. Clients may send X-Request-Deadline-Ms (capped at
+# REQUEST_DEADLINE_MAX_S); every upstream timeout is shrunk to what is left.
+REQUEST_DEADLINE_S = float(os.environ.get("REQUEST_DEADLINE_S", "60"))
+REQUEST_DEADLINE_MAX_S = float(os.environ.get("REQUEST_DEADLINE_MAX_S", "170"))
+DEADLINE_HEADER = "x-request-deadline-ms"
+GEMINI_TIMEOUT_S = float(os.environ.get("GEMINI_TIMEOUT_S", "30"))
+
+# Admission control: concurrent requests admitted per process (0 disables) and
+# the queueing delay interactive traffic should stay under
+ADMISSION_MAX_INFLIGHT = int(os.environ.get("ADMISSION_MAX_INFLIGHT", "32"))
+ADMISSION_QUEUE_TARGET_MS = float(os.environ.get("ADMISSION_QUEUE_TARGET_MS", "250"))
+
+# Circuit breakers: consecutive failures before opening, seconds before a retry probe
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "5"))
+BREAKER_RESET_S = float(os.environ.get("BREAKER_RESET_S", "30"))
+
+# Yelp API quota per upstream (yelp_fusion, yelp_ai): daily calls when Yelp does not
+# report RateLimit-* headers (0 = unknown), sustained calls/second per process with
+# a small burst, and the remaining share at which optional traffic is refused:
+# below LOW prefetch stops, below CRITICAL batch work stops too
+YELP_DAILY_LIMIT = int(os.environ.get("YELP_DAILY_LIMIT", "0"))
+YELP_QPS = float(os.environ.get("YELP_QPS", "5"))
+YELP_BURST = int(os.environ.get("YELP_BURST", "10"))
+YELP_QUOTA_LOW = float(os.environ.get("YELP_QUOTA_LOW", "0.2"))
+YELP_QUOTA_CRITICAL = float(os.environ.get("YELP_QUOTA_CRITICAL", "0.05"))
+
+# Optional background warmup once the server is accepting connections
+BACKEND_WARMUP = os.environ.get("BACKEND_WARMUP", "0") not in ("0", "false", "False", "")
+
+
+# ---------------------------
+# LAZY INIT
+# ---------------------------
+class BackendNotConfigured(RuntimeError):
+    """Required configuration (API keys) is missing; surfaced as a 503, not an import crash."""
+
+
+def require(value: Optional[str], message: str) -> str:
+    if not value:
+        raise BackendNotConfigured(message)
+    return value
+
+
+class Lazy(Generic[T]):
+    """Thread-safe value built on first .get(); a failed build is retried next time."""
+
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._value: Optional[T] = None
+        self._built = False
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._built
+
+    def get(self) -> T:
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self._value = self._factory()
+                    self._built = True
+        return self._value
+
+
+def new_genai_client(api_key: str):
+    # google-genai is the slowest import in the service; defer it to first use.
+    from google import genai
+    return genai.Client(api_key=api_key)
+
+
+# ---------------------------
+# JSON / TEXT HELPERS
+# ---------------------------
+_CODE_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE | re.MULTILINE)
+
+
+def strip_code_fences(text: Optional[str]) -> str:
+    return _CODE_FENCE_RE.sub("", (text or "").strip())
+
+
+def extract_json_substring(text: str, open_ch: str = "{", close_ch: str = "}") -> Optional[str]:
+    """Outermost open_ch...close_ch span of text, e.g. a JSON object wrapped in prose."""
+    s = text.find(open_ch)
+    e = text.rfind(close_ch)
+    if s != -1 and e != -1 and e > s:
+        return text[s:e + 1]
+    return None
+
+
+# ---------------------------
+# DEADLINES
+# ---------------------------
+class DeadlineExceeded(RuntimeError):
+    """The request's time budget ran out; surfaced as a 504."""
+
+
+# Monotonic expiry of the current request's budget (None outside a request)
+_DEADLINE: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+def remaining_budget() -> Optional[float]:
+    expires = _DEADLINE.get()
+    return None if expires is None else expires - time.monotonic()
+
+
+def budget_timeout(cap: float, stage: str = "upstream call") -> float:
+    """Timeout for one blocking call: `cap`, shrunk to what is left of the request budget."""
+    left = remaining_budget()
+    if left is None:
+        return cap
+    if left <= 0:
+        raise DeadlineExceeded(f"Request deadline exceeded before {stage}")
+    return min(cap, left)
+
+
+@contextmanager
+def request_deadline(seconds: float):
+    """Run the enclosed block (and work submitted from it) under a `seconds` budget."""
+    token = _DEADLINE.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+def submit_in_context(pool, fn: Callable[..., T], *args, **kwargs) -> "Future[T]":
+    """pool.submit() that carries the caller's deadline (and other contextvars) along."""
+    return pool.submit(copy_context().run, fn, *args, **kwargs)
+
+
+def wait_result(fut: Future, stage: str, cancel: bool = True) -> Any:
+    """fut.result() bounded by the request budget; cancels not-yet-started work on expiry."""
+    left = remaining_budget()
+    try:
+        return fut.result(timeout=None if left is None else max(0.0, left))
+    except FutureTimeout:
+        if cancel:
+            fut.cancel()
+        raise DeadlineExceeded(f"Request deadline exceeded during {stage}") from None
+
+
+class DeadlineMiddleware:
+    """ASGI middleware that opens a budget per HTTP request (header or default)."""
+
+    def __init__(self, app, default_s: float = REQUEST_DEADLINE_S):
+        self.app = app
+        self.default_s = default_s
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        budget = self.default_s
+        for name, value in scope.get("headers") or ():
+            if name == DEADLINE_HEADER.encode():
+                try:
+                    budget = min(REQUEST_DEADLINE_MAX_S, max(0.0, float(value) / 1000.0))
+                except ValueError:
+                    pass
+                break
+        with request_deadline(budget):
+            await self.app(scope, receive, send)
+
+
+# ---------------------------
+# CIRCUIT BREAKERS
+# ---------------------------
+class CircuitOpen(RuntimeError):
+    """An upstream's breaker is open; surfaced as a fast 503 with Retry-After."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Upstream {name} is unavailable (circuit open)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def _status_of(e: BaseException) -> Optional[int]:
+    for attr in ("status_code", "code"):
+        status = getattr(e, attr, None)
+        if isinstance(status, int):
+            return status
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_upstream_failure(e: BaseException) -> bool:
+    """Timeouts, connection errors, 5xx and 429 count against a breaker; other 4xx do not."""
+    if isinstance(e, (DeadlineExceeded, CircuitOpen, BackendNotConfigured)):
+        return False
+    status = _status_of(e)
+    return status is None or status >= 500 or status == 429
+
+
+class CircuitBreaker:
+    """
+    Per-process breaker for one upstream. Opens after `failures` consecutive
+    failures and fails fast for `reset_s`; then calls are let through again
+    (half-open) and the first result either closes it or re-opens it.
+    """
+
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, reset_s: float = BREAKER_RESET_S):
+        self.name = name
+        self.failures = failures
+        self.reset_s = reset_s
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._opened_at: Optional[float] = None
+        self.trips = 0
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self._opened_at + self.reset_s - time.monotonic())
+
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.reset_s:
+                return "open"
+            return "half_open"
+
+    def allow(self) -> bool:
+        return self.state() != "open"
+
+    def check(self) -> None:
+        if not self.allow():
+            raise CircuitOpen(self.name, self.retry_after())
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._consecutive = 0
+            self._opened_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._consecutive += 1
+            if self._opened_at is not None and now - self._opened_at < self.reset_s:
+                return  # already open
+            # a failed half-open call re-opens immediately
+            if self._opened_at is not None or self._consecutive >= self.failures:
+                self._opened_at = now
+                self.trips += 1
+                logger.warning("circuit %s open after %d failures", self.name, self._consecutive)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state(),
+            "consecutive_failures": self._consecutive,
+            "trips": self.trips,
+            "retry_after": round(self.retry_after(), 1),
+        }
+
+
+_BREAKERS: Dict[str, CircuitBreaker] = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def circuit_breaker(name: str) -> CircuitBreaker:
+    with _BREAKERS_LOCK:
+        breaker = _BREAKERS.get(name)
+        if breaker is None:
+            breaker = _BREAKERS[name] = CircuitBreaker(name)
+        return breaker
+
+
+def breaker_states() -> Dict[str, Dict[str, Any]]:
+    with _BREAKERS_LOCK:
+        breakers = list(_BREAKERS.values())
+    return {b.name: b.stats() for b in breakers}
+
+
+# ---------------------------
+# ADMISSION CONTROL
+# ---------------------------
+# Lowest priority first. Routes declare a class; clients may lower theirs
+# (never raise it) with X-Request-Priority, e.g. for prefetching.
+PRIORITY_CLASSES = ("prefetch", "batch", "caption", "interactive")
+PRIORITY_HEADER = "x-request-priority"
+
+# Queueing delay (in multiples of the target) at which each class is shed
+_SHED_AT = {"prefetch": 1.0, "batch": 2.0, "caption": 4.0, "interactive": None}
+
+_ADMISSION_EXEMPT = {"/", "/health", "/metrics", "/docs", "/redoc", "/openapi.json"}
+_ADMISSION_EXEMPT_PREFIXES = ("/admin/",)
+
+# Priority class of the current request; background jobs set their own
+_PRIORITY: ContextVar[str] = ContextVar("request_priority", default="interactive")
+
+
+def current_priority() -> str:
+    return _PRIORITY.get()
+
+
+@contextmanager
+def request_priority(cls: str):
+    """Run the enclosed work as priority class `cls` (e.g. "batch" for jobs)."""
+    token = _PRIORITY.set(cls)
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+
+class AdmissionController:
+    """
+    Bounds in-flight requests per process. Requests that cannot start at once
+    queue by priority class; when the queueing delay exceeds a class's limit
+    that class is shed with a fast 503 instead of queueing. Runs on the event
+    loop only, so it needs no locks.
+    """
+
+    def __init__(self, max_inflight: int, target_s: float):
+        self.max_inflight = max_inflight
+        self.target_s = target_s
+        self.in_flight = 0
+        self._ewma_wait = 0.0
+        self._ewma_at = time.monotonic()
+        self._waiters: List[list] = []  # heap of [-rank, seq, enqueued_at, future]
+        self._seq = itertools.count()
+        self.admitted: Dict[str, int] = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self.shed: Dict[str, int] = dict.fromkeys(PRIORITY_CLASSES, 0)
+
+    def _prune(self) -> None:
+        while self._waiters and self._waiters[0][3].done():
+            heapq.heappop(self._waiters)
+
+    def _recent_wait(self, now: float) -> float:
+        # average of recent admission waits, decaying with a 1 s half-life when idle
+        return self._ewma_wait * 0.5 ** (now - self._ewma_at)
+
+    def queue_delay(self) -> float:
+        now = time.monotonic()
+        oldest = max((now - w[2] for w in self._waiters if not w[3].done()), default=0.0)
+        return max(self._recent_wait(now), oldest)
+
+    def _limit(self, cls: str) -> Optional[float]:
+        factor = _SHED_AT[cls]
+        return None if factor is None else factor * self.target_s
+
+    def _admit(self, cls: str, waited: float) -> None:
+        now = time.monotonic()
+        self._ewma_wait = 0.8 * self._recent_wait(now) + 0.2 * waited
+        self._ewma_at = now
+        self.admitted[cls] += 1
+
+    async def acquire(self, cls: str) -> Optional[Tuple[int, str, float]]:
+        """None once admitted; otherwise (status, message, retry_after) to reject with."""
+        self._prune()
+        if self.in_flight < self.max_inflight and not self._waiters:
+            self.in_flight += 1
+            self._admit(cls, 0.0)
+            return None
+
+        delay = self.queue_delay()
+        limit = self._limit(cls)
+        if limit is not None and delay > limit:
+            self.shed[cls] += 1
+            return 503, f"Server busy; shedding {cls} traffic", delay
+
+        timeout = limit
+        left = remaining_budget()
+        if left is not None:
+            timeout = left if timeout is None else min(timeout, left)
+
+        fut = asyncio.get_running_loop().create_future()
+        enqueued = time.monotonic()
+        heapq.heappush(self._waiters, [-PRIORITY_CLASSES.index(cls), next(self._seq), enqueued, fut])
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            if not (fut.done() and not fut.cancelled()):
+                self.shed[cls] += 1
+                if limit is None or (left is not None and left <= limit):
+                    return 504, "Request deadline exceeded while queued", self.queue_delay()
+                return 503, f"Server busy; shedding {cls} traffic", self.queue_delay()
+        except BaseException:
+            # client went away: pass on a slot we may already have been handed
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+        self._admit(cls, time.monotonic() - enqueued)
+        return None
+
+    def release(self) -> None:
+        while self._waiters:
+            fut = heapq.heappop(self._waiters)[3]
+            if not fut.done():
+                fut.set_result(None)  # hand the slot straight to the next waiter
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        queued = dict.fromkeys(PRIORITY_CLASSES, 0)
+        for rank, _seq, _t, fut in self._waiters:
+            if not fut.done():
+                queued[PRIORITY_CLASSES[-rank]] += 1
+        return {
+            "max_in_flight": self.max_inflight,
+            "in_flight": self.in_flight,
+            "queued": queued,
+            "queue_delay_ms": round(self.queue_delay() * 1000, 1),
+            "admitted": dict(self.admitted),
+            "shed": dict(self.shed),
+        }
+
+
+# One controller per process: the threadpool it protects is per process too
+_ADMISSION = AdmissionController(ADMISSION_MAX_INFLIGHT, ADMISSION_QUEUE_TARGET_MS / 1000.0)
+
+
+def admission_stats() -> Optional[Dict[str, Any]]:
+    return _ADMISSION.stats() if ADMISSION_MAX_INFLIGHT > 0 else None
+
+
+def admission_pressure() -> float:
+    """Current queueing delay as a multiple of the target; background work backs off above 1."""
+    if ADMISSION_MAX_INFLIGHT <= 0:
+        return 0.0
+    return _ADMISSION.queue_delay() / _ADMISSION.target_s
+
+
+class AdmissionMiddleware:
+    """ASGI middleware that classifies each request and admits, queues or sheds it."""
+
+    def __init__(self, app, priorities: Dict[str, str], controller: AdmissionController = _ADMISSION):
+        self.app = app
+        self.priorities = priorities
+        self.controller = controller
+
+    def _classify(self, scope) -> str:
+        cls = self.priorities.get(scope["path"], "interactive")
+        for name, value in scope.get("headers") or ():
+            if name == PRIORITY_HEADER.encode():
+                asked = value.decode("latin-1").strip().lower()
+                if asked in PRIORITY_CLASSES and PRIORITY_CLASSES.index(asked) < PRIORITY_CLASSES.index(cls):
+                    cls = asked
+                break
+        return cls
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or path in _ADMISSION_EXEMPT or path.startswith(_ADMISSION_EXEMPT_PREFIXES):
+            return await self.app(scope, receive, send)
+
+        cls = self._classify(scope)
+        _PRIORITY.set(cls)
+        rejected = await self.controller.acquire(cls)
+        if rejected is not None:
+            from fastapi.responses import JSONResponse
+
+            status, message, retry_after = rejected
+            response = JSONResponse(
+                status_code=status,
+                content={"status": status, "message": message},
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+            return await response(scope, receive, send)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release()
+
+
+# ---------------------------
+# YELP QUOTA
+# ---------------------------
+QUOTA_LEVELS = ("ok", "low", "critical", "exhausted")
+
+# lowest priority class still allowed to spend quota at each level
+_QUOTA_FLOOR = {"ok": "prefetch", "low": "batch", "critical": "caption", "exhausted": None}
+
+
+def _next_utc_midnight() -> float:
+    now = datetime.now(timezone.utc)
+    return (now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)).timestamp()
+
+
+def _parse_reset(value: Optional[str]) -> float:
+    try:
+        return datetime.fromisoformat(value.strip()).timestamp()
+    except Exception:
+        return _next_utc_midnight()
+
+
+class TokenBucket:
+    """Per-process pacing: `rate` tokens/second, at most `burst` saved up."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token; returns how long to sleep before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._at) * self.rate)
+            self._at = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class QuotaBudget:
+    """
+    Daily quota and burst pacing for one Yelp upstream. The remaining count
+    comes from Yelp's RateLimit-* headers when present (shared by every worker
+    through the shared state), otherwise from our own daily call counter
+    against YELP_DAILY_LIMIT.
+    """
+
+    def __init__(self, name: str, daily_limit: int = YELP_DAILY_LIMIT):
+        self.name = name
+        self.daily_limit = daily_limit
+        self.bucket = TokenBucket(YELP_QPS, YELP_BURST) if YELP_QPS > 0 else None
+        self.refused: Dict[str, int] = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self.spent = 0  # calls admitted by this process
+        self.paced_s = 0.0
+
+    def _observed(self) -> Optional[Dict[str, float]]:
+        seen = _QUOTA_STORE.get().get(self.name)
+        if seen is None or seen["reset_at"] <= time.time():
+            return None
+        return seen
+
+    def remaining(self) -> Tuple[Optional[int], Optional[int]]:
+        """(remaining, daily limit); (None, None) while the quota is unknown."""
+        seen = self._observed()
+        if seen is not None:
+            return int(seen["remaining"]), int(seen["limit"]) or None
+        if self.daily_limit > 0:
+            used = get_shared_state().window_count(f"quota:{self.name}", 86400)
+            return max(0, self.daily_limit - used), self.daily_limit
+        return None, None
+
+    def level(self) -> str:
+        left, limit = self.remaining()
+        if left is None:
+            return "ok"
+        if left <= 0:
+            return "exhausted"
+        if limit:
+            share = left / limit
+            if share <= YELP_QUOTA_CRITICAL:
+                return "critical"
+            if share <= YELP_QUOTA_LOW:
+                return "low"
+        return "ok"
+
+    def retry_after(self) -> float:
+        seen = self._observed()
+        reset_at = seen["reset_at"] if seen else _next_utc_midnight()
+        return min(86400.0, max(1.0, reset_at - time.time()))
+
+    def spend(self) -> None:
+        """Admit one call for the current request's priority, pacing bursts."""
+        level = self.level()
+        floor = _QUOTA_FLOOR[level]
+        cls = current_priority()
+        if floor is None or PRIORITY_CLASSES.index(cls) < PRIORITY_CLASSES.index(floor):
+            self.refused[cls] = self.refused.get(cls, 0) + 1
+            raise KeyQuotaExhausted(
+                f"{self.name} daily quota is {level}; {cls} calls are paused",
+                retry_after=self.retry_after() if level == "exhausted" else 60.0,
+            )
+
+        self.spent += 1
+        if self.daily_limit > 0:
+            get_shared_state().try_acquire(f"quota:{self.name}", 86400, 1 << 30)
+        if self.bucket is not None:
+            wait = self.bucket.reserve()
+            if wait > 0:
+                left = remaining_budget()
+                if left is not None and left < wait:
+                    raise DeadlineExceeded(f"Request deadline exceeded pacing {self.name} calls")
+                self.paced_s += wait
+                time.sleep(wait)
+
+    def observe(self, response) -> None:
+        """Record Yelp's RateLimit-* headers from a response, if it sent them."""
+        headers = getattr(response, "headers", None) or {}
+        remaining = headers.get("RateLimit-Remaining")
+        if remaining is None:
+            if response.status_code == 429 and "ACCESS_LIMIT_REACHED" in (response.text or ""):
+                remaining = 0
+            else:
+                return
+        try:
+            seen = {
+                "remaining": max(0, int(float(remaining))),
+                "limit": int(float(headers.get("RateLimit-DailyLimit") or self.daily_limit)),
+                "reset_at": _parse_reset(headers.get("RateLimit-ResetTime")),
+            }
+        except ValueError:
+            return
+        _QUOTA_STORE.get().put(self.name, seen)
+
+    def stats(self) -> Dict[str, Any]:
+        left, limit = self.remaining()
+        return {
+            "level": self.level(),
+            "remaining": left,
+            "daily_limit": limit,
+            "refused": dict(self.refused),
+            "spent": self.spent,
+            "paced_s": round(self.paced_s, 2),
+        }
+
+
+_QUOTA_STORE = Lazy(lambda: make_ttl_store("yelp_quota", 86400, 64))
+YELP_UPSTREAMS = ("yelp_fusion", "yelp_ai")
+_QUOTAS = {name: QuotaBudget(name) for name in YELP_UPSTREAMS}
+
+
+def yelp_quota_level(upstream: str) -> str:
+    """"ok", "low", "critical" or "exhausted" for one Yelp upstream."""
+    return _QUOTAS[upstream].level()
+
+
+def yelp_quota_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: q.stats() for name, q in _QUOTAS.items()}
+
+
+# ---------------------------
+# HTTP POOL
+# ---------------------------
+def _build_http_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_HTTP = Lazy(_build_http_session)
+
+
+def http_session():
+    """Process-wide requests.Session so Yelp calls reuse TLS connections."""
+    return _HTTP.get()
+
+
+def upstream_request(upstream: str, method: str, url: str, timeout: float, **kwargs):
+    """
+    http_session().request() behind `upstream`'s circuit breaker, with the
+    timeout capped by the request budget. Yelp upstreams also spend from their
+    quota budget. 5xx/429 responses count as failures but are returned to the
+    caller unchanged.
+    """
+    import requests
+
+    breaker = circuit_breaker(upstream)
+    breaker.check()
+    quota = _QUOTAS.get(upstream)
+    if quota is not None:
+        quota.spend()
+    effective = budget_timeout(timeout, upstream)
+    try:
+        r = http_session().request(method, url, timeout=effective, **kwargs)
+    except requests.Timeout:
+        if effective < timeout:
+            # our own budget ran out; not the upstream's fault
+            raise DeadlineExceeded(f"Request deadline exceeded during {upstream}") from None
+        breaker.record_failure()
+        raise
+    except requests.RequestException:
+        breaker.record_failure()
+        raise
+    if quota is not None:
+        quota.observe(r)
+    if r.status_code >= 500 or r.status_code == 429:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return r
+
+
+# ---------------------------
+# WARMUP
+# ---------------------------
+_WARMUP_STATE: Dict[str, Any] = {"started": False, "done": False, "seconds": None, "errors": []}
+
+
+def start_warmup(tasks: List[Tuple[str, Callable[[], Any]]], delay_s: float = 0.2) -> None:
+    """
+    Run warmup tasks on a daemon thread so startup returns immediately and the
+    port is bound before any connection is opened. Failures are recorded, not raised.
+    """
+    if not BACKEND_WARMUP or _WARMUP_STATE["started"]:
+        return
+    _WARMUP_STATE["started"] = True
+
+    def _run():
+        time.sleep(delay_s)
+        t0 = time.perf_counter()
+        for name, task in tasks:
+            try:
+                task()
+            except Exception as e:
+                _WARMUP_STATE["errors"].append(f"{name}: {str(e)[:200]}")
+        _WARMUP_STATE["seconds"] = round(time.perf_counter() - t0, 3)
+        _WARMUP_STATE["done"] = True
+        logger.info("warmup finished in %ss", _WARMUP_STATE["seconds"])
+
+    threading.Thread(target=_run, name="backend-warmup", daemon=True).start()
+
+
+def warmup_status() -> Dict[str, Any]:
+    return dict(_WARMUP_STATE, errors=list(_WARMUP_STATE["errors"]))
+
+
+def preopen_connection(url: str) -> None:
+    """Establish (and pool) a TLS connection to url's host; the response is ignored."""
+    http_session().head(url, timeout=5)
+
+
+# ---------------------------
+# SINGLE-FLIGHT
+# ---------------------------
+_WS_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: Any) -> str:
+    """Case/whitespace-insensitive form used to build coalescing keys."""
+    return _WS_RE.sub(" ", str(text or "")).strip().lower()
+
+
+def digest(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one upstream call.
+    The first caller runs `fn`; callers arriving while it is in flight wait on
+    the same future and receive the same result (or exception).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._inflight: Dict[Hashable, Future] = {}
+        self.calls = 0
+        self.upstream = 0
+        self.saved = 0
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            self.calls += 1
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.saved += 1
+                leader = False
+            else:
+                fut = Future()
+                self._inflight[key] = fut
+                self.upstream += 1
+                leader = True
+
+        if not leader:
+            # the shared future belongs to the leader: never cancel it
+            return wait_result(fut, f"{self.name} (coalesced)", cancel=False)
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "upstream_calls": self.upstream,
+                "saved_calls": self.saved,
+                "in_flight": len(self._inflight),
+            }
+
+
+_FLIGHTS: Dict[str, SingleFlight] = {}
+_FLIGHTS_LOCK = threading.Lock()
+
+
+def single_flight_group(name: str) -> SingleFlight:
+    with _FLIGHTS_LOCK:
+        group = _FLIGHTS.get(name)
+        if group is None:
+            group = _FLIGHTS[name] = SingleFlight(name)
+        return group
+
+
+def single_flight(name: str, key: Callable[..., Optional[Hashable]]):
+    """
+    Decorator: coalesce concurrent identical calls. `key` receives the call's
+    arguments and returns a hashable key, or None to bypass coalescing.
+    """
+    group = single_flight_group(name)
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            k = key(*args, **kwargs)
+            if k is None:
+                return fn(*args, **kwargs)
+            return group.do(k, fn, *args, **kwargs)
+
+        wrapper.single_flight = group
+        return wrapper
+
+    return decorator
+
+
+def single_flight_stats() -> Dict[str, Dict[str, int]]:
+    with _FLIGHTS_LOCK:
+        groups = list(_FLIGHTS.values())
+    return {g.name: g.stats() for g in groups}
+
+
+# ---------------------------
+# TTL STORES
+# ---------------------------
+class TTLStore:
+    """Bounded, thread-safe LRU map whose entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < now:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SharedTTLStore:
+    """TTLStore interface over the SQLite shared state, visible to every worker."""
+
+    def __init__(self, state: "SQLiteSharedState", namespace: str, ttl: float, max_entries: int):
+        self.state = state
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def get(self, key: str) -> Optional[Any]:
+        return self.state.cache_get(self.namespace, key)
+
+    def put(self, key: str, value: Any) -> None:
+        self.state.cache_put(self.namespace, key, value, self.ttl, self.max_entries)
+
+    def __len__(self) -> int:
+        return self.state.cache_len(self.namespace)
+
+
+# ---------------------------
+# SHARED STATE
+# ---------------------------
+class MemorySharedState:
+    """Single-process implementation of the shared-state operations."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._windows: Dict[Tuple[str, int], int] = {}
+        self._cooldowns: Dict[str, float] = {}
+        self._counters: Dict[str, int] = {}
+
+    def try_acquire(self, key: str, window_s: int, limit: int) -> bool:
+        window = int(time.time() // window_s)
+        with self._lock:
+            count = self._windows.get((key, window), 0)
+            if count >= limit:
+                return False
+            self._windows[(key, window)] = count + 1
+            if len(self._windows) > 10000:
+                self._windows = {k: v for k, v in self._windows.items() if k[1] >= window - 1}
+            return True
+
+    def window_count(self, key: str, window_s: int) -> int:
+        with self._lock:
+            return self._windows.get((key, int(time.time() // window_s)), 0)
+
+    def set_cooldown(self, key: str, seconds: float) -> None:
+        with self._lock:
+            self._cooldowns[key] = max(self._cooldowns.get(key, 0.0), time.time() + seconds)
+
+    def cooldown_remaining(self, key: str) -> float:
+        with self._lock:
+            return max(0.0, self._cooldowns.get(key, 0.0) - time.time())
+
+    def next_counter(self, name: str) -> int:
+        with self._lock:
+            n = self._counters.get(name, 0)
+            self._counters[name] = n + 1
+            return n
+
+
+_STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_windows (
+    key TEXT, win INTEGER, count INTEGER, PRIMARY KEY (key, win)
+);
+CREATE TABLE IF NOT EXISTS cooldowns (key TEXT PRIMARY KEY, until REAL);
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER);
+CREATE TABLE IF NOT EXISTS cache (
+    namespace TEXT, key TEXT, value BLOB, expires REAL, PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS idx_cache_expires ON cache(namespace, expires);
+"""
+
+
+class SQLiteSharedState:
+    """
+    Cross-process shared state in one SQLite file (WAL). Connections are per
+    thread and per pid, so the object is safe to create before a preload fork.
+    Read-modify-write operations run inside BEGIN IMMEDIATE.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(_STATE_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _txn(self, fn):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            out = fn(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return out
+
+    def try_acquire(self, key: str, window_s: int, limit: int) -> bool:
+        window = int(time.time() // window_s)
+
+        def op(conn):
+            row = conn.execute(
+                "SELECT count FROM rate_windows WHERE key = ? AND win = ?", (key, window)
+            ).fetchone()
+            count = row[0] if row else 0
+            if count >= limit:
+                return False
+            conn.execute(
+                "INSERT INTO rate_windows (key, win, count) VALUES (?, ?, 1) "
+                "ON CONFLICT(key, win) DO UPDATE SET count = count + 1",
+                (key, window),
+            )
+            if random.random() < 0.01:
+                conn.execute("DELETE FROM rate_windows WHERE win < ? AND key = ?", (window - 1, key))
+            return True
+
+        return self._txn(op)
+
+    def window_count(self, key: str, window_s: int) -> int:
+        row = self._conn().execute(
+            "SELECT count FROM rate_windows WHERE key = ? AND win = ?",
+            (key, int(time.time() // window_s)),
+        ).fetchone()
+        return row[0] if row else 0
+
+    def set_cooldown(self, key: str, seconds: float) -> None:
+        self._conn().execute(
+            "INSERT INTO cooldowns (key, until) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET until = MAX(until, excluded.until)",
+            (key, time.time() + seconds),
+        )
+
+    def cooldown_remaining(self, key: str) -> float:
+        row = self._conn().execute("SELECT until FROM cooldowns WHERE key = ?", (key,)).fetchone()
+        return max(0.0, row[0] - time.time()) if row else 0.0
+
+    def next_counter(self, name: str) -> int:
+        def op(conn):
+            conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                (name,),
+            )
+            return conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0] - 1
+
+        return self._txn(op)
+
+    def cache_get(self, namespace: str, key: str) -> Optional[Any]:
+        row = self._conn().execute(
+            "SELECT value, expires FROM cache WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return pickle.loads(row[0])
+
+    def cache_put(self, namespace: str, key: str, value: Any, ttl: float, max_entries: int) -> None:
+        now = time.time()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        def op(conn):
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                (namespace, key, blob, now + ttl),
+            )
+            if random.random() < 0.02:
+                conn.execute("DELETE FROM cache WHERE namespace = ? AND expires < ?", (namespace, now))
+                conn.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND key IN ("
+                    "  SELECT key FROM cache WHERE namespace = ? ORDER BY expires DESC LIMIT -1 OFFSET ?"
+                    ")",
+                    (namespace, namespace, max_entries),
+                )
+
+        self._txn(op)
+
+    def cache_len(self, namespace: str) -> int:
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM cache WHERE namespace = ? AND expires >= ?", (namespace, time.time())
+        ).fetchone()[0]
+
+
+_STATE: Optional[Any] = None
+_STATE_LOCK = threading.Lock()
+
+
+def get_shared_state():
+    global _STATE
+    if _STATE is None:
+        with _STATE_LOCK:
+            if _STATE is None:
+                if SHARED_STATE_MODE == "sqlite":
+                    _STATE = SQLiteSharedState(SHARED_STATE_PATH)
+                else:
+                    _STATE = MemorySharedState()
+    return _STATE
+
+
+def make_ttl_store(namespace: str, ttl: float, max_entries: int):
+    """Hot cache that is per-process in memory mode and host-wide in sqlite mode."""
+    state = get_shared_state()
+    if isinstance(state, SQLiteSharedState):
+        return SharedTTLStore(state, namespace, ttl, max_entries)
+    return TTLStore(ttl, max_entries)
+
+
+# ---------------------------
+# GEMINI KEY SCHEDULER
+# ---------------------------
+class KeyQuotaExhausted(RuntimeError):
+    """Every key is rate limited or over quota; `retry_after` is a hint in seconds."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_api_keys(raw: Optional[str]) -> List[str]:
+    return [k.strip() for k in (raw or "").split(",") if k.strip()]
+
+
+def _is_rate_limited(e: BaseException) -> bool:
+    return getattr(e, "code", None) == 429 or getattr(e, "status_code", None) == 429
+
+
+class KeyScheduler:
+    """
+    Picks an API key per call. Keys over their RPM/RPD quota or cooling down
+    after a 429 are skipped. Counters, cooldowns and the round-robin cursor
+    live in the shared state, so every worker sees the same budget.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        keys: List[str],
+        factory: Callable[[str], Any],
+        rpm: int = GEMINI_KEY_RPM,
+        rpd: int = GEMINI_KEY_RPD,
+    ):
+        if not keys:
+            raise ValueError(f"{name}: no API keys configured")
+        self.name = name
+        self.keys = keys
+        self.rpm = rpm
+        self.rpd = rpd
+        self._factory = factory
+        self._clients: Dict[int, Any] = {}
+        self._lock = threading.Lock()
+        # never store raw keys in shared state
+        self._ids = [f"{name}:{digest(k)[:12]}" for k in keys]
+        self._breakers = [circuit_breaker(kid) for kid in self._ids]
+
+    def client(self, index: int) -> Any:
+        with self._lock:
+            c = self._clients.get(index)
+            if c is None:
+                c = self._clients[index] = self._factory(self.keys[index])
+            return c
+
+    def acquire(self, wait_s: float = GEMINI_ACQUIRE_WAIT_S) -> int:
+        state = get_shared_state()
+        left = remaining_budget()
+        budget_bound = left is not None and left < wait_s
+        if budget_bound:
+            wait_s = max(0.0, left)
+        deadline = time.monotonic() + wait_s
+        n = len(self.keys)
+
+        while True:
+            start = state.next_counter(f"rr:{self.name}") % n
+            shortest_wait = 60.0
+            broken = 0
+            for step in range(n):
+                i = (start + step) % n
+                kid = self._ids[i]
+                if not self._breakers[i].allow():
+                    broken += 1
+                    continue
+                cooldown = state.cooldown_remaining(kid)
+                if cooldown > 0:
+                    shortest_wait = min(shortest_wait, cooldown)
+                    continue
+                if self.rpd and state.window_count(kid + ":d", 86400) >= self.rpd:
+                    continue
+                if self.rpm and not state.try_acquire(kid + ":m", 60, self.rpm):
+                    shortest_wait = min(shortest_wait, 60 - time.time() % 60)
+                    continue
+                if self.rpd:
+                    state.try_acquire(kid + ":d", 86400, self.rpd)
+                return i
+
+            if broken == n:
+                raise CircuitOpen(self.name, min(b.retry_after() for b in self._breakers))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if budget_bound:
+                    raise DeadlineExceeded(f"Request deadline exceeded waiting for a {self.name} key")
+                raise KeyQuotaExhausted(
+                    f"All {self.name} keys are rate limited", retry_after=shortest_wait
+                )
+            time.sleep(min(0.25, remaining))
+
+    def report_rate_limited(self, index: int, retry_after: Optional[float] = None) -> None:
+        get_shared_state().set_cooldown(self._ids[index], retry_after or GEMINI_429_COOLDOWN_S)
+
+    def call(self, fn: Callable[[Any], Any]) -> Any:
+        """
+        Run fn(client) on a scheduled key; on a 429 cool that key down and try
+        another. Other upstream failures count against the key's breaker.
+        """
+        last_exc: Optional[BaseException] = None
+        for _ in range(len(self.keys)):
+            index = self.acquire()
+            breaker = self._breakers[index]
+            try:
+                result = fn(self.client(index))
+            except Exception as e:
+                if _is_rate_limited(e):
+                    self.report_rate_limited(index)
+                    last_exc = e
+                    continue
+                left = remaining_budget()
+                if left is not None and left <= 0:
+                    raise DeadlineExceeded(f"Request deadline exceeded during {self.name} call") from e
+                if is_upstream_failure(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                raise
+            breaker.record_success()
+            return result
+        raise last_exc
+
+    def warm(self) -> None:
+        for i in range(len(self.keys)):
+            self.client(i)
+
+    def stats(self) -> Dict[str, Any]:
+        state = get_shared_state()
+        return {
+            "keys": len(self.keys),
+            "used_this_minute": [state.window_count(k + ":m", 60) for k in self._ids],
+            "cooling_down": [round(state.cooldown_remaining(k), 1) for k in self._ids],
+        }
+
+
+def _build_gemini() -> KeyScheduler:
+    raw = require(GEMINI_API_KEYS_RAW, "Missing GOOGLE_API_KEY / GEMINI_API_KEY (or GEMINI_API_KEYS)")
+    keys = parse_api_keys(raw)
+    if not keys:
+        raise BackendNotConfigured("No valid Gemini keys after parsing")
+    return KeyScheduler("gemini", keys, new_genai_client)
+
+
+# One scheduler per process, shared by every pipeline mounted in it
+_GEMINI = Lazy(_build_gemini)
+
+
+def gemini_scheduler() -> KeyScheduler:
+    return _GEMINI.get()
+
+
+def gemini_config(config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """generate_content config whose HTTP timeout is bounded by the request budget."""
+    timeout_ms = max(1, int(budget_timeout(GEMINI_TIMEOUT_S, "Gemini call") * 1000))
+    return dict(config or {}, http_options={"timeout": timeout_ms})
+
+
+def gemini_stats() -> Optional[Dict[str, Any]]:
+    return _GEMINI.get().stats() if _GEMINI.ready else None
+
+
+# ---------------------------
+# APP WIRING
+# ---------------------------
+# Runtime errors that routes must re-raise instead of wrapping in a 4xx/502
+PASSTHROUGH_ERRORS = (BackendNotConfigured, KeyQuotaExhausted, DeadlineExceeded, CircuitOpen)
+
+
+def install_error_handlers(app, route_priorities: Optional[Dict[str, str]] = None) -> None:
+    """
+    Map runtime errors to fast 503/504s with the body shape used by the routes,
+    and open a deadline budget for every request. With `route_priorities`
+    (path -> priority class) requests also pass admission control, inside the
+    deadline so queueing time counts against the budget.
+    """
+    from fastapi.responses import JSONResponse
+
+    if route_priorities is not None and ADMISSION_MAX_INFLIGHT > 0:
+        app.add_middleware(AdmissionMiddleware, priorities=route_priorities)
+    app.add_middleware(DeadlineMiddleware)
+
+    @app.exception_handler(BackendNotConfigured)
+    def _not_configured(_request, exc: BackendNotConfigured):
+        return JSONResponse(status_code=503, content={"status": 503, "message": str(exc)})
+
+    @app.exception_handler(KeyQuotaExhausted)
+    @app.exception_handler(CircuitOpen)
+    def _retry_later(_request, exc: Union[KeyQuotaExhausted, CircuitOpen]):
+        return JSONResponse(
+            status_code=503,
+            content={"status": 503, "message": str(exc)},
+            headers={"Retry-After": str(max(1, int(exc.retry_after)))},
+        )
+
+    @app.exception_handler(DeadlineExceeded)
+    def _deadline(_request, exc: DeadlineExceeded):
+        return JSONResponse(status_code=504, content={"status": 504, "message": str(exc)})
+
+
+def health_report() -> Dict[str, Any]:
+    breakers = breaker_states()
+    quota = {name: q.level() for name, q in _QUOTAS.items()}
+    degraded = any(b["state"] == "open" for b in breakers.values()) or any(
+        level in ("critical", "exhausted") for level in quota.values()
+    )
+    return {
+        "status": "degraded" if degraded else "ok",
+        "warmup": warmup_status(),
+        "breakers": breakers,
+        "yelp_quota": quota,
+    }
+
+
+_METRICS: Dict[str, Callable[[], Any]] = {}
+
+
+def register_metrics(name: str, fn: Callable[[], Any]) -> None:
+    """Add a section to /metrics; feature modules register theirs at import."""
+    _METRICS[name] = fn
+
+
+def runtime_metrics() -> Dict[str, Any]:
+    out = {
+        "single_flight": single_flight_stats(),
+        "gemini_keys": gemini_stats(),
+        "breakers": breaker_states(),
+        "admission": admission_stats(),
+        "yelp_quota": yelp_quota_stats(),
+    }
+    for name, fn in list(_METRICS.items()):
+        out[name] = fn()
+    return out
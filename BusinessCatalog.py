@@ -0,0 +1,433 @@
+# BusinessCatalog.py
+# Embedded, geo-indexed catalog of businesses seen in search traffic.
+# Pipeline 1 upserts search summaries, Pipeline 2 upserts Fusion details and
+# verdicts; both read it back for instant "near me" results, fresh-detail hits
+# and incremental verdict refreshes.
+
+import os
+import json
+import math
+import time
+import sqlite3
+import threading
+from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+load_dotenv()
+
+
+# ---------------------------
+# CONFIG
+# ---------------------------
+CATALOG_DB_PATH = os.environ.get("CATALOG_DB_PATH", "business_catalog.db")
+CATALOG_ENABLED = os.environ.get("CATALOG_ENABLED", "1") not in ("0", "false", "False")
+
+GEOHASH_PRECISION = 9
+_EARTH_RADIUS_M = 6371008.8
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS businesses (
+    id                 TEXT PRIMARY KEY,
+    alias              TEXT,
+    name               TEXT,
+    latitude           REAL,
+    longitude          REAL,
+    geohash            TEXT,
+    categories         TEXT,
+    rating             REAL,
+    review_count       INTEGER,
+    price              TEXT,
+    summary_json       TEXT,
+    summary_updated_at REAL,
+    details_json       TEXT,
+    details_locale     TEXT,
+    details_updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_businesses_geohash ON businesses(geohash);
+CREATE INDEX IF NOT EXISTS idx_businesses_alias ON businesses(alias);
+CREATE TABLE IF NOT EXISTS verdicts (
+    business_id  TEXT,
+    locale       TEXT,
+    p_json       TEXT,
+    n_json       TEXT,
+    j_json       TEXT,
+    review_ids   TEXT,
+    full_at      REAL,
+    delta_runs   INTEGER,
+    updated_at   REAL,
+    PRIMARY KEY (business_id, locale)
+);
+"""
+
+
+# ---------------------------
+# GEOHASH
+# ---------------------------
+def geohash_encode(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_lo, lat_hi = -90.0, 90.0
+    lon_lo, lon_hi = -180.0, 180.0
+    out = []
+    bits = 0
+    ch = 0
+    even = True
+
+    while len(out) < precision:
+        if even:
+            mid = (lon_lo + lon_hi) / 2
+            if longitude >= mid:
+                ch = (ch << 1) | 1
+                lon_lo = mid
+            else:
+                ch <<= 1
+                lon_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if latitude >= mid:
+                ch = (ch << 1) | 1
+                lat_lo = mid
+            else:
+                ch <<= 1
+                lat_hi = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            out.append(_BASE32[ch])
+            bits = 0
+            ch = 0
+
+    return "".join(out)
+
+
+def _cell_size_deg(precision: int) -> Tuple[float, float]:
+    total = 5 * precision
+    lon_bits = (total + 1) // 2
+    lat_bits = total // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def _covering_cells(latitude: float, longitude: float, radius_m: float) -> List[str]:
+    """Geohash prefixes of the 3x3 block of cells (each >= radius) around the point."""
+    cos_lat = max(math.cos(math.radians(latitude)), 1e-6)
+    precision = 1
+    for p in range(GEOHASH_PRECISION, 0, -1):
+        dlat, dlon = _cell_size_deg(p)
+        if (
+            math.radians(dlat) * _EARTH_RADIUS_M >= radius_m
+            and math.radians(dlon) * _EARTH_RADIUS_M * cos_lat >= radius_m
+        ):
+            precision = p
+            break
+
+    dlat, dlon = _cell_size_deg(precision)
+    cells = set()
+    for i in (-1, 0, 1):
+        for j in (-1, 0, 1):
+            lat = min(max(latitude + i * dlat, -90.0), 90.0)
+            lon = (longitude + j * dlon + 180.0) % 360.0 - 180.0
+            cells.add(geohash_encode(lat, lon, precision))
+    return sorted(cells)
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = (
+        math.sin((p2 - p1) / 2) ** 2
+        + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    )
+    return 2 * _EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _to_float(value: Any) -> Optional[float]:
+    try:
+        f = float(value)
+    except (TypeError, ValueError):
+        return None
+    return f if math.isfinite(f) else None
+
+
+def _categories_text(categories: Iterable[Any]) -> str:
+    """'|ramen|japanese|' so a category filter is a single LIKE."""
+    names = []
+    for c in categories or []:
+        if isinstance(c, dict):
+            names.extend(v for v in (c.get("alias"), c.get("title")) if v)
+        elif c:
+            names.append(str(c))
+    return "|" + "|".join(n.strip().lower() for n in names) + "|" if names else ""
+
+
+# ---------------------------
+# CATALOG
+# ---------------------------
+class BusinessCatalog:
+    """
+    SQLite-backed catalog. One connection per thread (WAL mode); writes from
+    request handlers go through a single background writer so they never add
+    latency to a search.
+    """
+
+    def __init__(self, path: str = CATALOG_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="catalog-writer")
+        with self._conn() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # ---- writes -------------------------------------------------------------
+    def upsert_summaries(self, records: Iterable[Dict[str, Any]]) -> int:
+        """Upsert compact Pipeline 1 business records (must carry `id`)."""
+        now = time.time()
+        rows = []
+        for r in records:
+            if not r.get("id"):
+                continue
+            lat, lon = _to_float(r.get("latitude")), _to_float(r.get("longitude"))
+            rows.append((
+                r["id"],
+                r.get("name"),
+                lat,
+                lon,
+                geohash_encode(lat, lon) if lat is not None and lon is not None else None,
+                _categories_text(r.get("categories")),
+                _to_float(r.get("rating")),
+                r.get("review_count") if isinstance(r.get("review_count"), int) else None,
+                r.get("price"),
+                json.dumps(r, ensure_ascii=False, separators=(",", ":")),
+                now,
+            ))
+
+        if not rows:
+            return 0
+
+        with self._conn() as conn:
+            conn.executemany(
+                """
+                INSERT INTO businesses (
+                    id, name, latitude, longitude, geohash, categories,
+                    rating, review_count, price, summary_json, summary_updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    name = excluded.name,
+                    latitude = COALESCE(excluded.latitude, latitude),
+                    longitude = COALESCE(excluded.longitude, longitude),
+                    geohash = COALESCE(excluded.geohash, geohash),
+                    categories = CASE WHEN excluded.categories != '' THEN excluded.categories ELSE categories END,
+                    rating = COALESCE(excluded.rating, rating),
+                    review_count = COALESCE(excluded.review_count, review_count),
+                    price = COALESCE(excluded.price, price),
+                    summary_json = excluded.summary_json,
+                    summary_updated_at = excluded.summary_updated_at
+                """,
+                rows,
+            )
+        return len(rows)
+
+    def upsert_details(self, business: Dict[str, Any], locale: Optional[str] = None) -> None:
+        """Upsert a Yelp Fusion business payload as returned by get_business_details."""
+        if not business.get("id"):
+            return
+        coords = business.get("coordinates") or {}
+        lat, lon = _to_float(coords.get("latitude")), _to_float(coords.get("longitude"))
+
+        with self._conn() as conn:
+            conn.execute(
+                """
+                INSERT INTO businesses (
+                    id, alias, name, latitude, longitude, geohash, categories,
+                    rating, review_count, price, details_json, details_locale, details_updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    alias = excluded.alias,
+                    name = excluded.name,
+                    latitude = COALESCE(excluded.latitude, latitude),
+                    longitude = COALESCE(excluded.longitude, longitude),
+                    geohash = COALESCE(excluded.geohash, geohash),
+                    categories = CASE WHEN excluded.categories != '' THEN excluded.categories ELSE categories END,
+                    rating = COALESCE(excluded.rating, rating),
+                    review_count = COALESCE(excluded.review_count, review_count),
+                    price = COALESCE(excluded.price, price),
+                    details_json = excluded.details_json,
+                    details_locale = excluded.details_locale,
+                    details_updated_at = excluded.details_updated_at
+                """,
+                (
+                    business["id"],
+                    business.get("alias"),
+                    business.get("name"),
+                    lat,
+                    lon,
+                    geohash_encode(lat, lon) if lat is not None and lon is not None else None,
+                    _categories_text(business.get("categories")),
+                    _to_float(business.get("rating")),
+                    business.get("review_count") if isinstance(business.get("review_count"), int) else None,
+                    business.get("price"),
+                    json.dumps(business, ensure_ascii=False, separators=(",", ":")),
+                    locale or "",
+                    time.time(),
+                ),
+            )
+
+    def put_verdict(
+        self,
+        business_id: str,
+        locale: Optional[str],
+        verdict: Dict[str, Any],
+    ) -> None:
+        """Store Pipeline 2's P/N/J points and the review ids they were built from."""
+        with self._conn() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO verdicts (
+                    business_id, locale, p_json, n_json, j_json, review_ids, full_at, delta_runs, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    business_id,
+                    locale or "",
+                    json.dumps(verdict["P"], ensure_ascii=False),
+                    json.dumps(verdict["N"], ensure_ascii=False),
+                    json.dumps(verdict["J"], ensure_ascii=False),
+                    json.dumps(verdict["review_ids"]),
+                    verdict["full_at"],
+                    verdict["delta_runs"],
+                    time.time(),
+                ),
+            )
+
+    def submit(self, fn, *args) -> None:
+        """Run a write on the background writer; failures are swallowed."""
+        def _run():
+            try:
+                fn(*args)
+            except Exception:
+                pass
+        self._writer.submit(_run)
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Wait for writes submitted so far (batch tools call this before exiting)."""
+        self._writer.submit(lambda: None).result(timeout)
+
+    # ---- reads --------------------------------------------------------------
+    def get_verdict(self, business_id: str, locale: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT * FROM verdicts WHERE business_id = ? AND locale = ?",
+            (business_id, locale or ""),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "P": json.loads(row["p_json"]),
+            "N": json.loads(row["n_json"]),
+            "J": json.loads(row["j_json"]),
+            "review_ids": json.loads(row["review_ids"]),
+            "full_at": row["full_at"],
+            "delta_runs": row["delta_runs"],
+            "updated_at": row["updated_at"],
+        }
+
+    def get_details(
+        self,
+        id_or_alias: str,
+        locale: Optional[str] = None,
+        max_age_s: Optional[float] = None,
+    ) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            """
+            SELECT details_json, details_updated_at FROM businesses
+            WHERE (id = ? OR alias = ?) AND details_json IS NOT NULL AND details_locale = ?
+            LIMIT 1
+            """,
+            (id_or_alias, id_or_alias, locale or ""),
+        ).fetchone()
+
+        if row is None:
+            return None
+        if max_age_s is not None and time.time() - row["details_updated_at"] > max_age_s:
+            return None
+        return json.loads(row["details_json"])
+
+    def near(
+        self,
+        latitude: float,
+        longitude: float,
+        radius_m: float = 2000,
+        category: Optional[str] = None,
+        limit: int = 20,
+        max_age_s: Optional[float] = None,
+    ) -> List[Dict[str, Any]]:
+        """Businesses within radius_m, nearest first, each with `distance_m` and `updated_at`."""
+        cells = _covering_cells(latitude, longitude, radius_m)
+
+        where = ["(" + " OR ".join("geohash BETWEEN ? AND ?" for _ in cells) + ")"]
+        params: List[Any] = []
+        for c in cells:
+            params.extend([c, c + "~"])
+
+        if category:
+            where.append("categories LIKE ?")
+            params.append(f"%{category.strip().lower()}%")
+
+        if max_age_s is not None:
+            where.append("MAX(COALESCE(summary_updated_at, 0), COALESCE(details_updated_at, 0)) >= ?")
+            params.append(time.time() - max_age_s)
+
+        rows = self._conn().execute(
+            f"""
+            SELECT id, alias, name, latitude, longitude, rating, review_count, price,
+                   summary_json, summary_updated_at, details_updated_at
+            FROM businesses WHERE {" AND ".join(where)}
+            """,
+            params,
+        ).fetchall()
+
+        hits = []
+        for row in rows:
+            d = haversine_m(latitude, longitude, row["latitude"], row["longitude"])
+            if d > radius_m:
+                continue
+            if row["summary_json"]:
+                record = json.loads(row["summary_json"])
+            else:
+                record = {
+                    k: row[k]
+                    for k in ("id", "name", "latitude", "longitude", "rating", "review_count", "price")
+                    if row[k] is not None
+                }
+            record["distance_m"] = round(d, 1)
+            record["updated_at"] = max(row["summary_updated_at"] or 0, row["details_updated_at"] or 0)
+            hits.append((d, record))
+
+        hits.sort(key=lambda h: h[0])
+        return [r for _, r in hits[:limit]]
+
+
+_CATALOG: Optional[BusinessCatalog] = None
+_CATALOG_LOCK = threading.Lock()
+
+
+def get_catalog() -> Optional[BusinessCatalog]:
+    """Process-wide catalog, opened on first use; None when disabled or unavailable."""
+    global _CATALOG
+    if not CATALOG_ENABLED:
+        return None
+    if _CATALOG is None:
+        with _CATALOG_LOCK:
+            if _CATALOG is None:
+                try:
+                    _CATALOG = BusinessCatalog(CATALOG_DB_PATH)
+                except sqlite3.Error:
+                    return None
+    return _CATALOG
@@ -0,0 +1,93 @@
+# Gateway.py
+# Optional single-process entry point serving Pipeline 1 and Pipeline 2 together.
+# Both route sets share one Gemini key scheduler, one Yelp HTTP pool, one
+# shared-state/cache layer and one business catalog (all from BackendRuntime /
+# BusinessCatalog). The standalone Pipeline1Backend / Pipeline2Backend apps are
+# unchanged and still run on their own.
+#
+#   uvicorn Gateway:app
+#   gunicorn -c gunicorn.conf.py Gateway:app
+
+import os
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+
+import Pipeline1Backend
+import Pipeline2Backend
+from Profiling import install_profiling
+from BackendRuntime import health_report, install_error_handlers, runtime_metrics, start_warmup
+
+
+def _warmup_tasks():
+    tasks = {}
+    for name, task in Pipeline1Backend.warmup_tasks() + Pipeline2Backend.warmup_tasks():
+        tasks.setdefault(name, task)
+    # Pipeline 2 pre-opens the Fusion host; the Yelp AI host is the same origin.
+    return list(tasks.items())
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    start_warmup(_warmup_tasks())
+    Pipeline2Backend.start_job_workers()
+    yield
+
+
+app = FastAPI(
+    title="Yelp AI Gateway",
+    version="1.0.0",
+    default_response_class=Pipeline1Backend.CompactJSONResponse,
+    lifespan=lifespan,
+)
+
+install_error_handlers(
+    app, {**Pipeline1Backend.ROUTE_PRIORITIES, **Pipeline2Backend.ROUTE_PRIORITIES}
+)
+install_profiling(app)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+app.include_router(Pipeline1Backend.router)
+app.include_router(Pipeline2Backend.router)
+
+
+@app.get("/")
+def root():
+    return {
+        "status": "running",
+        "docs": "/docs",
+        "health": "/health",
+        "pipelines": {
+            "pipeline1": ["/search-image", "/search-caption", "/search-refine", "/search-nearby"],
+            "pipeline2": ["/analyze-business"],
+        },
+    }
+
+
+@app.get("/health")
+def health():
+    return health_report()
+
+
+@app.get("/metrics")
+def metrics():
+    return runtime_metrics()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8000")),
+        log_level="info",
+    )
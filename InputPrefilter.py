@@ -0,0 +1,316 @@
+# InputPrefilter.py
+# Cheap local checks that run before any Gemini quota is spent: image
+# content-type / magic-byte sniffing, dimension and size limits, a denylist of
+# image hashes the guardrail already rejected, and a keyword intent classifier.
+
+import os
+import re
+import struct
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from BackendRuntime import make_ttl_store, register_metrics
+
+load_dotenv()
+
+
+# ---------------------------
+# CONFIG
+# ---------------------------
+PREFILTER_ENABLED = os.environ.get("PREFILTER_ENABLED", "1") not in ("0", "false", "False")
+PREFILTER_MIN_SIDE_PX = int(os.environ.get("PREFILTER_MIN_SIDE_PX", "64"))
+# Gemini's inline-data request limit is 20 MB
+PREFILTER_MAX_BYTES = int(os.environ.get("PREFILTER_MAX_BYTES", str(20 * 1024 * 1024)))
+PREFILTER_DENYLIST_TTL_S = float(os.environ.get("PREFILTER_DENYLIST_TTL_S", str(30 * 86400)))
+PREFILTER_DENYLIST_MAX = int(os.environ.get("PREFILTER_DENYLIST_MAX", "50000"))
+
+# Guardrail categories that describe the image itself (not the user's intent),
+# so the same bytes will always be rejected again
+DENYLIST_CATEGORIES = {
+    "face_only",
+    "adult_or_nudity",
+    "violence_or_gore",
+    "drugs_or_weapons",
+    "hate_or_extremism",
+}
+
+
+@dataclass(slots=True)
+class PrefilterVerdict:
+    allowed: bool
+    reason: str = ""
+    category: str = ""
+    mime: Optional[str] = None          # sniffed MIME to send upstream
+    image_hash: Optional[str] = None
+    flags: List[str] = field(default_factory=list)
+
+
+# ---------------------------
+# IMAGE SNIFFING
+# ---------------------------
+@dataclass(slots=True)
+class ImageInfo:
+    format: str
+    mime: Optional[str]                 # None: recognised but not accepted by Gemini
+    width: Optional[int]
+    height: Optional[int]
+
+
+_HEIC_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis"}
+_HEIF_BRANDS = {b"mif1", b"msf1"}
+
+
+def _jpeg_size(data: bytes) -> Tuple[Optional[int], Optional[int]]:
+    i = 2
+    n = len(data)
+    while i + 4 <= n:
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        if marker == 0xD9:
+            break
+        seg_len = struct.unpack(">H", data[i + 2:i + 4])[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if i + 9 > n:
+                break
+            h, w = struct.unpack(">HH", data[i + 5:i + 9])
+            return w, h
+        i += 2 + seg_len
+    return None, None
+
+
+def _webp_size(data: bytes) -> Tuple[Optional[int], Optional[int]]:
+    chunk = data[12:16]
+    if chunk == b"VP8 " and len(data) >= 30:
+        w, h = struct.unpack("<HH", data[26:30])
+        return w & 0x3FFF, h & 0x3FFF
+    if chunk == b"VP8L" and len(data) >= 25:
+        bits = struct.unpack("<I", data[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(data) >= 30:
+        w = int.from_bytes(data[24:27], "little") + 1
+        h = int.from_bytes(data[27:30], "little") + 1
+        return w, h
+    return None, None
+
+
+def _heif_size(data: bytes) -> Tuple[Optional[int], Optional[int]]:
+    # image spatial extents property: 'ispe' + version/flags + width + height
+    pos = data.find(b"ispe", 0, 1 << 16)
+    if pos == -1 or pos + 16 > len(data):
+        return None, None
+    w, h = struct.unpack(">II", data[pos + 8:pos + 16])
+    return w, h
+
+
+def sniff_image(data: bytes) -> Optional[ImageInfo]:
+    """Identify an image from its magic bytes and read its dimensions from the header."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and len(data) >= 24 and data[12:16] == b"IHDR":
+        w, h = struct.unpack(">II", data[16:24])
+        return ImageInfo("png", "image/png", w, h)
+    if data.startswith(b"\xff\xd8\xff"):
+        w, h = _jpeg_size(data)
+        return ImageInfo("jpeg", "image/jpeg", w, h)
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        w, h = _webp_size(data)
+        return ImageInfo("webp", "image/webp", w, h)
+    if data[4:8] == b"ftyp":
+        brand = data[8:12]
+        if brand in _HEIC_BRANDS or brand in _HEIF_BRANDS:
+            w, h = _heif_size(data)
+            return ImageInfo("heif", "image/heic" if brand in _HEIC_BRANDS else "image/heif", w, h)
+        if brand in (b"avif", b"avis"):
+            return ImageInfo("avif", None, None, None)
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        w, h = struct.unpack("<HH", data[6:10])
+        return ImageInfo("gif", None, w, h)
+    if data[:2] == b"BM":
+        return ImageInfo("bmp", None, None, None)
+    return None
+
+
+# ---------------------------
+# INTENT CLASSIFIER
+# ---------------------------
+_WORD_RE = re.compile(r"[a-z]+")
+
+_FOOD_TERMS = frozenset("""
+food foods eat eats eating ate dinner lunch breakfast brunch dessert desserts snack snacks meal meals
+restaurant restaurants cafe cafes coffee tea boba bubble bar bars pub pubs brewery winery bakery
+bakeries diner diners bistro grill deli buffet takeout delivery dine dining menu dish dishes cuisine
+drink drinks beer wine cocktail cocktails juice smoothie grocery groceries market hotel hotels
+pizza burger burgers sushi ramen noodles noodle pho taco tacos burrito burritos curry biryani
+dumplings dim sum bbq barbecue steak steakhouse chicken wings fries sandwich sandwiches salad soup
+pasta seafood fish oysters lobster crab shrimp vegan vegetarian halal kosher gluten bagel bagels
+donut donuts doughnut cake cakes pastry pastries cookie cookies ice cream gelato chocolate pie
+pancakes waffles eggs bacon toast chinese thai indian italian mexican japanese korean vietnamese
+mediterranean greek french ethiopian lebanese turkish spanish american cajun hungry spicy tasty
+delicious yummy cheap open late nearby near best popular trending
+""".split())
+
+# Terms that alone make an intent unsafe or out of scope for a food app
+_BLOCKED_TERMS = {
+    **dict.fromkeys("gun guns rifle pistol ammo ammunition firearm firearms weapon weapons bomb bombs explosive explosives".split(), "drugs_or_weapons"),
+    **dict.fromkeys("cocaine heroin meth methamphetamine fentanyl opioids".split(), "drugs_or_weapons"),
+    **dict.fromkeys("porn porno nude nudes naked nsfw escort escorts".split(), "adult_or_nudity"),
+    **dict.fromkeys("murder gore torture behead".split(), "violence_or_gore"),
+    **dict.fromkeys("nazi genocide".split(), "hate_or_extremism"),
+    **dict.fromkeys("homework essay python javascript stock stocks crypto bitcoin password hack hacking".split(), "unrelated"),
+}
+
+
+def classify_intent(text: str) -> Tuple[str, float]:
+    """
+    Keyword classifier for free-text intents. Returns (label, confidence) where
+    label is "food", "unknown", or a guardrail category for blocked intents.
+    """
+    words = _WORD_RE.findall((text or "").lower())
+    if not words:
+        return "unknown", 0.0
+    food = sum(1 for w in words if w in _FOOD_TERMS)
+    blocked = [_BLOCKED_TERMS[w] for w in words if w in _BLOCKED_TERMS]
+    if blocked and not food:
+        return blocked[0], min(1.0, 0.6 + 0.2 * len(blocked))
+    if food:
+        return "food", min(1.0, 0.5 + 0.25 * food)
+    return "unknown", 0.0
+
+
+# ---------------------------
+# STATS
+# ---------------------------
+_STATS_LOCK = threading.Lock()
+_STATS: Dict[str, Any] = {
+    "images_checked": 0,
+    "captions_checked": 0,
+    "rejected": {},
+    "flagged": {},
+    "gemini_calls_avoided": 0,
+}
+
+
+def _count(kind: str, key: str) -> None:
+    with _STATS_LOCK:
+        _STATS[kind][key] = _STATS[kind].get(key, 0) + 1
+
+
+def _reject(reason: str, category: str, code: str, **kw) -> PrefilterVerdict:
+    _count("rejected", code)
+    with _STATS_LOCK:
+        _STATS["gemini_calls_avoided"] += 1
+    return PrefilterVerdict(False, reason, category, **kw)
+
+
+def prefilter_stats() -> Dict[str, Any]:
+    with _STATS_LOCK:
+        return {
+            "enabled": PREFILTER_ENABLED,
+            "images_checked": _STATS["images_checked"],
+            "captions_checked": _STATS["captions_checked"],
+            "rejected": dict(_STATS["rejected"]),
+            "flagged": dict(_STATS["flagged"]),
+            "gemini_calls_avoided": _STATS["gemini_calls_avoided"],
+            "denylist_size": len(_DENYLIST),
+        }
+
+
+register_metrics("prefilter", prefilter_stats)
+
+
+# ---------------------------
+# CHECKS
+# ---------------------------
+_DENYLIST = make_ttl_store("image_denylist", PREFILTER_DENYLIST_TTL_S, PREFILTER_DENYLIST_MAX)
+
+
+def image_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def check_image(data: bytes, declared_mime: Optional[str], intent: str) -> PrefilterVerdict:
+    """
+    Validate an uploaded image locally. A rejection means the Gemini guardrail
+    would have refused it; an allowed verdict carries the sniffed MIME type.
+    """
+    declared = (declared_mime or "").split(";")[0].strip().lower()
+    if not PREFILTER_ENABLED:
+        return PrefilterVerdict(True, mime=declared or "image/jpeg")
+
+    with _STATS_LOCK:
+        _STATS["images_checked"] += 1
+
+    if not data:
+        return _reject("The uploaded image is empty.", "invalid_image", "empty")
+    if len(data) > PREFILTER_MAX_BYTES:
+        return _reject("The uploaded image is too large.", "invalid_image", "too_large")
+    if declared and not declared.startswith("image/") and declared != "application/octet-stream":
+        return _reject(f"Unsupported upload type: {declared}.", "invalid_image", "not_an_image")
+
+    info = sniff_image(data)
+    if info is None:
+        return _reject("The upload is not a readable image.", "invalid_image", "unrecognised")
+    if info.mime is None:
+        return _reject(f"Unsupported image format: {info.format}.", "invalid_image", "unsupported_format")
+
+    flags: List[str] = []
+    if declared and declared != info.mime:
+        flags.append("mime_mismatch")
+    if info.width is None or info.height is None:
+        flags.append("dimensions_unknown")
+    elif info.width == 0 or info.height == 0:
+        return _reject("The upload is not a readable image.", "invalid_image", "corrupt")
+    elif min(info.width, info.height) < PREFILTER_MIN_SIDE_PX:
+        return _reject("The image is too small to recognise any food.", "invalid_image", "too_small")
+
+    digest = image_digest(data)
+    denied = _DENYLIST.get(digest)
+    if denied is not None:
+        reason, category = denied
+        return _reject(reason, category, "denylisted")
+
+    label, _confidence = classify_intent(intent)
+    if label not in ("food", "unknown"):
+        return _reject("This request is not about finding food or dining.", label, "intent")
+    if label == "unknown":
+        flags.append("intent_unclear")
+
+    for flag in flags:
+        _count("flagged", flag)
+    return PrefilterVerdict(True, mime=info.mime, image_hash=digest, flags=flags)
+
+
+def check_caption(text: str) -> PrefilterVerdict:
+    """Gate for text-only searches, which have no Gemini guardrail of their own."""
+    if not PREFILTER_ENABLED:
+        return PrefilterVerdict(True)
+
+    with _STATS_LOCK:
+        _STATS["captions_checked"] += 1
+
+    if not (text or "").strip():
+        return _reject("Describe the food or place you are looking for.", "uncertain", "empty_caption")
+
+    label, _confidence = classify_intent(text)
+    if label not in ("food", "unknown"):
+        return _reject("This request is not about finding food or dining.", label, "intent")
+    if label == "unknown":
+        _count("flagged", "intent_unclear")
+        return PrefilterVerdict(True, flags=["intent_unclear"])
+    return PrefilterVerdict(True)
+
+
+def remember_rejected_image(image_hash: Optional[str], reason: str, category: str) -> None:
+    """Denylist an image the guardrail rejected for what it shows (not for the intent)."""
+    if PREFILTER_ENABLED and image_hash and category in DENYLIST_CATEGORIES:
+        _DENYLIST.put(image_hash, (reason, category))
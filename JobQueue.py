@@ -0,0 +1,341 @@
+# JobQueue.py
+# Bounded background job queue persisted in SQLite. Jobs survive restarts
+# (running jobs whose lease expired are picked up again), every worker process
+# on the host can claim from the same file, and resubmitting the same work
+# returns the existing job instead of queueing a duplicate.
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+from dotenv import load_dotenv
+
+from BackendRuntime import admission_pressure, http_session, register_metrics, yelp_quota_level
+
+load_dotenv()
+
+logger = logging.getLogger("backend.jobs")
+
+
+# ---------------------------
+# CONFIG
+# ---------------------------
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", "analysis_jobs.db")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_QUEUE_MAX = int(os.environ.get("JOB_QUEUE_MAX", "200"))
+# A running job not finished within its lease is assumed lost (crash/restart) and re-queued
+JOB_LEASE_S = float(os.environ.get("JOB_LEASE_S", "300"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+# Finished jobs younger than this answer resubmissions of the same work
+JOB_RESULT_TTL_S = float(os.environ.get("JOB_RESULT_TTL_S", "3600"))
+JOB_RETAIN_S = float(os.environ.get("JOB_RETAIN_S", str(7 * 86400)))
+JOB_WEBHOOK_TIMEOUT_S = float(os.environ.get("JOB_WEBHOOK_TIMEOUT_S", "10"))
+
+_POLL_S = 1.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id             TEXT PRIMARY KEY,
+    kind           TEXT NOT NULL,
+    dedupe_key     TEXT NOT NULL,
+    payload        TEXT NOT NULL,
+    status         TEXT NOT NULL,
+    result         TEXT,
+    error          TEXT,
+    status_code    INTEGER,
+    webhook_url    TEXT,
+    webhook_status TEXT,
+    attempts       INTEGER NOT NULL DEFAULT 0,
+    run_after      REAL NOT NULL,
+    lease_until    REAL,
+    created_at     REAL NOT NULL,
+    updated_at     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs(status, run_after);
+CREATE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs(kind, dedupe_key, created_at);
+"""
+
+
+# Yelp quota levels at which workers stop claiming jobs
+_QUOTA_PAUSE = ("critical", "exhausted")
+
+
+class JobQueueFull(RuntimeError):
+    """Too many queued jobs; `retry_after` is a hint in seconds."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class JobFailed(RuntimeError):
+    """Permanent job failure with the HTTP status the synchronous route would return."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+Handler = Callable[[Dict[str, Any]], Any]
+
+# kind -> (handler, retryable predicate); registered at import by the owning module
+_HANDLERS: Dict[str, Tuple[Handler, Callable[[BaseException], bool]]] = {}
+
+
+def register_handler(
+    kind: str,
+    handler: Handler,
+    retryable: Callable[[BaseException], bool] = lambda e: False,
+) -> None:
+    _HANDLERS[kind] = (handler, retryable)
+
+
+class JobQueue:
+    """
+    Jobs move queued -> running -> done | failed. Claims happen inside
+    BEGIN IMMEDIATE, so threads and processes never run the same job twice.
+    Handlers return a JSON-serialisable result; raise JobFailed for permanent
+    errors. Other exceptions are retried with backoff up to JOB_MAX_ATTEMPTS
+    when the kind's `retryable` predicate (see register_handler) accepts them.
+    """
+
+    def __init__(self, path: str = JOBS_DB_PATH, workers: int = JOB_WORKERS, max_queued: int = JOB_QUEUE_MAX):
+        self.path = path
+        self.workers = workers
+        self.max_queued = max_queued
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._started_pid: Optional[int] = None
+        self._start_lock = threading.Lock()
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _txn(self, fn):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            out = fn(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return out
+
+    # ---- API ----------------------------------------------------------------
+    def submit(
+        self,
+        kind: str,
+        payload: Dict[str, Any],
+        dedupe_key: str,
+        webhook_url: Optional[str] = None,
+    ) -> Tuple[Dict[str, Any], bool]:
+        """Queue a job, or return the active/recent job for the same key. -> (job, created)"""
+        if webhook_url and urlparse(webhook_url).scheme not in ("http", "https"):
+            raise ValueError("webhook_url must be an http(s) URL")
+        now = time.time()
+
+        def op(conn):
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE kind = ? AND dedupe_key = ? AND ("
+                "  status IN ('queued', 'running') OR (status = 'done' AND updated_at >= ?)"
+                ") ORDER BY created_at DESC LIMIT 1",
+                (kind, dedupe_key, now - JOB_RESULT_TTL_S),
+            ).fetchone()
+            if row is not None:
+                return row, False
+
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise JobQueueFull("Job queue is full", retry_after=30)
+
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, kind, dedupe_key, payload, status, webhook_url, run_after, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, kind, dedupe_key, json.dumps(payload), webhook_url, now, now, now),
+            )
+            return conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone(), True
+
+        row, created = self._txn(op)
+        if created:
+            self.start()
+            self._wake.set()
+        return self._public(row), created
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._public(row) if row is not None else None
+
+    @staticmethod
+    def _public(row: sqlite3.Row) -> Dict[str, Any]:
+        job = {
+            "job_id": row["id"],
+            "kind": row["kind"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+        if row["result"] is not None:
+            job["result"] = json.loads(row["result"])
+        if row["error"]:
+            job["error"] = row["error"]
+            job["status_code"] = row["status_code"]
+        if row["webhook_status"]:
+            job["webhook_status"] = row["webhook_status"]
+        return job
+
+    # ---- workers ------------------------------------------------------------
+    def start(self) -> None:
+        """Start this process's worker threads (once per pid, so safe after a fork)."""
+        if self._started_pid == os.getpid() or self.workers <= 0:
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            for i in range(self.workers):
+                threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True).start()
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        now = time.time()
+
+        def op(conn):
+            # jobs whose worker died (restart, crash) go back to the queue
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', lease_until = NULL, updated_at = ?"
+                " WHERE status = 'running' AND lease_until < ?",
+                (now, now),
+            )
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' AND run_after <= ?"
+                " ORDER BY run_after LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ?"
+                " WHERE id = ?",
+                (now + JOB_LEASE_S, now, row["id"]),
+            )
+            return row
+
+        return self._txn(op)
+
+    def _finish(self, job_id: str, status: str, result: Any = None, error: str = "", status_code: Optional[int] = None) -> None:
+        self._conn().execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, status_code = ?, lease_until = NULL, updated_at = ?"
+            " WHERE id = ?",
+            (status, json.dumps(result) if result is not None else None, error or None, status_code, time.time(), job_id),
+        )
+
+    def _retry_later(self, job_id: str, attempts: int, error: str) -> None:
+        now = time.time()
+        self._conn().execute(
+            "UPDATE jobs SET status = 'queued', error = ?, lease_until = NULL, run_after = ?, updated_at = ?"
+            " WHERE id = ?",
+            (error, now + min(300.0, 10.0 * 2 ** (attempts - 1)), now, job_id),
+        )
+
+    def _run(self, row: sqlite3.Row) -> None:
+        job_id, kind = row["id"], row["kind"]
+        handler, retryable = _HANDLERS.get(kind, (None, None))
+        if handler is None:
+            self._finish(job_id, "failed", error=f"No handler for job kind {kind!r}", status_code=500)
+            return
+        attempts = row["attempts"] + 1
+        try:
+            result = handler(json.loads(row["payload"]))
+        except JobFailed as e:
+            self._finish(job_id, "failed", error=str(e), status_code=e.status_code)
+        except Exception as e:
+            message = str(e)[:500] or type(e).__name__
+            if retryable(e) and attempts < JOB_MAX_ATTEMPTS:
+                logger.warning("job %s attempt %d failed, retrying: %s", job_id, attempts, message)
+                self._retry_later(job_id, attempts, message)
+                return
+            self._finish(job_id, "failed", error=message, status_code=getattr(e, "status_code", None) or 500)
+        else:
+            self._finish(job_id, "done", result=result)
+        self._notify(job_id)
+
+    def _notify(self, job_id: str) -> None:
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or not row["webhook_url"]:
+            return
+        try:
+            r = http_session().post(row["webhook_url"], json=self._public(row), timeout=JOB_WEBHOOK_TIMEOUT_S)
+            outcome = f"http {r.status_code}"
+        except Exception as e:
+            outcome = f"error: {str(e)[:200]}"
+        self._conn().execute("UPDATE jobs SET webhook_status = ? WHERE id = ?", (outcome, job_id))
+
+    def _purge(self) -> None:
+        self._conn().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+            (time.time() - JOB_RETAIN_S,),
+        )
+
+    def _worker(self) -> None:
+        last_purge = 0.0
+        while True:
+            try:
+                # interactive traffic is queueing or Yelp quota is nearly spent:
+                # leave the CPU and upstream quota to interactive requests
+                if admission_pressure() > 1.0 or yelp_quota_level("yelp_fusion") in _QUOTA_PAUSE:
+                    time.sleep(_POLL_S)
+                    continue
+                row = self._claim()
+                if row is None:
+                    if time.time() - last_purge > 3600:
+                        self._purge()
+                        last_purge = time.time()
+                    self._wake.wait(_POLL_S)
+                    self._wake.clear()
+                    continue
+                self._run(row)
+            except Exception:
+                logger.exception("job worker error")
+                time.sleep(_POLL_S)
+
+    def stats(self) -> Dict[str, Any]:
+        counts = dict(self._conn().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {
+            "workers": self.workers if self._started_pid == os.getpid() else 0,
+            "max_queued": self.max_queued,
+            **{s: counts.get(s, 0) for s in ("queued", "running", "done", "failed")},
+        }
+
+
+_QUEUE: Optional[JobQueue] = None
+_QUEUE_LOCK = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """Process-wide queue over JOBS_DB_PATH, opened on first use."""
+    global _QUEUE
+    if _QUEUE is None:
+        with _QUEUE_LOCK:
+            if _QUEUE is None:
+                _QUEUE = JobQueue(JOBS_DB_PATH)
+    return _QUEUE
+
+
+register_metrics("jobs", lambda: get_job_queue().stats() if _QUEUE is not None else None)
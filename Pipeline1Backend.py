@@ -1,478 +1,1470 @@
-import os
-import re
-import json
-import requests
-from typing import Any, Dict, List, Optional, Tuple
-
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-
-from google import genai
-from google.genai import types
-
-import uvicorn
-from dotenv import load_dotenv
-
-
-# ============================================================================
-# ENV + CLIENTS
-# ============================================================================
-load_dotenv()
-
-GEMINI_API_KEY = os.environ.get("GOOGLE_API_KEY") or os.environ.get("GEMINI_API_KEY")
-YELP_API_KEY = os.environ.get("YELP_API_KEY")
-YELP_AI_ENDPOINT = os.environ.get(
-    "YELP_AI_ENDPOINT", "https://api.yelp.com/ai/chat/v2"
-)
-
-if not GEMINI_API_KEY:
-    raise RuntimeError("Missing GOOGLE_API_KEY or GEMINI_API_KEY in environment")
-
-if not YELP_API_KEY:
-    raise RuntimeError("Missing YELP_API_KEY in environment")
-
-client = genai.Client(api_key=GEMINI_API_KEY)
-
-# ✅ Correct model from your rate-limit dashboard
-MODEL_FAST = "gemini-2.5-flash-lite"
-
-
-# ============================================================================
-# FASTAPI APP
-# ============================================================================
-app = FastAPI(title="Yelp AI Backend", version="1.5.0")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-
-# ============================================================================
-# GUARDRAIL PROMPT
-# ============================================================================
-GUARDRAIL_SYS = """
-You are a safety + relevance gate for an app that ONLY helps users find places to GET, EAT, or USE
-food, drinks, groceries, desserts, and restaurant/hotel services.
-
-You will see:
-- An IMAGE
-- A short USER INTENT
-
-Output ONLY valid JSON:
-
-{
-  "allowed": true/false,
-  "reason": "<short safety/relevance explanation>",
-  "category": "<food_or_venue | face_only | adult_or_nudity | violence_or_gore |
-               drugs_or_weapons | hate_or_extremism | unrelated | uncertain>"
-}
-
-Rules:
-- If anything unsafe (nudity, violence, drugs, weapons, hate) is detected → allowed=false.
-- If user intent is unrelated to food/venues → allowed=false.
-- Otherwise → allowed=true.
-"""
-
-
-# ============================================================================
-# JSON / TEXT HELPERS
-# ============================================================================
-_CODE_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE | re.MULTILINE)
-
-
-def _strip_code_fences(text: str) -> str:
-    return _CODE_FENCE_RE.sub("", (text or "").strip())
-
-
-def _extract_json_obj_substring(text: str) -> Optional[str]:
-    s = text.find("{")
-    e = text.rfind("}")
-    if s != -1 and e != -1 and e > s:
-        return text[s:e + 1]
-    return None
-
-
-def _safe_json_parse(text: str) -> Optional[Dict[str, Any]]:
-    if not text:
-        return None
-
-    cleaned = _strip_code_fences(text)
-
-    try:
-        parsed = json.loads(cleaned)
-        if isinstance(parsed, dict):
-            return parsed
-    except Exception:
-        pass
-
-    sub = _extract_json_obj_substring(cleaned)
-    if sub:
-        try:
-            parsed = json.loads(sub)
-            if isinstance(parsed, dict):
-                return parsed
-        except Exception:
-            return None
-
-    return None
-
-
-def _truncate_to_sentence(text: str, max_len: int = 1000) -> str:
-    text = (text or "").strip()
-    if len(text) <= max_len:
-        return text
-
-    truncated = text[:max_len]
-    p = max(
-        truncated.rfind("."),
-        truncated.rfind("!"),
-        truncated.rfind("?"),
-    )
-
-    return truncated[: p + 1] if p != -1 else truncated
-
-
-# ============================================================================
-# PROMPT BUILDERS
-# ============================================================================
-def _build_prompt(
-    location: str,
-    latitude: str,
-    longitude: str,
-    date: str,
-    time: str,
-) -> str:
-
-    latlon_block = ""
-    if latitude or longitude:
-        latlon_block = f"Latitude: {latitude or 'N/A'}\nLongitude: {longitude or 'N/A'}\n"
-
-    return (
-        "Write exactly ONE natural-language Yelp search sentence.\n"
-        f"Location: {location}\n"
-        f"{latlon_block}"
-        f"Date: {date}\n"
-        f"Time: {time}\n"
-        "Goal:\n"
-        "- Find places serving the food shown OR\n"
-        "- Find TRENDING / POPULAR nearby food or venues if asked.\n"
-        "Rules:\n"
-        "- Ask for MANY options sorted by popularity/reviews.\n"
-        "- Use clear first-person phrasing.\n"
-        "- Output a single sentence only.\n"
-        "- No meta or markdown.\n"
-        "- Under 900 characters.\n"
-    )
-
-
-# ============================================================================
-# GEMINI FUNCTIONS
-# ============================================================================
-def _guardrail_check_image(
-    image_bytes: bytes,
-    mime_type: str,
-    user_intent: str,
-) -> Tuple[bool, str, str]:
-
-    try:
-        resp = client.models.generate_content(
-            model=MODEL_FAST,
-            contents=[
-                GUARDRAIL_SYS,
-                types.Part.from_bytes(data=image_bytes, mime_type=mime_type),
-                f"User intent: {user_intent}",
-            ],
-            config={"response_mime_type": "application/json"},
-        )
-
-        raw = (getattr(resp, "text", "") or "").strip()
-        data = _safe_json_parse(raw) or {}
-
-    except Exception:
-        return False, "Safety validation failed.", "uncertain"
-
-    allowed = bool(data.get("allowed", False))
-    reason = str(data.get("reason") or "").strip()
-    category = str(data.get("category") or "uncertain").strip()
-
-    if not reason:
-        return False, "Unable to verify image safety and relevance.", "uncertain"
-
-    return allowed, reason, category
-
-
-def _gemini_image_to_query(
-    image_bytes: bytes,
-    mime_type: str,
-    user_query: str,
-    location: str,
-    latitude: str,
-    longitude: str,
-    date: str,
-    time: str,
-) -> str:
-
-    instruction = _build_prompt(location, latitude, longitude, date, time)
-
-    resp = client.models.generate_content(
-        model=MODEL_FAST,
-        contents=[
-            types.Part.from_bytes(data=image_bytes, mime_type=mime_type),
-            instruction,
-            f"User intent: {user_query}",
-        ],
-    )
-
-    return _truncate_to_sentence(getattr(resp, "text", "") or "")
-
-
-def _gemini_caption_to_query(
-    user_query: str,
-    location: str,
-    latitude: str,
-    longitude: str,
-    date: str,
-    time: str,
-) -> str:
-
-    instruction = _build_prompt(location, latitude, longitude, date, time)
-
-    resp = client.models.generate_content(
-        model=MODEL_FAST,
-        contents=[
-            instruction,
-            f"User intent: {user_query}",
-        ],
-    )
-
-    return _truncate_to_sentence(getattr(resp, "text", "") or "")
-
-
-# ============================================================================
-# YELP CALL
-# ============================================================================
-def _call_yelp_ai(yelp_query: str) -> Dict[str, Any]:
-
-    headers = {
-        "Authorization": f"Bearer {YELP_API_KEY}",
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-    }
-
-    payload = {"query": yelp_query}
-
-    r = requests.post(
-        YELP_AI_ENDPOINT,
-        headers=headers,
-        json=payload,
-        timeout=45,
-    )
-
-    if r.status_code != 200:
-        raise HTTPException(status_code=r.status_code, detail=r.text)
-
-    return r.json()
-
-
-# ============================================================================
-# RESULT EXTRACTION
-# ============================================================================
-def _extract_results(data: Dict[str, Any], yelp_query: str) -> Dict[str, Any]:
-
-    ai_text = (data.get("response") or {}).get("text", "") or ""
-
-    results = {
-        "chat_id": data.get("chat_id"),
-        "query": yelp_query,
-        "ai_response_text": ai_text,
-        "businesses": [],
-    }
-
-    for entity in data.get("entities") or []:
-        for biz in entity.get("businesses") or []:
-
-            loc = biz.get("location") or {}
-            coords = biz.get("coordinates") or {}
-            summaries = biz.get("summaries") or {}
-            contextual = biz.get("contextual_info") or {}
-
-            photos = contextual.get("photos") or []
-            hours = contextual.get("business_hours") or []
-            openings = (biz.get("reservation_availability") or {}).get("openings") or []
-
-            addr = (
-                loc.get("formatted_address")
-                or ", ".join(
-                    p
-                    for p in [
-                        loc.get("address1"),
-                        loc.get("city"),
-                        loc.get("state"),
-                        loc.get("zip_code"),
-                        loc.get("country"),
-                    ]
-                    if p
-                )
-                or "N/A"
-            )
-
-            photo_url = (
-                photos[0].get("original_url")
-                if photos and isinstance(photos[0], dict)
-                else "N/A"
-            )
-
-            hours_list = []
-            for h in hours:
-                slots = []
-                for s in h.get("business_hours", []):
-                    if s.get("open_time") and s.get("close_time"):
-                        slots.append(f"{s['open_time']} to {s['close_time']}")
-                hours_list.append({
-                    "day_of_week": h.get("day_of_week", "N/A"),
-                    "hours": slots,
-                })
-
-            opening_list = []
-            for d in openings:
-                opening_list.append({
-                    "date": d.get("date", "N/A"),
-                    "slots": [
-                        {
-                            "time": s.get("time", "N/A"),
-                            "seating_areas": s.get("seating_areas", []),
-                        }
-                        for s in d.get("slots", [])
-                    ],
-                })
-
-            results["businesses"].append({
-
-                "id": biz.get("id"),
-
-                "name": biz.get("name", "N/A"),
-                "address": addr,
-                "yelp_url": biz.get("url", "N/A"),
-
-                "rating": biz.get("rating", "N/A"),
-                "review_count": biz.get("review_count", "N/A"),
-                "price": biz.get("price", "N/A"),
-
-                "latitude": coords.get("latitude", "N/A"),
-                "longitude": coords.get("longitude", "N/A"),
-
-                "short_summary": summaries.get("short") or contextual.get("summary") or "N/A",
-
-                "photo_url": photo_url,
-                "business_hours": hours_list,
-                "reservation_openings": opening_list,
-
-                "phone": biz.get("phone", "N/A"),
-            })
-
-    results["businesses"].sort(
-        key=lambda b: (
-            float(b["rating"]) if isinstance(b["rating"], (int, float)) else -1,
-            int(b["review_count"]) if isinstance(b["review_count"], int) else -1,
-        ),
-        reverse=True,
-    )
-
-    return results
-
-
-# ============================================================================
-# ROUTES
-# ============================================================================
-@app.get("/")
-def root():
-    return {"status": "running", "docs": "/docs", "health": "/health"}
-
-
-@app.get("/health")
-def health():
-    return {"status": "ok"}
-
-
-@app.post("/search-image")
-async def search_image(
-    image: UploadFile = File(...),
-    user_query: str = Form(...),
-    Location: str = Form(""),
-    Latitude: str = Form(""),
-    Longitude: str = Form(""),
-    Date: str = Form("12/11/2025"),
-    Time: str = Form("8pm"),
-):
-
-    img = await image.read()
-    mime = image.content_type or "image/jpeg"
-
-    allowed, reason, cat = _guardrail_check_image(img, mime, user_query)
-    if not allowed:
-        return JSONResponse(
-            status_code=422,
-            content={
-                "status": 422,
-                "message": reason,
-                "category": cat,
-            },
-        )
-
-    yelp_query = _gemini_image_to_query(
-        img,
-        mime,
-        user_query,
-        Location,
-        Latitude,
-        Longitude,
-        Date,
-        Time,
-    )
-
-    data = _call_yelp_ai(yelp_query)
-
-    return _extract_results(data, yelp_query)
-
-
-@app.post("/search-caption")
-async def search_caption(
-    user_query: str = Form(...),
-
-    Location: str = Form(""),
-    Latitude: str = Form(""),
-    Longitude: str = Form(""),
-
-    Date: str = Form("12/11/2025"),
-    Time: str = Form("8pm"),
-):
-
-    yelp_query = _gemini_caption_to_query(
-        user_query,
-        Location,
-        Latitude,
-        Longitude,
-        Date,
-        Time,
-    )
-
-    data = _call_yelp_ai(yelp_query)
-
-    return _extract_results(data, yelp_query)
-
-
-# ============================================================================
-# LOCAL RUN
-# ============================================================================
-if __name__ == "__main__":
-    uvicorn.run(
-        app,
-        host="0.0.0.0",
-        port=int(os.environ.get("PORT", "8000")),
-        log_level="info",
-    )
+import os
+import re
+import json
+import math
+import uuid
+import heapq
+import bisect
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field, fields, replace
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, FastAPI, UploadFile, File, Form, HTTPException
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import orjson
+except ImportError:  # optional: falls back to the stdlib encoder
+    orjson = None
+
+import uvicorn
+from dotenv import load_dotenv
+
+from BusinessCatalog import get_catalog
+from InputPrefilter import check_caption, check_image, remember_rejected_image
+from Profiling import install_profiling, ProfiledRoute
+from QueryCompiler import CAPTION_COMPILER_MODE, choose_local, compile_caption, record_shadow
+from BackendRuntime import (
+    digest,
+    extract_json_substring,
+    gemini_config,
+    gemini_scheduler,
+    health_report,
+    install_error_handlers,
+    make_ttl_store,
+    normalize_text,
+    PASSTHROUGH_ERRORS,
+    preopen_connection,
+    require,
+    runtime_metrics,
+    single_flight,
+    start_warmup,
+    strip_code_fences,
+    TTLStore,
+    upstream_request,
+    yelp_quota_level,
+)
+
+
+# ============================================================================
+# ENV + CLIENTS
+# ============================================================================
+load_dotenv()
+
+# Gemini keys (one, or a comma-separated list) are read by BackendRuntime and
+# scheduled per call; the scheduler is built on first use or during warmup, so a
+# missing key answers 503 on the routes that need it instead of crashing import.
+YELP_API_KEY = os.environ.get("YELP_API_KEY")
+YELP_AI_ENDPOINT = os.environ.get(
+    "YELP_AI_ENDPOINT", "https://api.yelp.com/ai/chat/v2"
+)
+
+# ✅ Correct model from your rate-limit dashboard
+MODEL_FAST = "gemini-2.5-flash-lite"
+
+# Short-lived server-side store of ranked results (pagination + lazy details)
+RESULT_STORE_TTL_S = float(os.environ.get("RESULT_STORE_TTL_S", "600"))
+RESULT_STORE_MAX = int(os.environ.get("RESULT_STORE_MAX", "2000"))
+
+# Yelp AI conversations kept open for /search-refine
+SESSION_TTL_S = float(os.environ.get("SESSION_TTL_S", "1800"))
+SESSION_MAX = int(os.environ.get("SESSION_MAX", "5000"))
+
+# Ranking: blend of smoothed rating, proximity and open-at-requested-time
+RANK_W_RATING = float(os.environ.get("RANK_W_RATING", "0.6"))
+RANK_W_DISTANCE = float(os.environ.get("RANK_W_DISTANCE", "0.25"))
+RANK_W_OPEN = float(os.environ.get("RANK_W_OPEN", "0.15"))
+RANK_PRIOR_RATING = float(os.environ.get("RANK_PRIOR_RATING", "3.8"))
+RANK_PRIOR_REVIEWS = float(os.environ.get("RANK_PRIOR_REVIEWS", "25"))
+RANK_DISTANCE_SCALE_M = float(os.environ.get("RANK_DISTANCE_SCALE_M", "3000"))
+RANK_TOP_K = int(os.environ.get("RANK_TOP_K", "100"))
+
+# Compiled weekly opening hours, cached by business id
+HOURS_INDEX_TTL_S = float(os.environ.get("HOURS_INDEX_TTL_S", "86400"))
+HOURS_INDEX_MAX = int(os.environ.get("HOURS_INDEX_MAX", "50000"))
+
+# Provisional "near me" results served from the local business catalog
+CATALOG_NEARBY_MAX_AGE_S = float(os.environ.get("CATALOG_NEARBY_MAX_AGE_S", str(7 * 86400)))
+
+# Images accepted by one /search-image request (carousel screenshots)
+MULTI_IMAGE_MAX = int(os.environ.get("MULTI_IMAGE_MAX", "5"))
+
+# Recent Yelp AI replies by query, served instead of a new call while the
+# Yelp AI quota is low
+YELP_AI_CACHE_TTL_S = float(os.environ.get("YELP_AI_CACHE_TTL_S", str(6 * 3600)))
+YELP_AI_CACHE_MAX = int(os.environ.get("YELP_AI_CACHE_MAX", "2000"))
+
+
+# ============================================================================
+# RESULT MODEL
+# ============================================================================
+# Compact, slotted representation of an extracted search result. Fields left at
+# their default (missing upstream values) are dropped from the JSON body.
+@dataclass(slots=True)
+class OpeningSlot:
+    time: Optional[str] = None
+    seating_areas: List[Any] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class OpeningDay:
+    date: Optional[str] = None
+    slots: List[OpeningSlot] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class DayHours:
+    day_of_week: Optional[Any] = None
+    hours: List[str] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class Business:
+    id: Optional[str] = None
+    name: Optional[str] = None
+    address: Optional[str] = None
+    yelp_url: Optional[str] = None
+    rating: Optional[float] = None
+    review_count: Optional[int] = None
+    price: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    short_summary: Optional[str] = None
+    photo_url: Optional[str] = None
+    business_hours: List[DayHours] = field(default_factory=list)
+    reservation_openings: List[OpeningDay] = field(default_factory=list)
+    phone: Optional[str] = None
+    categories: List[str] = field(default_factory=list)
+    distance_m: Optional[float] = None
+    open_at_request: Optional[bool] = None
+    next_open: Optional[str] = None
+    # Compiled hours used for ranking; never serialized
+    hours_index: Optional["WeeklyHours"] = field(
+        default=None, repr=False, compare=False, metadata={"internal": True}
+    )
+
+
+@dataclass(slots=True)
+class DishMatch:
+    """One distinct dish in a multi-image search, or an image that produced none."""
+    images: List[int] = field(default_factory=list)   # 1-based upload positions
+    dish: str = ""
+    query: str = ""
+    business_ids: List[str] = field(default_factory=list)
+    message: str = ""                                 # why this image has no results
+    category: str = ""
+
+
+@dataclass(slots=True)
+class SearchResults:
+    chat_id: Optional[str] = None
+    query: str = ""
+    ai_response_text: str = ""
+    businesses: List[Business] = field(default_factory=list)
+    result_id: Optional[str] = None
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None
+    dishes: List[DishMatch] = field(default_factory=list)
+
+
+def _public_fields(cls_or_obj: Any) -> Tuple[str, ...]:
+    return tuple(f.name for f in fields(cls_or_obj) if not f.metadata.get("internal"))
+
+
+BUSINESS_FIELDS = frozenset(_public_fields(Business))
+
+# Per-request values that must not leak into the shared catalog
+_REQUEST_FIELDS = ("distance_m", "open_at_request", "next_open")
+
+
+@dataclass(slots=True)
+class SearchSession:
+    """What a refinement needs from the original search; no LLM state is kept."""
+    chat_id: str
+    query: str
+    guardrail_reason: Optional[str] = None
+    guardrail_category: Optional[str] = None
+    latitude: str = ""
+    longitude: str = ""
+    date: str = ""
+    time: str = ""
+    refinements: List[str] = field(default_factory=list)
+
+
+_FIELD_NAMES: Dict[type, Tuple[str, ...]] = {}
+
+
+def _compact(obj: Any) -> Any:
+    """Convert result dataclasses to plain JSON types, dropping empty fields."""
+    if isinstance(obj, list):
+        return [_compact(v) for v in obj]
+
+    names = _FIELD_NAMES.get(type(obj))
+    if names is None:
+        if not hasattr(obj, "__dataclass_fields__"):
+            return obj
+        names = _FIELD_NAMES.setdefault(type(obj), _public_fields(obj))
+
+    out = {}
+    for name in names:
+        v = getattr(obj, name)
+        if v is None or v == "" or v == []:
+            continue
+        out[name] = _compact(v) if isinstance(v, list) else v
+    return out
+
+
+class CompactJSONResponse(JSONResponse):
+    """JSON response that skips FastAPI's generic encoder and omits empty fields."""
+
+    def render(self, content: Any) -> bytes:
+        if hasattr(content, "__dataclass_fields__") or isinstance(content, list):
+            content = _compact(content)
+        if orjson is not None:
+            return orjson.dumps(content)
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+# ============================================================================
+# RESULT STORE
+# ============================================================================
+# Shared across workers in multi-process mode so cursors and chat_ids work on any worker
+_RESULT_STORE = make_ttl_store("results", RESULT_STORE_TTL_S, RESULT_STORE_MAX)
+_BUSINESS_STORE = make_ttl_store("businesses", RESULT_STORE_TTL_S, RESULT_STORE_MAX * 20)
+_SESSION_STORE = make_ttl_store("sessions", SESSION_TTL_S, SESSION_MAX)
+_YELP_AI_CACHE = make_ttl_store("yelp_ai_replies", YELP_AI_CACHE_TTL_S, YELP_AI_CACHE_MAX)
+
+
+def _remember_session(
+    results: SearchResults,
+    session: Optional[SearchSession] = None,
+    guardrail: Optional[Tuple[str, str]] = None,
+    context: Tuple[str, str, str, str] = ("", "", "", ""),
+) -> None:
+    """Keep the Yelp AI conversation open under its (possibly new) chat_id."""
+    if not results.chat_id:
+        return
+    if session is None:
+        reason, category = guardrail or (None, None)
+        latitude, longitude, date, time_ = context
+        session = SearchSession(
+            chat_id=results.chat_id,
+            query=results.query,
+            guardrail_reason=reason,
+            guardrail_category=category,
+            latitude=latitude,
+            longitude=longitude,
+            date=date,
+            time=time_,
+        )
+    else:
+        session = replace(session, chat_id=results.chat_id)
+    _SESSION_STORE.put(results.chat_id, session)
+
+
+def _remember_results(results: SearchResults) -> SearchResults:
+    results.result_id = uuid.uuid4().hex
+    _RESULT_STORE.put(results.result_id, results)
+    for b in results.businesses:
+        if b.id:
+            _BUSINESS_STORE.put(b.id, b)
+    _catalog_upsert(results.businesses)
+    return results
+
+
+def _catalog_upsert(businesses: List[Business]) -> None:
+    catalog = get_catalog()
+    if catalog is None or not businesses:
+        return
+    records = []
+    for b in businesses:
+        record = _compact(b)
+        for k in _REQUEST_FIELDS:
+            record.pop(k, None)
+        records.append(record)
+    catalog.submit(catalog.upsert_summaries, records)
+
+
+def _parse_fields(fields_param: str) -> Optional[Tuple[str, ...]]:
+    names = tuple(n.strip() for n in (fields_param or "").split(",") if n.strip())
+    if not names:
+        return None
+    unknown = [n for n in names if n not in BUSINESS_FIELDS]
+    if unknown:
+        raise HTTPException(400, f"Unknown fields: {', '.join(unknown)}")
+    return ("id",) + tuple(n for n in names if n != "id")
+
+
+def _project(biz: Business, names: Tuple[str, ...]) -> Business:
+    return Business(**{n: getattr(biz, n) for n in names})
+
+
+def _encode_cursor(result_id: str, offset: int) -> str:
+    return f"{result_id}.{offset}"
+
+
+def _decode_cursor(cursor: str) -> Tuple[str, int]:
+    result_id, _, offset = cursor.partition(".")
+    if not result_id or not offset.isdigit():
+        raise HTTPException(400, "Malformed cursor")
+    return result_id, int(offset)
+
+
+def _page(
+    results: SearchResults,
+    fields_param: str,
+    limit: int,
+    offset: int = 0,
+) -> SearchResults:
+    """Slice the ranked list and apply the sparse fieldset; the stored copy is untouched."""
+    names = _parse_fields(fields_param)
+    total = len(results.businesses)
+
+    end = offset + limit if limit > 0 else total
+    page = results.businesses[offset:end]
+    if names:
+        page = [_project(b, names) for b in page]
+
+    return replace(
+        results,
+        businesses=page,
+        total=total,
+        next_cursor=_encode_cursor(results.result_id, end) if end < total else None,
+    )
+
+
+def _page_from_cursor(cursor: str, fields_param: str, limit: int) -> SearchResults:
+    result_id, offset = _decode_cursor(cursor)
+    results = _RESULT_STORE.get(result_id)
+    if results is None:
+        raise HTTPException(410, "Search results expired; run the search again")
+    return _page(results, fields_param, limit, offset)
+
+
+# ============================================================================
+# FASTAPI APP
+# ============================================================================
+def warmup_tasks():
+    return [
+        ("gemini_clients", lambda: gemini_scheduler().warm()),
+        ("yelp_connection", lambda: preopen_connection(YELP_AI_ENDPOINT)),
+        ("catalog", get_catalog),
+    ]
+
+
+# Admission-control class per route (see BackendRuntime.PRIORITY_CLASSES);
+# captions are cheaper to retry than an uploaded image, so they are shed first
+ROUTE_PRIORITIES = {
+    "/search-image": "interactive",
+    "/search-refine": "interactive",
+    "/search-caption": "caption",
+    "/search-nearby": "interactive",
+}
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    start_warmup(warmup_tasks())
+    yield
+
+
+app = FastAPI(
+    title="Yelp AI Backend",
+    version="1.5.0",
+    default_response_class=CompactJSONResponse,
+    lifespan=lifespan,
+)
+
+
+install_error_handlers(app, ROUTE_PRIORITIES)
+install_profiling(app)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# Pipeline routes live on a router so Gateway.py can mount them next to Pipeline 2
+router = APIRouter(default_response_class=CompactJSONResponse, route_class=ProfiledRoute)
+
+
+# ============================================================================
+# GUARDRAIL PROMPT
+# ============================================================================
+GUARDRAIL_SYS = """
+You are a safety + relevance gate for an app that ONLY helps users find places to GET, EAT, or USE
+food, drinks, groceries, desserts, and restaurant/hotel services.
+
+You will see:
+- An IMAGE
+- A short USER INTENT
+
+Output ONLY valid JSON:
+
+{
+  "allowed": true/false,
+  "reason": "<short safety/relevance explanation>",
+  "category": "<food_or_venue | face_only | adult_or_nudity | violence_or_gore |
+               drugs_or_weapons | hate_or_extremism | unrelated | uncertain>"
+}
+
+Rules:
+- If anything unsafe (nudity, violence, drugs, weapons, hate) is detected → allowed=false.
+- If user intent is unrelated to food/venues → allowed=false.
+- Otherwise → allowed=true.
+"""
+
+
+MULTI_IMAGE_SYS = """
+You will see several numbered food IMAGES (Image 1, Image 2, ...) and one USER INTENT.
+For EACH image, first apply the safety + relevance gate below, then, if it is allowed,
+name the dish it shows and write the Yelp search sentence described in the query rules.
+
+Gate rules:
+- If anything unsafe (nudity, violence, drugs, weapons, hate) is detected → allowed=false.
+- If the image or the user intent is unrelated to food/venues → allowed=false.
+- Otherwise → allowed=true.
+
+Output ONLY a valid JSON array with one object per image, in image order:
+
+[
+  {
+    "image": <image number>,
+    "allowed": true/false,
+    "reason": "<short safety/relevance explanation>",
+    "category": "<food_or_venue | face_only | adult_or_nudity | violence_or_gore |
+                 drugs_or_weapons | hate_or_extremism | unrelated | uncertain>",
+    "dish": "<short canonical dish name, e.g. 'tonkotsu ramen'; empty if not allowed>",
+    "query": "<the Yelp search sentence for this dish; empty if not allowed>"
+  }
+]
+
+Images showing the same dish must get the same "dish" and the same "query".
+"""
+
+
+# ============================================================================
+# JSON / TEXT HELPERS
+# ============================================================================
+def _safe_json_parse(text: str) -> Optional[Dict[str, Any]]:
+    if not text:
+        return None
+
+    cleaned = strip_code_fences(text)
+
+    try:
+        parsed = json.loads(cleaned)
+        if isinstance(parsed, dict):
+            return parsed
+    except Exception:
+        pass
+
+    sub = extract_json_substring(cleaned, "{", "}")
+    if sub:
+        try:
+            parsed = json.loads(sub)
+            if isinstance(parsed, dict):
+                return parsed
+        except Exception:
+            return None
+
+    return None
+
+
+def _safe_json_list_parse(text: str) -> List[Any]:
+    cleaned = strip_code_fences(text)
+    for candidate in (cleaned, extract_json_substring(cleaned, "[", "]")):
+        if not candidate:
+            continue
+        try:
+            parsed = json.loads(candidate)
+        except Exception:
+            continue
+        if isinstance(parsed, list):
+            return parsed
+    return []
+
+
+def _truncate_to_sentence(text: str, max_len: int = 1000) -> str:
+    text = (text or "").strip()
+    if len(text) <= max_len:
+        return text
+
+    truncated = text[:max_len]
+    p = max(
+        truncated.rfind("."),
+        truncated.rfind("!"),
+        truncated.rfind("?"),
+    )
+
+    return truncated[: p + 1] if p != -1 else truncated
+
+
+# ============================================================================
+# PROMPT BUILDERS
+# ============================================================================
+def _build_prompt(
+    location: str,
+    latitude: str,
+    longitude: str,
+    date: str,
+    time: str,
+) -> str:
+
+    latlon_block = ""
+    if latitude or longitude:
+        latlon_block = f"Latitude: {latitude or 'N/A'}\nLongitude: {longitude or 'N/A'}\n"
+
+    return (
+        "Write exactly ONE natural-language Yelp search sentence.\n"
+        f"Location: {location}\n"
+        f"{latlon_block}"
+        f"Date: {date}\n"
+        f"Time: {time}\n"
+        "Goal:\n"
+        "- Find places serving the food shown OR\n"
+        "- Find TRENDING / POPULAR nearby food or venues if asked.\n"
+        "Rules:\n"
+        "- Ask for MANY options sorted by popularity/reviews.\n"
+        "- Use clear first-person phrasing.\n"
+        "- Output a single sentence only.\n"
+        "- No meta or markdown.\n"
+        "- Under 900 characters.\n"
+    )
+
+
+# ============================================================================
+# GEMINI FUNCTIONS
+# ============================================================================
+def _generate(**kwargs):
+    """generate_content on the next Gemini key with quota left, within the request budget."""
+    return gemini_scheduler().call(
+        lambda c: c.models.generate_content(**dict(kwargs, config=gemini_config(kwargs.get("config"))))
+    )
+
+
+def _guardrail_check_image(
+    image_bytes: bytes,
+    mime_type: str,
+    user_intent: str,
+) -> Tuple[bool, str, str]:
+
+    from google.genai import types
+
+    try:
+        resp = _generate(
+            model=MODEL_FAST,
+            contents=[
+                GUARDRAIL_SYS,
+                types.Part.from_bytes(data=image_bytes, mime_type=mime_type),
+                f"User intent: {user_intent}",
+            ],
+            config={"response_mime_type": "application/json"},
+        )
+
+        raw = (getattr(resp, "text", "") or "").strip()
+        data = _safe_json_parse(raw) or {}
+
+    except PASSTHROUGH_ERRORS:
+        raise
+    except Exception:
+        return False, "Safety validation failed.", "uncertain"
+
+    allowed = bool(data.get("allowed", False))
+    reason = str(data.get("reason") or "").strip()
+    category = str(data.get("category") or "uncertain").strip()
+
+    if not reason:
+        return False, "Unable to verify image safety and relevance.", "uncertain"
+
+    return allowed, reason, category
+
+
+def _gemini_image_to_query(
+    image_bytes: bytes,
+    mime_type: str,
+    user_query: str,
+    location: str,
+    latitude: str,
+    longitude: str,
+    date: str,
+    time: str,
+) -> str:
+
+    from google.genai import types
+
+    instruction = _build_prompt(location, latitude, longitude, date, time)
+
+    resp = _generate(
+        model=MODEL_FAST,
+        contents=[
+            types.Part.from_bytes(data=image_bytes, mime_type=mime_type),
+            instruction,
+            f"User intent: {user_query}",
+        ],
+    )
+
+    return _truncate_to_sentence(getattr(resp, "text", "") or "")
+
+
+@single_flight(
+    "gemini_caption_to_query",
+    key=lambda user_query, location, latitude, longitude, date, time: tuple(
+        normalize_text(v) for v in (user_query, location, latitude, longitude, date, time)
+    ),
+)
+def _gemini_caption_to_query(
+    user_query: str,
+    location: str,
+    latitude: str,
+    longitude: str,
+    date: str,
+    time: str,
+) -> str:
+
+    instruction = _build_prompt(location, latitude, longitude, date, time)
+
+    resp = _generate(
+        model=MODEL_FAST,
+        contents=[
+            instruction,
+            f"User intent: {user_query}",
+        ],
+    )
+
+    return _truncate_to_sentence(getattr(resp, "text", "") or "")
+
+
+def _gemini_images_to_queries(
+    images: List[Tuple[bytes, str]],
+    user_query: str,
+    location: str,
+    latitude: str,
+    longitude: str,
+    date: str,
+    time: str,
+) -> List[Dict[str, Any]]:
+    """
+    Guardrail verdict, dish name and Yelp query for every image in one
+    multimodal call. Returns one dict per image, in upload order.
+    """
+    from google.genai import types
+
+    contents: List[Any] = [MULTI_IMAGE_SYS, _build_prompt(location, latitude, longitude, date, time)]
+    for i, (data, mime) in enumerate(images, 1):
+        contents.append(f"Image {i}:")
+        contents.append(types.Part.from_bytes(data=data, mime_type=mime))
+    contents.append(f"User intent: {user_query}")
+
+    try:
+        resp = _generate(
+            model=MODEL_FAST,
+            contents=contents,
+            config={"response_mime_type": "application/json"},
+        )
+        items = _safe_json_list_parse(getattr(resp, "text", "") or "")
+    except PASSTHROUGH_ERRORS:
+        raise
+    except Exception:
+        items = []
+
+    by_image: Dict[int, Dict[str, Any]] = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            by_image.setdefault(int(item.get("image")), item)
+        except (TypeError, ValueError):
+            continue
+
+    out = []
+    for i in range(1, len(images) + 1):
+        item = by_image.get(i) or {}
+        reason = str(item.get("reason") or "").strip()
+        query = _truncate_to_sentence(str(item.get("query") or ""))
+        out.append({
+            # same rule as the single-image guardrail: no reason, no pass
+            "allowed": bool(item.get("allowed", False)) and bool(reason) and bool(query),
+            "reason": reason or "Unable to verify image safety and relevance.",
+            "category": str(item.get("category") or "uncertain").strip(),
+            "dish": str(item.get("dish") or "").strip(),
+            "query": query,
+        })
+    return out
+
+
+def _caption_to_query(
+    user_query: str,
+    location: str,
+    latitude: str,
+    longitude: str,
+    date: str,
+    time: str,
+) -> str:
+    """Local template for simple, confident captions (QueryCompiler); Gemini otherwise."""
+    args = (user_query, location, latitude, longitude, date, time)
+    if CAPTION_COMPILER_MODE == "off":
+        return _gemini_caption_to_query(*args)
+
+    compiled = compile_caption(*args)
+    if choose_local(compiled):
+        return compiled.query
+
+    query = _gemini_caption_to_query(*args)
+    record_shadow(user_query, compiled, query)
+    return query
+
+
+# ============================================================================
+# YELP CALL
+# ============================================================================
+@single_flight(
+    "yelp_ai",
+    key=lambda yelp_query, chat_id=None: (normalize_text(yelp_query), chat_id or ""),
+)
+def _call_yelp_ai(yelp_query: str, chat_id: Optional[str] = None) -> Dict[str, Any]:
+
+    # follow-ups continue a Yelp chat and are never served from the cache
+    cache_key = None if chat_id else digest(normalize_text(yelp_query))
+    if cache_key and yelp_quota_level("yelp_ai") != "ok":
+        cached = _YELP_AI_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+
+    headers = {
+        "Authorization": f"Bearer {require(YELP_API_KEY, 'Missing YELP_API_KEY in environment')}",
+        "Accept": "application/json",
+        "Content-Type": "application/json",
+    }
+
+    payload = {"query": yelp_query}
+    if chat_id:
+        payload["chat_id"] = chat_id
+
+    r = upstream_request(
+        "yelp_ai",
+        "POST",
+        YELP_AI_ENDPOINT,
+        headers=headers,
+        json=payload,
+        timeout=45,
+    )
+
+    if r.status_code != 200:
+        raise HTTPException(status_code=r.status_code, detail=r.text)
+
+    data = r.json()
+    if cache_key:
+        _YELP_AI_CACHE.put(cache_key, data)
+    return data
+
+
+def _dish_key(dish: str, query: str) -> str:
+    """Merge key for multi-image dishes: 'Tacos' and 'taco' are the same dish."""
+    words = normalize_text(dish).split()
+    if not words:
+        return normalize_text(query)
+    return " ".join(w[:-1] if len(w) > 3 and w.endswith("s") else w for w in words)
+
+
+# ============================================================================
+# OPENING HOURS
+# ============================================================================
+_DAY_NAMES = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+_MINUTES_PER_DAY = 24 * 60
+_MINUTES_PER_WEEK = 7 * _MINUTES_PER_DAY
+
+
+def _day_index(day: Any) -> Optional[int]:
+    if isinstance(day, int):
+        return day if 0 <= day <= 6 else None
+    name = str(day or "").strip().lower()
+    for i, d in enumerate(_DAY_NAMES):
+        if name[:3] == d[:3]:
+            return i
+    return None
+
+
+def _hhmm_to_minute(text: Any) -> Optional[int]:
+    text = str(text or "").strip().replace(":", "")
+    if len(text) != 4 or not text.isdigit():
+        return None
+    minute = int(text[:2]) * 60 + int(text[2:])
+    return minute if minute <= _MINUTES_PER_DAY else None
+
+
+class WeeklyHours:
+    """
+    Sorted, merged [start, end) intervals in minutes since Monday 00:00.
+    Overnight spans roll into the next day and Sunday night wraps to Monday,
+    so open-at and next-opening lookups are a single bisect.
+    """
+
+    __slots__ = ("starts", "ends")
+
+    def __init__(self, spans: List[Tuple[int, int, int]]):
+        intervals: List[Tuple[int, int]] = []
+        for day, start, end in spans:
+            a = day * _MINUTES_PER_DAY + start
+            b = day * _MINUTES_PER_DAY + end
+            if end <= start:
+                b += _MINUTES_PER_DAY
+            if b > _MINUTES_PER_WEEK:
+                intervals.append((a, _MINUTES_PER_WEEK))
+                intervals.append((0, b - _MINUTES_PER_WEEK))
+            else:
+                intervals.append((a, b))
+
+        intervals.sort()
+        merged: List[List[int]] = []
+        for a, b in intervals:
+            if merged and a <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], b)
+            else:
+                merged.append([a, b])
+
+        self.starts = tuple(a for a, _ in merged)
+        self.ends = tuple(b for _, b in merged)
+
+    def __bool__(self) -> bool:
+        return bool(self.starts)
+
+    def is_open(self, weekday: int, minute: int) -> bool:
+        t = weekday * _MINUTES_PER_DAY + minute
+        i = bisect.bisect_right(self.starts, t) - 1
+        return i >= 0 and t < self.ends[i]
+
+    def next_opening(self, weekday: int, minute: int) -> Optional[Tuple[int, int]]:
+        """(weekday, minute) of the next opening at or after the given time."""
+        if not self.starts:
+            return None
+        t = weekday * _MINUTES_PER_DAY + minute
+        i = bisect.bisect_right(self.starts, t) - 1
+        if i >= 0 and t < self.ends[i]:
+            return weekday, minute
+        nxt = self.starts[(i + 1) % len(self.starts)]
+        return divmod(nxt, _MINUTES_PER_DAY)
+
+
+_HOURS_INDEX = TTLStore(HOURS_INDEX_TTL_S, HOURS_INDEX_MAX)
+
+
+def _compile_hours(raw_hours: List[Dict[str, Any]]) -> Optional[WeeklyHours]:
+    spans = []
+    for h in raw_hours:
+        day = _day_index(h.get("day_of_week"))
+        if day is None:
+            continue
+        for s in h.get("business_hours") or []:
+            start = _hhmm_to_minute(s.get("open_time"))
+            end = _hhmm_to_minute(s.get("close_time"))
+            if start is not None and end is not None:
+                spans.append((day, start, end))
+    return WeeklyHours(spans) if spans else None
+
+
+def _hours_index_for(business_id: Optional[str], raw_hours: List[Dict[str, Any]]) -> Optional[WeeklyHours]:
+    if not raw_hours:
+        return None
+    if business_id:
+        cached = _HOURS_INDEX.get(business_id)
+        if cached is not None:
+            return cached
+    index = _compile_hours(raw_hours)
+    if business_id and index is not None:
+        _HOURS_INDEX.put(business_id, index)
+    return index
+
+
+def _format_week_minute(weekday: int, minute: int) -> str:
+    return f"{_DAY_NAMES[weekday].title()} {minute // 60:02d}:{minute % 60:02d}"
+
+
+# ============================================================================
+# RESULT EXTRACTION
+# ============================================================================
+def _join_address(loc: Dict[str, Any]) -> Optional[str]:
+    return loc.get("formatted_address") or ", ".join(
+        p
+        for p in [
+            loc.get("address1"),
+            loc.get("city"),
+            loc.get("state"),
+            loc.get("zip_code"),
+            loc.get("country"),
+        ]
+        if p
+    ) or None
+
+
+def _extract_business(biz: Dict[str, Any]) -> Business:
+
+    loc = biz.get("location") or {}
+    coords = biz.get("coordinates") or {}
+    summaries = biz.get("summaries") or {}
+    contextual = biz.get("contextual_info") or {}
+
+    photos = contextual.get("photos") or []
+    hours = contextual.get("business_hours") or []
+    openings = (biz.get("reservation_availability") or {}).get("openings") or []
+
+    photo_url = (
+        photos[0].get("original_url")
+        if photos and isinstance(photos[0], dict)
+        else None
+    )
+
+    hours_list = [
+        DayHours(
+            day_of_week=h.get("day_of_week"),
+            hours=[
+                f"{s['open_time']} to {s['close_time']}"
+                for s in h.get("business_hours", [])
+                if s.get("open_time") and s.get("close_time")
+            ],
+        )
+        for h in hours
+    ]
+
+    opening_list = [
+        OpeningDay(
+            date=d.get("date"),
+            slots=[
+                OpeningSlot(
+                    time=s.get("time"),
+                    seating_areas=s.get("seating_areas") or [],
+                )
+                for s in d.get("slots", [])
+            ],
+        )
+        for d in openings
+    ]
+
+    rating = biz.get("rating")
+    review_count = biz.get("review_count")
+    categories = [
+        c.get("title") or c.get("alias")
+        for c in biz.get("categories") or []
+        if isinstance(c, dict) and (c.get("title") or c.get("alias"))
+    ]
+
+    return Business(
+        id=biz.get("id"),
+        name=biz.get("name"),
+        address=_join_address(loc),
+        yelp_url=biz.get("url"),
+        rating=rating if isinstance(rating, (int, float)) else None,
+        review_count=review_count if isinstance(review_count, int) else None,
+        price=biz.get("price"),
+        latitude=coords.get("latitude"),
+        longitude=coords.get("longitude"),
+        short_summary=summaries.get("short") or contextual.get("summary"),
+        photo_url=photo_url,
+        business_hours=hours_list,
+        reservation_openings=opening_list,
+        phone=biz.get("phone"),
+        categories=categories,
+        hours_index=_hours_index_for(biz.get("id"), hours),
+    )
+
+
+def _extract_results(data: Dict[str, Any], yelp_query: str) -> SearchResults:
+
+    ai_text = (data.get("response") or {}).get("text", "") or ""
+
+    businesses = [
+        _extract_business(biz)
+        for entity in data.get("entities") or []
+        for biz in entity.get("businesses") or []
+    ]
+
+    return SearchResults(
+        chat_id=data.get("chat_id"),
+        query=yelp_query,
+        ai_response_text=ai_text,
+        businesses=businesses,
+    )
+
+
+# ============================================================================
+# RANKING
+# ============================================================================
+_TIME_RE = re.compile(r"^\s*(\d{1,2})(?::?(\d{2}))?\s*([ap]\.?m\.?)?\s*$", re.IGNORECASE)
+_DATE_FORMATS = ("%m/%d/%Y", "%Y-%m-%d", "%m/%d/%y", "%m-%d-%Y")
+_EARTH_RADIUS_M = 6371008.8
+
+
+def _parse_float(value: Any) -> Optional[float]:
+    try:
+        f = float(value)
+    except (TypeError, ValueError):
+        return None
+    return f if math.isfinite(f) else None
+
+
+def _parse_minute_of_day(text: str) -> Optional[int]:
+    """'8pm', '8:30 PM', '20:00' or '2000' → minutes after midnight."""
+    m = _TIME_RE.match(text or "")
+    if not m:
+        return None
+    hh, mm, ampm = m.group(1), m.group(2), m.group(3)
+    if mm is None and ampm is None and len(hh) > 2:
+        return None
+    h, mi = int(hh), int(mm or 0)
+    if ampm:
+        if not 1 <= h <= 12:
+            return None
+        h = h % 12 + (12 if ampm.lower().startswith("p") else 0)
+    if h > 23 or mi > 59:
+        return None
+    return h * 60 + mi
+
+
+def _parse_when(date: str, time_: str) -> Optional[Tuple[int, int]]:
+    """(weekday with Monday=0, minute of day) for the user's requested Date/Time."""
+    minute = _parse_minute_of_day(time_)
+    if minute is None:
+        return None
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime((date or "").strip(), fmt).weekday(), minute
+        except ValueError:
+            continue
+    return None
+
+
+def _rank_businesses(
+    businesses: List[Business],
+    latitude: str = "",
+    longitude: str = "",
+    date: str = "",
+    time_: str = "",
+    top_k: int = RANK_TOP_K,
+) -> List[Business]:
+    """
+    Score every candidate column-wise, then pick the top-k with a partial sort.
+    Fills `distance_m` / `open_at_request` on the returned businesses.
+    """
+    n = len(businesses)
+    if n == 0:
+        return []
+
+    # Bayesian-smoothed rating, normalized to 0..1
+    c, m = RANK_PRIOR_RATING, RANK_PRIOR_REVIEWS
+    ratings = [b.rating if b.rating is not None else c for b in businesses]
+    counts = [b.review_count or 0 for b in businesses]
+    rating_score = [
+        ((v * r + m * c) / (v + m) - 1.0) / 4.0 if v + m > 0 else (r - 1.0) / 4.0
+        for r, v in zip(ratings, counts)
+    ]
+
+    # Haversine distance to the user; unknown positions score neutral
+    user_lat, user_lon = _parse_float(latitude), _parse_float(longitude)
+    distances: List[Optional[float]] = [None] * n
+    distance_score = [0.5] * n
+    if user_lat is not None and user_lon is not None:
+        lat0, lon0 = math.radians(user_lat), math.radians(user_lon)
+        cos_lat0 = math.cos(lat0)
+        for i, b in enumerate(businesses):
+            lat, lon = _parse_float(b.latitude), _parse_float(b.longitude)
+            if lat is None or lon is None:
+                continue
+            lat1, lon1 = math.radians(lat), math.radians(lon)
+            a = (
+                math.sin((lat1 - lat0) / 2.0) ** 2
+                + cos_lat0 * math.cos(lat1) * math.sin((lon1 - lon0) / 2.0) ** 2
+            )
+            d = 2.0 * _EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+            distances[i] = d
+            distance_score[i] = math.exp(-d / RANK_DISTANCE_SCALE_M)
+
+    # Open at the requested Date/Time; unknown hours score neutral
+    when = _parse_when(date, time_)
+    open_flags: List[Optional[bool]] = [None] * n
+    open_score = [0.5] * n
+    if when is not None:
+        weekday, minute = when
+        for i, b in enumerate(businesses):
+            if b.hours_index:
+                flag = b.hours_index.is_open(weekday, minute)
+                open_flags[i] = flag
+                open_score[i] = 1.0 if flag else 0.0
+
+    scores = [
+        RANK_W_RATING * rs + RANK_W_DISTANCE * ds + RANK_W_OPEN * os_
+        for rs, ds, os_ in zip(rating_score, distance_score, open_score)
+    ]
+
+    k = n if top_k <= 0 else min(top_k, n)
+    order = heapq.nlargest(k, range(n), key=scores.__getitem__)
+
+    ranked = []
+    for i in order:
+        b = businesses[i]
+        b.distance_m = round(distances[i], 1) if distances[i] is not None else None
+        b.open_at_request = open_flags[i]
+        if open_flags[i] is False:
+            nxt = b.hours_index.next_opening(*when)
+            b.next_open = _format_week_minute(*nxt) if nxt else None
+        ranked.append(b)
+    return ranked
+
+
+def _rank_results(
+    results: SearchResults,
+    latitude: str,
+    longitude: str,
+    date: str,
+    time_: str,
+) -> SearchResults:
+    results.businesses = _rank_businesses(results.businesses, latitude, longitude, date, time_)
+    return results
+
+
+# ============================================================================
+# ROUTES
+# ============================================================================
+@app.get("/")
+def root():
+    return {"status": "running", "docs": "/docs", "health": "/health"}
+
+
+@app.get("/health")
+def health():
+    return health_report()
+
+
+@app.get("/metrics")
+def metrics():
+    return runtime_metrics()
+
+
+@router.get("/business/{business_id}")
+def business_details(business_id: str, fields: str = ""):
+    """Full (or field-selected) business from a recent search, e.g. hours/openings."""
+    biz = _BUSINESS_STORE.get(business_id)
+    if biz is None:
+        raise HTTPException(404, "Business not found in recent results")
+
+    names = _parse_fields(fields)
+    return CompactJSONResponse(_project(biz, names) if names else biz)
+
+
+@router.get("/search-nearby")
+def search_nearby(
+    Latitude: float,
+    Longitude: float,
+    category: str = "",
+    radius_m: float = 2000,
+    limit: int = 20,
+    fields: str = "",
+):
+    """
+    Provisional results from the local catalog (no upstream calls), so the app
+    can show nearby places while a Yelp AI search is still in flight.
+    """
+    catalog = get_catalog()
+    if catalog is None:
+        return CompactJSONResponse({"provisional": True, "total": 0, "businesses": []})
+
+    hits = catalog.near(
+        Latitude,
+        Longitude,
+        radius_m=max(50.0, min(radius_m, 50000.0)),
+        category=category or None,
+        limit=max(1, min(limit, 100)),
+        max_age_s=CATALOG_NEARBY_MAX_AGE_S,
+    )
+
+    names = _parse_fields(fields)
+    if names:
+        keep = set(names) | {"distance_m"}
+        hits = [{k: v for k, v in h.items() if k in keep} for h in hits]
+
+    return CompactJSONResponse({"provisional": True, "total": len(hits), "businesses": hits})
+
+
+@router.post("/search-image")
+async def search_image(
+    image: Optional[UploadFile] = File(None),
+    images: Optional[List[UploadFile]] = File(None),
+    user_query: str = Form(...),
+    Location: str = Form(""),
+    Latitude: str = Form(""),
+    Longitude: str = Form(""),
+    Date: str = Form("12/11/2025"),
+    Time: str = Form("8pm"),
+    fields: str = Form(""),
+    limit: int = Form(0, ge=0),
+    cursor: str = Form(""),
+):
+
+    if cursor:
+        return CompactJSONResponse(_page_from_cursor(cursor, fields, limit))
+
+    uploads = ([image] if image is not None else []) + list(images or [])
+    if not uploads:
+        raise HTTPException(422, "image is required unless a cursor is given")
+    if len(uploads) > MULTI_IMAGE_MAX:
+        raise HTTPException(422, f"At most {MULTI_IMAGE_MAX} images per search")
+    if len(uploads) > 1:
+        return await _search_images(
+            uploads, user_query, Location, Latitude, Longitude, Date, Time, fields, limit
+        )
+
+    img = await uploads[0].read()
+
+    # local checks first: invalid, denylisted or off-topic uploads never reach Gemini
+    pre = await run_in_threadpool(check_image, img, uploads[0].content_type, user_query)
+    if not pre.allowed:
+        return JSONResponse(
+            status_code=422,
+            content={
+                "status": 422,
+                "message": pre.reason,
+                "category": pre.category,
+            },
+        )
+    mime = pre.mime
+
+    allowed, reason, cat = await run_in_threadpool(_guardrail_check_image, img, mime, user_query)
+    if not allowed:
+        remember_rejected_image(pre.image_hash, reason, cat)
+        return JSONResponse(
+            status_code=422,
+            content={
+                "status": 422,
+                "message": reason,
+                "category": cat,
+            },
+        )
+
+    yelp_query = await run_in_threadpool(
+        _gemini_image_to_query,
+        img,
+        mime,
+        user_query,
+        Location,
+        Latitude,
+        Longitude,
+        Date,
+        Time,
+    )
+
+    data = await run_in_threadpool(_call_yelp_ai, yelp_query)
+    results = _rank_results(
+        _extract_results(data, yelp_query), Latitude, Longitude, Date, Time
+    )
+    results = _remember_results(results)
+    _remember_session(
+        results,
+        guardrail=(reason, cat),
+        context=(Latitude, Longitude, Date, Time),
+    )
+
+    return CompactJSONResponse(_page(results, fields, limit))
+
+
+async def _search_images(
+    uploads: List[UploadFile],
+    user_query: str,
+    location: str,
+    latitude: str,
+    longitude: str,
+    date: str,
+    time_: str,
+    fields: str,
+    limit: int,
+):
+    """
+    Several images in one search: one multimodal Gemini call guards and
+    describes them all, identical dishes share one Yelp call, and the merged
+    business list is deduplicated by id before ranking.
+    """
+    dishes: List[DishMatch] = []
+    accepted: List[Tuple[int, bytes, str, Optional[str]]] = []
+    for pos, upload in enumerate(uploads, 1):
+        data = await upload.read()
+        pre = await run_in_threadpool(check_image, data, upload.content_type, user_query)
+        if pre.allowed:
+            accepted.append((pos, data, pre.mime, pre.image_hash))
+        else:
+            dishes.append(DishMatch(images=[pos], message=pre.reason, category=pre.category))
+
+    verdicts: List[Dict[str, Any]] = []
+    if accepted:
+        verdicts = await run_in_threadpool(
+            _gemini_images_to_queries,
+            [(data, mime) for _pos, data, mime, _h in accepted],
+            user_query, location, latitude, longitude, date, time_,
+        )
+
+    groups: Dict[str, DishMatch] = {}
+    guardrail: Optional[Tuple[str, str]] = None
+    for (pos, _data, _mime, image_hash), v in zip(accepted, verdicts):
+        if not v["allowed"]:
+            remember_rejected_image(image_hash, v["reason"], v["category"])
+            dishes.append(DishMatch(images=[pos], message=v["reason"], category=v["category"]))
+            continue
+        guardrail = guardrail or (v["reason"], v["category"])
+        key = _dish_key(v["dish"], v["query"])
+        match = groups.get(key)
+        if match is None:
+            groups[key] = DishMatch(images=[pos], dish=v["dish"], query=v["query"], category=v["category"])
+        else:
+            match.images.append(pos)
+
+    if not groups:
+        first = min(dishes, key=lambda d: d.images[0])
+        return JSONResponse(
+            status_code=422,
+            content={"status": 422, "message": first.message, "category": first.category},
+        )
+
+    matches = list(groups.values())
+    payloads = await asyncio.gather(
+        *(run_in_threadpool(_call_yelp_ai, m.query) for m in matches),
+        return_exceptions=True,
+    )
+    if all(isinstance(p, BaseException) for p in payloads):
+        raise payloads[0]
+
+    combined = SearchResults(query=" | ".join(m.query for m in matches))
+    texts: List[str] = []
+    seen: set = set()
+    for match, data in zip(matches, payloads):
+        if isinstance(data, BaseException):
+            match.message, match.category = "Yelp search failed for this dish.", "upstream_error"
+            continue
+        part = _extract_results(data, match.query)
+        combined.chat_id = combined.chat_id or part.chat_id
+        if part.ai_response_text:
+            texts.append(part.ai_response_text)
+        for b in part.businesses:
+            if b.id:
+                match.business_ids.append(b.id)
+                if b.id in seen:
+                    continue
+                seen.add(b.id)
+            combined.businesses.append(b)
+
+    combined.ai_response_text = "\n\n".join(texts)
+    combined.dishes = sorted(dishes + matches, key=lambda d: d.images[0])
+
+    results = _rank_results(combined, latitude, longitude, date, time_)
+    results = _remember_results(results)
+    # refinements continue the first dish's Yelp AI conversation
+    _remember_session(results, guardrail=guardrail, context=(latitude, longitude, date, time_))
+
+    return CompactJSONResponse(_page(results, fields, limit))
+
+
+@router.post("/search-caption")
+async def search_caption(
+    user_query: str = Form(...),
+
+    Location: str = Form(""),
+    Latitude: str = Form(""),
+    Longitude: str = Form(""),
+
+    Date: str = Form("12/11/2025"),
+    Time: str = Form("8pm"),
+
+    fields: str = Form(""),
+    limit: int = Form(0, ge=0),
+    cursor: str = Form(""),
+):
+
+    if cursor:
+        return CompactJSONResponse(_page_from_cursor(cursor, fields, limit))
+
+    pre = check_caption(user_query)
+    if not pre.allowed:
+        return JSONResponse(
+            status_code=422,
+            content={
+                "status": 422,
+                "message": pre.reason,
+                "category": pre.category,
+            },
+        )
+
+    yelp_query = await run_in_threadpool(
+        _caption_to_query,
+        user_query,
+        Location,
+        Latitude,
+        Longitude,
+        Date,
+        Time,
+    )
+
+    data = await run_in_threadpool(_call_yelp_ai, yelp_query)
+    results = _rank_results(
+        _extract_results(data, yelp_query), Latitude, Longitude, Date, Time
+    )
+    results = _remember_results(results)
+    _remember_session(results, context=(Latitude, Longitude, Date, Time))
+
+    return CompactJSONResponse(_page(results, fields, limit))
+
+
+@router.post("/search-refine")
+async def search_refine(
+    chat_id: str = Form(...),
+    refinement: str = Form(...),
+
+    fields: str = Form(""),
+    limit: int = Form(0, ge=0),
+):
+    """
+    Continue an earlier search's Yelp AI conversation ("cheaper", "open later").
+    Reuses the original guardrail verdict and costs one Yelp call, no Gemini.
+    """
+    session = _SESSION_STORE.get(chat_id)
+    if session is None:
+        raise HTTPException(404, "Search session expired; run the search again")
+
+    refinement = _truncate_to_sentence(refinement, max_len=900)
+    if not refinement:
+        raise HTTPException(422, "refinement must not be empty")
+
+    data = await run_in_threadpool(_call_yelp_ai, refinement, session.chat_id)
+    results = _rank_results(
+        _extract_results(data, refinement),
+        session.latitude,
+        session.longitude,
+        session.date,
+        session.time,
+    )
+    if not results.chat_id:
+        results.chat_id = session.chat_id
+    results = _remember_results(results)
+    _remember_session(
+        results,
+        session=replace(session, refinements=session.refinements + [refinement]),
+    )
+
+    return CompactJSONResponse(_page(results, fields, limit))
+
+
+app.include_router(router)
+
+
+# ============================================================================
+# LOCAL RUN
+# ============================================================================
+if __name__ == "__main__":
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8000")),
+        log_level="info",
+    )
@@ -1,509 +1,823 @@
-# Pipeline2Backend.py
-# Parallel P/N + stronger judge prompt + global thread pool.
-# ✅ Fully working version optimized for speed & throughput with gemini-2.5-flash-lite
-
-import os
-import re
-import json
-import requests
-import threading
-from urllib.parse import urlparse
-from typing import Optional, Union, Any, Dict, List, Tuple
-from itertools import cycle
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-from fastapi import FastAPI, HTTPException, Body
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, ValidationError
-
-from google import genai
-from dotenv import load_dotenv
-
-
-# ---------------------------
-# ENV + CLIENTS
-# ---------------------------
-load_dotenv()
-
-# Allow multiple Gemini keys (comma-separated)
-GEMINI_API_KEYS_RAW = (
-    os.environ.get("GEMINI_API_KEYS")
-    or os.environ.get("GOOGLE_API_KEYS")
-    or os.environ.get("GOOGLE_API_KEY")
-    or os.environ.get("GEMINI_API_KEY")
-)
-
-YELP_API_KEY = os.environ.get("YELP_API_KEY")
-YELP_AI_ENDPOINT = os.environ.get(
-    "YELP_AI_ENDPOINT",
-    "https://api.yelp.com/ai/chat/v2",
-)
-
-if not GEMINI_API_KEYS_RAW:
-    raise RuntimeError("Missing GOOGLE_API_KEY / GEMINI_API_KEY (or GEMINI_API_KEYS)")
-if not YELP_API_KEY:
-    raise RuntimeError("Missing YELP_API_KEY")
-
-# ✅ Correct model from your quota: fastest non-streaming tier
-MODEL_FAST = "gemini-2.5-flash-lite"
-
-# Parse keys
-GEMINI_KEYS = [k.strip() for k in GEMINI_API_KEYS_RAW.split(",") if k.strip()]
-if not GEMINI_KEYS:
-    raise RuntimeError("No valid Gemini keys after parsing")
-
-# Instantiate clients
-_GEMINI_CLIENTS = [genai.Client(api_key=k) for k in GEMINI_KEYS]
-_client_cycle = cycle(_GEMINI_CLIENTS)
-_client_lock = threading.Lock()
-
-def _next_llm_client() -> genai.Client:
-    with _client_lock:
-        return next(_client_cycle)
-
-# Global thread pool to reuse across requests
-AGENT_POOL = ThreadPoolExecutor(max_workers=4)
-
-YELP_BUSINESS_ENDPOINT = "https://api.yelp.com/v3/businesses/{business_id_or_alias}"
-YELP_REVIEWS_ENDPOINT  = "https://api.yelp.com/v3/businesses/{business_id_or_alias}/reviews"
-
-
-# ---------------------------
-# FASTAPI APP
-# ---------------------------
-app = FastAPI(title="Yelp Pipeline 2 Backend", version="1.5.1")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-
-# ---------------------------
-# PROMPTS
-# ---------------------------
-OPTIMIST_SYS = """
-You are the Optimistic Agent. You receive context about a restaurant or hotel and several review snippets.
-Focus on strengths, recurring positives, and reasons a typical guest might enjoy the place.
-Highlight food quality, friendly/efficient service, value, vibe, convenience, and reliability.
-Do not mention reviews or that you are an agent.
-
-Output ONLY a valid JSON array of short points (strings), 3–6 items.
-Example: ["Great pasta", "Warm service", "Cozy ambience"]
-""".strip()
-
-CRITIC_SYS = """
-You are the Critical Agent. You receive context about a restaurant or hotel and several review snippets.
-Focus on weaknesses, recurring complaints, risks, and situations where a guest could be disappointed.
-Highlight inconsistent food, slow/rude service, cleanliness problems, cramped/noisy space, and poor value.
-Do not mention reviews or that you are an agent.
-
-Output ONLY a valid JSON array of short points (strings), 3–6 items.
-Example: ["Long waits", "Inconsistent dishes", "Noisy dining room"]
-""".strip()
-
-JUDGE_SYS = """
-You are the Judge Agent. You receive the business context plus an Optimistic analysis and a Critical analysis.
-
-Do NOT split the difference. Decide a lean:
-- If positives outweigh negatives → lean positive.
-- If negatives outweigh positives → lean negative.
-- Say "mixed" only if truly balanced.
-
-Output ONLY a valid JSON array of short points (strings), 2–4 items:
-1) Net verdict with lean.
-2) Who it suits / best use-case.
-3) Key caution or tip (optional).
-
-Constraints:
-- Base only on provided material.
-- No invented statistics or prices.
-- Do not mention Yelp, reviews, or agents.
-""".strip()
-
-
-# ---------------------------
-# REQUEST SCHEMA
-# ---------------------------
-class AnalyzeRequest(BaseModel):
-    business_url: str = Field(..., description="Full Yelp business URL")
-    reviews_limit: int = Field(6, ge=1, le=20)
-    ai_fallback: bool = True
-    locale: Optional[str] = None
-
-    model_config = {"extra": "ignore"}
-
-
-# ---------------------------
-# HELPERS
-# ---------------------------
-def _yelp_headers():
-    return {
-        "Authorization": f"Bearer {YELP_API_KEY}",
-        "accept": "application/json",
-    }
-
-
-def run_agent(system_prompt: str, content: str) -> str:
-    """
-    Parallel-safe Gemini call using fastest available vision/text tier.
-    Uses round-robin API key selection.
-    """
-    llm_client = _next_llm_client()
-
-    resp = llm_client.models.generate_content(
-        model=MODEL_FAST,
-        contents=[system_prompt, content],
-        config={"response_mime_type": "application/json"},
-    )
-
-    return (getattr(resp, "text", "") or "").strip()
-
-
-_CODE_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE | re.MULTILINE)
-
-
-def _strip_code_fences(text: str) -> str:
-    return _CODE_FENCE_RE.sub("", text.strip())
-
-
-def _extract_json_array_substring(text: str) -> Optional[str]:
-    s = text.find("[")
-    e = text.rfind("]")
-    if s != -1 and e != -1 and e > s:
-        return text[s:e + 1]
-    return None
-
-
-def _sanitize_points(points: List[str], max_items: int) -> List[str]:
-    out: List[str] = []
-    for p in points:
-        if not p:
-            continue
-        s = str(p).strip()
-        s = s.strip(",")
-        if (s.startswith('"') and s.endswith('"')) or (s.startswith("'") and s.endswith("'")):
-            s = s[1:-1].strip()
-        if s:
-            out.append(s)
-    return out[:max_items]
-
-
-def safe_points_parse(text: str, min_items: int = 2, max_items: int = 8) -> List[str]:
-    if not text:
-        return []
-
-    cleaned = _strip_code_fences(text)
-
-    # Try strict JSON
-    try:
-        arr = json.loads(cleaned)
-        if isinstance(arr, list):
-            pts = _sanitize_points(arr, max_items)
-            if pts:
-                return pts
-    except Exception:
-        pass
-
-    # Extract embedded JSON array
-    sub = _extract_json_array_substring(cleaned)
-    if sub:
-        try:
-            arr = json.loads(sub)
-            if isinstance(arr, list):
-                pts = _sanitize_points(arr, max_items)
-                if pts:
-                    return pts
-        except Exception:
-            pass
-
-    # Fallback: line split
-    lines = re.split(r"(?:\r?\n)+", cleaned)
-    pts: List[str] = []
-    for ln in lines:
-        ln = re.sub(r"^[-•\d\)\.]+\s*", "", ln.strip())
-        if ln:
-            pts.append(ln)
-
-    if not pts and ";" in cleaned:
-        pts = [p.strip() for p in cleaned.split(";") if p.strip()]
-
-    pts = _sanitize_points(pts, max_items)
-    return pts if len(pts) >= min_items else pts
-
-
-def extract_business_id_or_alias_from_url(business_url: str) -> str:
-    parsed = urlparse(business_url.strip())
-    parts = [p for p in parsed.path.split("/") if p]
-    if len(parts) >= 2 and parts[0] == "biz":
-        return parts[1]
-    if re.match(r"^[A-Za-z0-9\-_]+$", business_url.strip()):
-        return business_url.strip()
-    raise ValueError("Unable to extract business alias/id from URL")
-
-
-def get_business_details(business_id_or_alias: str, locale: Optional[str]) -> dict:
-    r = requests.get(
-        YELP_BUSINESS_ENDPOINT.format(business_id_or_alias=business_id_or_alias),
-        headers=_yelp_headers(),
-        params={"locale": locale} if locale else None,
-        timeout=30,
-    )
-    r.raise_for_status()
-    return r.json()
-
-
-def get_business_reviews_from_fusion(
-    business_id_or_alias: str,
-    limit: int,
-    locale: Optional[str],
-) -> list:
-
-    r = requests.get(
-        YELP_REVIEWS_ENDPOINT.format(business_id_or_alias=business_id_or_alias),
-        headers=_yelp_headers(),
-        params={"limit": limit, "sort_by": "yelp_sort", "locale": locale} if locale else {"limit": limit},
-        timeout=30,
-    )
-
-    if r.status_code != 200:
-        return []
-
-    return (r.json() or {}).get("reviews", [])
-
-
-def get_review_snippets_from_yelp_ai(business_name: str, city: str, state: str) -> str:
-
-    location_str = ", ".join(p for p in [city, state] if p)
-    payload = {
-        "query": f"For {business_name} in {location_str}, summarize typical guest experiences "
-                 f"as 3 short positives and 3 short negatives."
-    }
-
-    r = requests.post(
-        YELP_AI_ENDPOINT,
-        headers={
-            "Authorization": f"Bearer {YELP_API_KEY}",
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        },
-        json=payload,
-        timeout=40,
-    )
-
-    if r.status_code != 200:
-        raise HTTPException(502, f"Yelp AI fallback failed: {r.text[:300]}")
-
-    return ((r.json() or {}).get("response") or {}).get("text", "") or ""
-
-
-def normalize_business_payload(business: dict) -> dict:
-
-    loc = business.get("location") or {}
-    cats = [c.get("title") for c in (business.get("categories") or []) if c.get("title")]
-
-    address = loc.get("formatted_address") or ", ".join(
-        p for p in [
-            loc.get("address1"),
-            loc.get("address2"),
-            loc.get("address3"),
-            loc.get("city"),
-            loc.get("state"),
-            loc.get("zip_code"),
-            loc.get("country"),
-        ] if p
-    )
-
-    return {
-        "name": business.get("name", "N/A"),
-        "rating": business.get("rating", "N/A"),
-        "price": business.get("price", "N/A"),
-        "categories": cats,
-        "address": address or "N/A",
-        "url": business.get("url", "N/A"),
-        "review_count": business.get("review_count", "N/A"),
-    }
-
-
-def build_context_from_reviews(business: dict, reviews: list) -> str:
-    b = normalize_business_payload(business)
-    out = f"""
-Business:
-Name: {b['name']}
-Rating: {b['rating']}
-Price: {b['price']}
-Categories: {", ".join(b['categories'])}
-Address: {b['address']}
-
-Representative review snippets:
-""".strip()
-
-    for r in reviews[:10]:
-        txt = (r.get("text") or "").replace("\n", " ").strip()
-        if txt:
-            out += f"\n- {r.get('rating')}★: {txt}"
-
-    return out
-
-
-def build_context_from_ai_summary(business: dict, summary: str) -> str:
-    b = normalize_business_payload(business)
-    return f"""
-Business:
-Name: {b['name']}
-Rating: {b['rating']}
-Price: {b['price']}
-Categories: {", ".join(b['categories'])}
-Address: {b['address']}
-
-AI summary of typical positives/negatives:
-{summary.strip()}
-""".strip()
-
-
-def run_multi_agent_debate(context: str) -> Tuple[List[str], List[str], List[str]]:
-
-    # Run P + N in parallel
-    futures = {
-        AGENT_POOL.submit(run_agent, OPTIMIST_SYS, context): "P",
-        AGENT_POOL.submit(run_agent, CRITIC_SYS, context): "N",
-    }
-
-    P_raw = N_raw = ""
-
-    for fut in as_completed(futures):
-        label = futures[fut]
-        try:
-            txt = fut.result()
-        except Exception:
-            txt = ""
-
-        if label == "P":
-            P_raw = txt
-        else:
-            N_raw = txt
-
-    P = safe_points_parse(P_raw, min_items=3, max_items=6)
-    N = safe_points_parse(N_raw, min_items=3, max_items=6)
-
-    judge_input = f"""
-{context}
-
-Optimistic analysis: {json.dumps(P, ensure_ascii=False)}
-Critical analysis: {json.dumps(N, ensure_ascii=False)}
-Counts: positives={len(P)} negatives={len(N)}
-""".strip()
-
-    J_raw = AGENT_POOL.submit(run_agent, JUDGE_SYS, judge_input).result()
-    J = safe_points_parse(J_raw, min_items=2, max_items=4)
-
-    return P, N, J
-
-
-def parse_request(payload: Union[str, Dict[str, Any]]) -> AnalyzeRequest:
-    if isinstance(payload, str):
-        return AnalyzeRequest(business_url=payload.strip())
-    return AnalyzeRequest(**payload)
-
-
-# ---------------------------
-# ROUTES
-# ---------------------------
-@app.get("/")
-def root():
-    return {
-        "service": "Yelp Pipeline 2 Backend",
-        "docs": "/docs",
-        "health": "/health",
-        "endpoint": "/analyze-business",
-        "body": "Send JSON {business_url} or raw text body with a Yelp URL",
-    }
-
-
-@app.get("/health")
-def health():
-    return {"status": "ok"}
-
-
-@app.post("/analyze-business")
-def analyze_business(
-    payload: Union[str, Dict[str, Any]] = Body(...),
-):
-
-    try:
-        req = parse_request(payload)
-    except ValidationError as e:
-        raise HTTPException(422, e.errors())
-
-    try:
-        business_id = extract_business_id_or_alias_from_url(req.business_url)
-    except Exception as e:
-        raise HTTPException(400, str(e))
-
-    # Parallel data fetch
-    fbiz = AGENT_POOL.submit(get_business_details, business_id, req.locale)
-    frev = AGENT_POOL.submit(
-        get_business_reviews_from_fusion,
-        business_id,
-        req.reviews_limit,
-        req.locale,
-    )
-
-    try:
-        business = fbiz.result()
-    except Exception as e:
-        raise HTTPException(502, f"Business fetch failed: {e}")
-
-    try:
-        reviews = frev.result()
-    except Exception:
-        reviews = []
-
-    context_source = "fusion_reviews"
-
-    if reviews:
-        context = build_context_from_reviews(business, reviews)
-    else:
-        if not req.ai_fallback:
-            raise HTTPException(404, "Fusion reviews unavailable and ai_fallback=False")
-
-        loc = business.get("location") or {}
-        ai_txt = get_review_snippets_from_yelp_ai(
-            business.get("name", ""),
-            loc.get("city", ""),
-            loc.get("state", ""),
-        )
-
-        context = build_context_from_ai_summary(business, ai_txt)
-        context_source = "yelp_ai_summary"
-
-    try:
-        P, N, J = run_multi_agent_debate(context)
-    except Exception as e:
-        raise HTTPException(502, f"LLM debate failed: {str(e)[:300]}")
-
-    return {
-        "business_id": business_id,
-        "business": normalize_business_payload(business),
-        "context_source": context_source,
-        "P": P,
-        "N": N,
-        "J": J,
-    }
-
-
-# ---------------------------
-# LOCAL RUN
-# ---------------------------
-if __name__ == "__main__":
-    import uvicorn
-
-    uvicorn.run(
-        app,
-        host="0.0.0.0",
-        port=int(os.environ.get("PORT", "8000")),
-        log_level="info",
-    )
+# Pipeline2Backend.py
+# Parallel P/N + stronger judge prompt + global thread pool.
+# ✅ Fully working version optimized for speed & throughput with gemini-2.5-flash-lite
+
+import os
+import re
+import json
+import time
+from urllib.parse import urlparse
+from typing import Optional, Union, Any, Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
+
+from fastapi import APIRouter, FastAPI, HTTPException, Body
+from fastapi.responses import JSONResponse
+from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
+from pydantic import BaseModel, Field, ValidationError
+
+from dotenv import load_dotenv
+
+from BusinessCatalog import get_catalog
+from Profiling import install_profiling, ProfiledRoute
+from JobQueue import get_job_queue, JobFailed, JobQueueFull, register_handler
+from BackendRuntime import (
+    DeadlineExceeded,
+    digest,
+    extract_json_substring,
+    gemini_config,
+    gemini_scheduler,
+    health_report,
+    install_error_handlers,
+    Lazy,
+    normalize_text,
+    PASSTHROUGH_ERRORS,
+    preopen_connection,
+    remaining_budget,
+    request_deadline,
+    request_priority,
+    require,
+    runtime_metrics,
+    single_flight,
+    start_warmup,
+    strip_code_fences,
+    submit_in_context,
+    upstream_request,
+    wait_result,
+    yelp_quota_level,
+)
+
+
+# ---------------------------
+# ENV + CLIENTS
+# ---------------------------
+load_dotenv()
+
+# Gemini keys (GEMINI_API_KEYS / GOOGLE_API_KEYS / GOOGLE_API_KEY / GEMINI_API_KEY,
+# comma-separated allowed) are read by BackendRuntime. The per-key scheduler is
+# shared across workers in multi-process mode and built on first use (or during
+# warmup) so import never fails on missing keys.
+
+YELP_API_KEY = os.environ.get("YELP_API_KEY")
+YELP_AI_ENDPOINT = os.environ.get(
+    "YELP_AI_ENDPOINT",
+    "https://api.yelp.com/ai/chat/v2",
+)
+
+# ✅ Correct model from your quota: fastest non-streaming tier
+MODEL_FAST = "gemini-2.5-flash-lite"
+
+# Global thread pool to reuse across requests
+_AGENT_POOL = Lazy(lambda: ThreadPoolExecutor(max_workers=4))
+
+
+def agent_pool() -> ThreadPoolExecutor:
+    return _AGENT_POOL.get()
+
+
+YELP_BUSINESS_ENDPOINT = "https://api.yelp.com/v3/businesses/{business_id_or_alias}"
+YELP_REVIEWS_ENDPOINT  = "https://api.yelp.com/v3/businesses/{business_id_or_alias}/reviews"
+
+# Fusion details younger than this are served from the local catalog
+CATALOG_DETAILS_MAX_AGE_S = float(os.environ.get("CATALOG_DETAILS_MAX_AGE_S", "86400"))
+
+# Incremental verdict refresh: with at most VERDICT_DELTA_MAX_REVIEWS new reviews
+# only a delta update + the Judge run. A full debate is forced once the last full
+# one is older than VERDICT_STALE_S or after VERDICT_MAX_DELTA_RUNS deltas.
+VERDICT_DELTA_MAX_REVIEWS = int(os.environ.get("VERDICT_DELTA_MAX_REVIEWS", "3"))
+VERDICT_STALE_S = float(os.environ.get("VERDICT_STALE_S", str(7 * 86400)))
+VERDICT_MAX_DELTA_RUNS = int(os.environ.get("VERDICT_MAX_DELTA_RUNS", "5"))
+
+# A stored verdict younger than this is served without any Yelp call (verdicts
+# precomputed by precompute-verdicts.py land here); 0 always checks for new reviews
+VERDICT_SERVE_FRESH_S = float(os.environ.get("VERDICT_SERVE_FRESH_S", str(6 * 3600)))
+
+# Time budget for one background analysis job (no client is waiting on it)
+JOB_DEADLINE_S = float(os.environ.get("JOB_DEADLINE_S", "240"))
+
+
+# ---------------------------
+# FASTAPI APP
+# ---------------------------
+def warmup_tasks():
+    return [
+        ("gemini_clients", lambda: gemini_scheduler().warm()),
+        ("agent_pool", agent_pool),
+        ("yelp_connection", lambda: preopen_connection("https://api.yelp.com/v3/")),
+        ("catalog", get_catalog),
+    ]
+
+
+# Admission-control class per route (see BackendRuntime.PRIORITY_CLASSES);
+# batch and prefetch callers lower theirs with X-Request-Priority
+ROUTE_PRIORITIES = {
+    "/analyze-business": "interactive",
+    "/analyze-business/jobs": "batch",
+}
+
+
+def start_job_workers() -> None:
+    """Resume persisted analysis jobs in this process (also called by Gateway)."""
+    get_job_queue().start()
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    start_warmup(warmup_tasks())
+    start_job_workers()
+    yield
+
+
+app = FastAPI(title="Yelp Pipeline 2 Backend", version="1.5.1", lifespan=lifespan)
+
+install_error_handlers(app, ROUTE_PRIORITIES)
+install_profiling(app)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# Pipeline routes live on a router so Gateway.py can mount them next to Pipeline 1
+router = APIRouter(route_class=ProfiledRoute)
+
+
+# ---------------------------
+# PROMPTS
+# ---------------------------
+OPTIMIST_SYS = """
+You are the Optimistic Agent. You receive context about a restaurant or hotel and several review snippets.
+Focus on strengths, recurring positives, and reasons a typical guest might enjoy the place.
+Highlight food quality, friendly/efficient service, value, vibe, convenience, and reliability.
+Do not mention reviews or that you are an agent.
+
+Output ONLY a valid JSON array of short points (strings), 3–6 items.
+Example: ["Great pasta", "Warm service", "Cozy ambience"]
+""".strip()
+
+CRITIC_SYS = """
+You are the Critical Agent. You receive context about a restaurant or hotel and several review snippets.
+Focus on weaknesses, recurring complaints, risks, and situations where a guest could be disappointed.
+Highlight inconsistent food, slow/rude service, cleanliness problems, cramped/noisy space, and poor value.
+Do not mention reviews or that you are an agent.
+
+Output ONLY a valid JSON array of short points (strings), 3–6 items.
+Example: ["Long waits", "Inconsistent dishes", "Noisy dining room"]
+""".strip()
+
+JUDGE_SYS = """
+You are the Judge Agent. You receive the business context plus an Optimistic analysis and a Critical analysis.
+
+Do NOT split the difference. Decide a lean:
+- If positives outweigh negatives → lean positive.
+- If negatives outweigh positives → lean negative.
+- Say "mixed" only if truly balanced.
+
+Output ONLY a valid JSON array of short points (strings), 2–4 items:
+1) Net verdict with lean.
+2) Who it suits / best use-case.
+3) Key caution or tip (optional).
+
+Constraints:
+- Base only on provided material.
+- No invented statistics or prices.
+- Do not mention Yelp, reviews, or agents.
+""".strip()
+
+
+DELTA_SYS = """
+You maintain two lists of short points about a restaurant or hotel: positives (P) and negatives (N).
+You receive the business context, the current lists, and a few NEW review snippets.
+Update the lists: keep points that still hold, add recurring themes the new snippets support,
+and soften or drop points the new snippets clearly contradict. Do not mention reviews or agents.
+
+Output ONLY valid JSON: {"P": ["..."], "N": ["..."]} with 3–6 short points in each list.
+""".strip()
+
+
+# ---------------------------
+# REQUEST SCHEMA
+# ---------------------------
+class AnalyzeRequest(BaseModel):
+    business_url: str = Field(..., description="Full Yelp business URL")
+    reviews_limit: int = Field(6, ge=1, le=20)
+    ai_fallback: bool = True
+    locale: Optional[str] = None
+
+    model_config = {"extra": "ignore"}
+
+
+# ---------------------------
+# HELPERS
+# ---------------------------
+def _yelp_headers():
+    return {
+        "Authorization": f"Bearer {require(YELP_API_KEY, 'Missing YELP_API_KEY')}",
+        "accept": "application/json",
+    }
+
+
+def run_agent(system_prompt: str, content: str) -> str:
+    """
+    Parallel-safe Gemini call using fastest available vision/text tier.
+    Uses the shared key scheduler (round-robin over keys with quota left).
+    """
+    resp = gemini_scheduler().call(
+        lambda llm_client: llm_client.models.generate_content(
+            model=MODEL_FAST,
+            contents=[system_prompt, content],
+            config=gemini_config({"response_mime_type": "application/json"}),
+        )
+    )
+
+    return (getattr(resp, "text", "") or "").strip()
+
+
+def _sanitize_points(points: List[str], max_items: int) -> List[str]:
+    out: List[str] = []
+    for p in points:
+        if not p:
+            continue
+        s = str(p).strip()
+        s = s.strip(",")
+        if (s.startswith('"') and s.endswith('"')) or (s.startswith("'") and s.endswith("'")):
+            s = s[1:-1].strip()
+        if s:
+            out.append(s)
+    return out[:max_items]
+
+
+def safe_points_parse(text: str, min_items: int = 2, max_items: int = 8) -> List[str]:
+    if not text:
+        return []
+
+    cleaned = strip_code_fences(text)
+
+    # Try strict JSON
+    try:
+        arr = json.loads(cleaned)
+        if isinstance(arr, list):
+            pts = _sanitize_points(arr, max_items)
+            if pts:
+                return pts
+    except Exception:
+        pass
+
+    # Extract embedded JSON array
+    sub = extract_json_substring(cleaned, "[", "]")
+    if sub:
+        try:
+            arr = json.loads(sub)
+            if isinstance(arr, list):
+                pts = _sanitize_points(arr, max_items)
+                if pts:
+                    return pts
+        except Exception:
+            pass
+
+    # Fallback: line split
+    lines = re.split(r"(?:\r?\n)+", cleaned)
+    pts: List[str] = []
+    for ln in lines:
+        ln = re.sub(r"^[-•\d\)\.]+\s*", "", ln.strip())
+        if ln:
+            pts.append(ln)
+
+    if not pts and ";" in cleaned:
+        pts = [p.strip() for p in cleaned.split(";") if p.strip()]
+
+    pts = _sanitize_points(pts, max_items)
+    return pts if len(pts) >= min_items else pts
+
+
+def extract_business_id_or_alias_from_url(business_url: str) -> str:
+    parsed = urlparse(business_url.strip())
+    parts = [p for p in parsed.path.split("/") if p]
+    if len(parts) >= 2 and parts[0] == "biz":
+        return parts[1]
+    if re.match(r"^[A-Za-z0-9\-_]+$", business_url.strip()):
+        return business_url.strip()
+    raise ValueError("Unable to extract business alias/id from URL")
+
+
+@single_flight(
+    "business_details",
+    key=lambda business_id_or_alias, locale: (normalize_text(business_id_or_alias), locale or ""),
+)
+def get_business_details(business_id_or_alias: str, locale: Optional[str]) -> dict:
+    catalog = get_catalog()
+    if catalog is not None:
+        # short on Yelp quota: any stored copy beats spending a call
+        max_age_s = CATALOG_DETAILS_MAX_AGE_S if yelp_quota_level("yelp_fusion") == "ok" else None
+        try:
+            cached = catalog.get_details(business_id_or_alias, locale, max_age_s=max_age_s)
+        except Exception:
+            cached = None
+        if cached:
+            return cached
+
+    r = upstream_request(
+        "yelp_fusion",
+        "GET",
+        YELP_BUSINESS_ENDPOINT.format(business_id_or_alias=business_id_or_alias),
+        headers=_yelp_headers(),
+        params={"locale": locale} if locale else None,
+        timeout=30,
+    )
+    r.raise_for_status()
+    business = r.json()
+
+    if catalog is not None:
+        catalog.submit(catalog.upsert_details, business, locale)
+
+    return business
+
+
+def get_business_reviews_from_fusion(
+    business_id_or_alias: str,
+    limit: int,
+    locale: Optional[str],
+) -> list:
+
+    r = upstream_request(
+        "yelp_fusion",
+        "GET",
+        YELP_REVIEWS_ENDPOINT.format(business_id_or_alias=business_id_or_alias),
+        headers=_yelp_headers(),
+        params={"limit": limit, "sort_by": "yelp_sort", "locale": locale} if locale else {"limit": limit},
+        timeout=30,
+    )
+
+    if r.status_code != 200:
+        return []
+
+    return (r.json() or {}).get("reviews", [])
+
+
+def get_review_snippets_from_yelp_ai(business_name: str, city: str, state: str) -> str:
+
+    location_str = ", ".join(p for p in [city, state] if p)
+    payload = {
+        "query": f"For {business_name} in {location_str}, summarize typical guest experiences "
+                 f"as 3 short positives and 3 short negatives."
+    }
+
+    r = upstream_request(
+        "yelp_ai",
+        "POST",
+        YELP_AI_ENDPOINT,
+        headers={
+            "Authorization": f"Bearer {require(YELP_API_KEY, 'Missing YELP_API_KEY')}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        },
+        json=payload,
+        timeout=40,
+    )
+
+    if r.status_code != 200:
+        raise HTTPException(502, f"Yelp AI fallback failed: {r.text[:300]}")
+
+    return ((r.json() or {}).get("response") or {}).get("text", "") or ""
+
+
+def normalize_business_payload(business: dict) -> dict:
+
+    loc = business.get("location") or {}
+    cats = [c.get("title") for c in (business.get("categories") or []) if c.get("title")]
+
+    address = loc.get("formatted_address") or ", ".join(
+        p for p in [
+            loc.get("address1"),
+            loc.get("address2"),
+            loc.get("address3"),
+            loc.get("city"),
+            loc.get("state"),
+            loc.get("zip_code"),
+            loc.get("country"),
+        ] if p
+    )
+
+    return {
+        "name": business.get("name", "N/A"),
+        "rating": business.get("rating", "N/A"),
+        "price": business.get("price", "N/A"),
+        "categories": cats,
+        "address": address or "N/A",
+        "url": business.get("url", "N/A"),
+        "review_count": business.get("review_count", "N/A"),
+    }
+
+
+def build_context_from_reviews(business: dict, reviews: list) -> str:
+    b = normalize_business_payload(business)
+    out = f"""
+Business:
+Name: {b['name']}
+Rating: {b['rating']}
+Price: {b['price']}
+Categories: {", ".join(b['categories'])}
+Address: {b['address']}
+
+Representative review snippets:
+""".strip()
+
+    for r in reviews[:10]:
+        txt = (r.get("text") or "").replace("\n", " ").strip()
+        if txt:
+            out += f"\n- {r.get('rating')}★: {txt}"
+
+    return out
+
+
+def build_context_from_ai_summary(business: dict, summary: str) -> str:
+    b = normalize_business_payload(business)
+    return f"""
+Business:
+Name: {b['name']}
+Rating: {b['rating']}
+Price: {b['price']}
+Categories: {", ".join(b['categories'])}
+Address: {b['address']}
+
+AI summary of typical positives/negatives:
+{summary.strip()}
+""".strip()
+
+
+@single_flight("multi_agent_debate", key=lambda context: digest(context))
+def run_multi_agent_debate(context: str) -> Tuple[List[str], List[str], List[str]]:
+
+    # Run P + N in parallel
+    futures = {
+        submit_in_context(agent_pool(), run_agent, OPTIMIST_SYS, context): "P",
+        submit_in_context(agent_pool(), run_agent, CRITIC_SYS, context): "N",
+    }
+
+    P_raw = N_raw = ""
+
+    left = remaining_budget()
+    try:
+        for fut in as_completed(futures, timeout=None if left is None else max(0.0, left)):
+            label = futures[fut]
+            try:
+                txt = fut.result()
+            except Exception:
+                txt = ""
+
+            if label == "P":
+                P_raw = txt
+            else:
+                N_raw = txt
+    except FutureTimeout:
+        for fut in futures:
+            fut.cancel()
+        raise DeadlineExceeded("Request deadline exceeded during P/N agents") from None
+
+    P = safe_points_parse(P_raw, min_items=3, max_items=6)
+    N = safe_points_parse(N_raw, min_items=3, max_items=6)
+    J = run_judge(context, P, N)
+
+    return P, N, J
+
+
+def run_judge(context: str, P: List[str], N: List[str]) -> List[str]:
+    judge_input = f"""
+{context}
+
+Optimistic analysis: {json.dumps(P, ensure_ascii=False)}
+Critical analysis: {json.dumps(N, ensure_ascii=False)}
+Counts: positives={len(P)} negatives={len(N)}
+""".strip()
+
+    J_raw = wait_result(submit_in_context(agent_pool(), run_agent, JUDGE_SYS, judge_input), "judge")
+    return safe_points_parse(J_raw, min_items=2, max_items=4)
+
+
+def run_delta_update(
+    business: dict,
+    P: List[str],
+    N: List[str],
+    new_reviews: list,
+) -> Optional[Tuple[List[str], List[str]]]:
+    """Fold a few new reviews into existing P/N points; None if the reply is unusable."""
+    b = normalize_business_payload(business)
+    snippets = "\n".join(
+        f"- {r.get('rating')}★: {(r.get('text') or '').replace(chr(10), ' ').strip()}"
+        for r in new_reviews
+        if (r.get("text") or "").strip()
+    )
+    content = f"""
+Business: {b['name']} ({", ".join(b['categories'])}), rating {b['rating']}
+
+Current positives: {json.dumps(P, ensure_ascii=False)}
+Current negatives: {json.dumps(N, ensure_ascii=False)}
+
+New review snippets:
+{snippets}
+""".strip()
+
+    raw = strip_code_fences(run_agent(DELTA_SYS, content))
+    try:
+        data = json.loads(extract_json_substring(raw, "{", "}") or raw)
+    except Exception:
+        return None
+    if not isinstance(data, dict):
+        return None
+    new_P = _sanitize_points(data.get("P") or [], 6)
+    new_N = _sanitize_points(data.get("N") or [], 6)
+    if len(new_P) < 3 or len(new_N) < 3:
+        return None
+    return new_P, new_N
+
+
+def stored_analysis(
+    business_id_or_alias: str,
+    locale: Optional[str],
+    max_age_s: Optional[float],
+) -> Optional[Dict[str, Any]]:
+    """analyze() result rebuilt from the catalog alone (no upstream calls), if stored."""
+    catalog = get_catalog()
+    if catalog is None:
+        return None
+    try:
+        business = catalog.get_details(business_id_or_alias, locale)
+        stored = catalog.get_verdict(business["id"], locale) if business and business.get("id") else None
+    except Exception:
+        return None
+    if stored is None or (max_age_s is not None and time.time() - stored["updated_at"] > max_age_s):
+        return None
+    return {
+        "business_id": business_id_or_alias,
+        "business": normalize_business_payload(business),
+        "context_source": "stored_verdict",
+        "verdict_mode": "cached",
+        "P": stored["P"],
+        "N": stored["N"],
+        "J": stored["J"],
+    }
+
+
+def refresh_verdict(
+    business: dict,
+    reviews: list,
+    context: str,
+    locale: Optional[str],
+) -> Tuple[List[str], List[str], List[str], str]:
+    """
+    P/N/J for a business, reusing the stored verdict when the review set
+    barely changed. Returns (P, N, J, mode) with mode "cached" (no new
+    reviews), "delta" (delta update + Judge) or "full" (three-agent debate).
+    """
+    catalog = get_catalog()
+    business_id = business.get("id")
+    review_ids = [r["id"] for r in reviews if r.get("id")]
+
+    prev = None
+    if catalog is not None and business_id and review_ids:
+        try:
+            prev = catalog.get_verdict(business_id, locale)
+        except Exception:
+            prev = None
+
+    mode = "full"
+    if prev is not None:
+        known = set(prev["review_ids"])
+        added = [r for r in reviews if r.get("id") and r["id"] not in known]
+        fresh = (
+            time.time() - prev["full_at"] < VERDICT_STALE_S
+            and prev["delta_runs"] < VERDICT_MAX_DELTA_RUNS
+        )
+        if fresh and not added:
+            return prev["P"], prev["N"], prev["J"], "cached"
+        if fresh and len(added) <= VERDICT_DELTA_MAX_REVIEWS:
+            updated = run_delta_update(business, prev["P"], prev["N"], added)
+            if updated is not None:
+                P, N = updated
+                J = run_judge(context, P, N)
+                mode = "delta"
+
+    if mode == "full":
+        P, N, J = run_multi_agent_debate(context)
+
+    if catalog is not None and business_id and review_ids and P and N and J:
+        # remember every id seen so reviews rotating in and out of the top N don't count as new
+        seen = list(dict.fromkeys(review_ids + (prev["review_ids"] if prev else [])))[:200]
+        catalog.submit(catalog.put_verdict, business_id, locale, {
+            "P": P,
+            "N": N,
+            "J": J,
+            "review_ids": seen,
+            "full_at": time.time() if mode == "full" else prev["full_at"],
+            "delta_runs": 0 if mode == "full" else prev["delta_runs"] + 1,
+        })
+
+    return P, N, J, mode
+
+
+def parse_request(payload: Union[str, Dict[str, Any]]) -> AnalyzeRequest:
+    if isinstance(payload, str):
+        return AnalyzeRequest(business_url=payload.strip())
+    return AnalyzeRequest(**payload)
+
+
+# ---------------------------
+# ROUTES
+# ---------------------------
+@app.get("/")
+def root():
+    return {
+        "service": "Yelp Pipeline 2 Backend",
+        "docs": "/docs",
+        "health": "/health",
+        "endpoint": "/analyze-business",
+        "body": "Send JSON {business_url} or raw text body with a Yelp URL",
+    }
+
+
+@app.get("/health")
+def health():
+    return health_report()
+
+
+@app.get("/metrics")
+def metrics():
+    return runtime_metrics()
+
+
+def analyze(req: AnalyzeRequest, use_stored: bool = True) -> Dict[str, Any]:
+    """
+    Fetch business + reviews, run the debate; raises HTTPException like the
+    route. A fresh stored verdict (any stored verdict while Yelp quota is low)
+    is returned without upstream calls unless use_stored is False.
+    """
+    try:
+        business_id = extract_business_id_or_alias_from_url(req.business_url)
+    except Exception as e:
+        raise HTTPException(400, str(e))
+
+    if use_stored:
+        degraded = yelp_quota_level("yelp_fusion") != "ok"
+        if degraded or VERDICT_SERVE_FRESH_S > 0:
+            stored = stored_analysis(business_id, req.locale, None if degraded else VERDICT_SERVE_FRESH_S)
+            if stored is not None:
+                return stored
+
+    # Parallel data fetch
+    fbiz = submit_in_context(agent_pool(), get_business_details, business_id, req.locale)
+    frev = submit_in_context(
+        agent_pool(),
+        get_business_reviews_from_fusion,
+        business_id,
+        req.reviews_limit,
+        req.locale,
+    )
+
+    try:
+        business = wait_result(fbiz, "business fetch")
+    except PASSTHROUGH_ERRORS:
+        frev.cancel()
+        raise
+    except Exception as e:
+        raise HTTPException(502, f"Business fetch failed: {e}")
+
+    try:
+        reviews = wait_result(frev, "reviews fetch")
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        reviews = []
+
+    context_source = "fusion_reviews"
+
+    if reviews:
+        context = build_context_from_reviews(business, reviews)
+    else:
+        if not req.ai_fallback:
+            raise HTTPException(404, "Fusion reviews unavailable and ai_fallback=False")
+
+        loc = business.get("location") or {}
+        ai_txt = get_review_snippets_from_yelp_ai(
+            business.get("name", ""),
+            loc.get("city", ""),
+            loc.get("state", ""),
+        )
+
+        context = build_context_from_ai_summary(business, ai_txt)
+        context_source = "yelp_ai_summary"
+
+    try:
+        if context_source == "fusion_reviews":
+            P, N, J, verdict_mode = refresh_verdict(business, reviews, context, req.locale)
+        else:
+            P, N, J = run_multi_agent_debate(context)
+            verdict_mode = "full"
+    except PASSTHROUGH_ERRORS:
+        raise
+    except Exception as e:
+        raise HTTPException(502, f"LLM debate failed: {str(e)[:300]}")
+
+    return {
+        "business_id": business_id,
+        "business": normalize_business_payload(business),
+        "context_source": context_source,
+        "verdict_mode": verdict_mode,
+        "P": P,
+        "N": N,
+        "J": J,
+    }
+
+
+def _parse_or_422(payload: Union[str, Dict[str, Any]]) -> AnalyzeRequest:
+    try:
+        return parse_request(payload)
+    except ValidationError as e:
+        raise HTTPException(422, e.errors())
+
+
+@router.post("/analyze-business")
+def analyze_business(
+    payload: Union[str, Dict[str, Any]] = Body(...),
+):
+    return analyze(_parse_or_422(payload))
+
+
+# ---------------------------
+# BACKGROUND JOBS
+# ---------------------------
+def _run_analysis_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    with request_deadline(JOB_DEADLINE_S), request_priority("batch"):
+        try:
+            return analyze(AnalyzeRequest(**payload))
+        except HTTPException as e:
+            if e.status_code >= 500:
+                raise  # upstream trouble: retried
+            raise JobFailed(e.status_code, str(e.detail))
+
+
+register_handler(
+    "analyze_business",
+    _run_analysis_job,
+    retryable=lambda e: isinstance(e, PASSTHROUGH_ERRORS) or getattr(e, "status_code", 0) >= 500,
+)
+
+
+@router.post("/analyze-business/jobs", status_code=202)
+def submit_analysis_job(
+    payload: Union[str, Dict[str, Any]] = Body(...),
+):
+    """
+    Queue an analysis and return at once. Poll GET /analyze-business/jobs/{job_id},
+    or pass "webhook_url" to have the finished job POSTed back. Resubmitting the
+    same business returns the existing job.
+    """
+    req = _parse_or_422(payload)
+    webhook_url = payload.get("webhook_url") if isinstance(payload, dict) else None
+    try:
+        business_id = extract_business_id_or_alias_from_url(req.business_url)
+    except Exception as e:
+        raise HTTPException(400, str(e))
+
+    dedupe_key = "|".join(
+        (normalize_text(business_id), req.locale or "", str(req.reviews_limit), str(int(req.ai_fallback)))
+    )
+    try:
+        job, created = get_job_queue().submit(
+            "analyze_business", req.model_dump(), dedupe_key, webhook_url=webhook_url
+        )
+    except JobQueueFull as e:
+        raise HTTPException(503, str(e), headers={"Retry-After": str(int(e.retry_after))})
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+
+    job["deduplicated"] = not created
+    job["poll"] = f"/analyze-business/jobs/{job['job_id']}"
+    return JSONResponse(status_code=202 if job["status"] in ("queued", "running") else 200, content=job)
+
+
+@router.get("/analyze-business/jobs/{job_id}")
+def get_analysis_job(job_id: str):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        raise HTTPException(404, "Unknown job_id")
+    return job
+
+
+app.include_router(router)
+
+
+# ---------------------------
+# LOCAL RUN
+# ---------------------------
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8000")),
+        log_level="info",
+    )
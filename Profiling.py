@@ -0,0 +1,393 @@
+# Profiling.py
+# Admin-only profiling for production workers. Everything here is inert unless
+# PROFILING_ADMIN_TOKEN is set; then:
+#   - a sampled share of requests (PROFILE_SAMPLE_RATE), or any request sent with
+#     X-Profile: 1 and the admin token, is captured with cProfile around its
+#     endpoint and kept in memory (GET /admin/profiles, /admin/profiles/{id})
+#   - GET /admin/profile/sample?seconds=10 samples every thread of the process
+#     and returns collapsed stacks (flamegraph.pl / speedscope input)
+#   - event-loop lag and thread-pool start delay are probed and reported
+#     under /metrics -> "profiling"
+#
+# Admin routes need the X-Admin-Token header and answer 404 while disabled.
+
+import io
+import os
+import sys
+import hmac
+import time
+import uuid
+import random
+import asyncio
+import cProfile
+import pstats
+import logging
+import threading
+from collections import Counter, deque
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from fastapi.routing import APIRoute
+
+from BackendRuntime import register_metrics
+
+load_dotenv()
+
+logger = logging.getLogger("backend.profiling")
+
+
+# ---------------------------
+# CONFIG
+# ---------------------------
+PROFILING_ADMIN_TOKEN = os.environ.get("PROFILING_ADMIN_TOKEN", "").strip()
+PROFILING_ENABLED = bool(PROFILING_ADMIN_TOKEN)
+
+# Share of requests captured without being asked (0 = only on X-Profile)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "20"))
+PROFILE_TOP_N = int(os.environ.get("PROFILE_TOP_N", "40"))
+
+# Whole-process sampler limits
+PROFILE_SAMPLE_MAX_S = float(os.environ.get("PROFILE_SAMPLE_MAX_S", "30"))
+PROFILE_SAMPLE_HZ = int(os.environ.get("PROFILE_SAMPLE_HZ", "100"))
+
+# Lag probe period (0 disables the probes)
+LAG_PROBE_INTERVAL_S = float(os.environ.get("LAG_PROBE_INTERVAL_S", "1"))
+
+PROFILE_HEADER = "x-profile"
+ADMIN_TOKEN_HEADER = "x-admin-token"
+
+
+def _token_ok(token: Optional[str]) -> bool:
+    return (
+        PROFILING_ENABLED
+        and bool(token)
+        and hmac.compare_digest(token.encode(), PROFILING_ADMIN_TOKEN.encode())
+    )
+
+
+# ---------------------------
+# PER-REQUEST CAPTURE
+# ---------------------------
+class _Capture:
+    """One profiled request; the endpoint wrapper fills in `profile`."""
+
+    __slots__ = ("id", "method", "path", "trigger", "profile", "status", "wall_ms", "at")
+
+    def __init__(self, method: str, path: str, trigger: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.trigger = trigger
+        self.profile: Optional[cProfile.Profile] = None
+        self.status = 0
+        self.wall_ms = 0.0
+        self.at = time.time()
+
+
+_CAPTURE: ContextVar[Optional[_Capture]] = ContextVar("profile_capture", default=None)
+_CAPTURES: Deque[Dict[str, Any]] = deque(maxlen=PROFILE_KEEP)
+_CAPTURES_LOCK = threading.Lock()
+
+
+def _profiled(endpoint: Callable) -> Callable:
+    """
+    Wrap a route endpoint so a requested capture runs cProfile around it, in
+    whichever thread executes it (sync endpoints run on the thread pool).
+    Work the endpoint hands to other pools shows up as time spent waiting.
+    """
+    if asyncio.iscoroutinefunction(endpoint):
+        @wraps(endpoint)
+        async def run_async(*args, **kwargs):
+            capture = _CAPTURE.get()
+            if capture is None or capture.profile is not None:
+                return await endpoint(*args, **kwargs)
+            # on the event loop: interleaved requests are captured too
+            capture.profile = cProfile.Profile()
+            capture.profile.enable()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                capture.profile.disable()
+
+        return run_async
+
+    @wraps(endpoint)
+    def run_sync(*args, **kwargs):
+        capture = _CAPTURE.get()
+        if capture is None or capture.profile is not None:
+            return endpoint(*args, **kwargs)
+        capture.profile = cProfile.Profile()
+        capture.profile.enable()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            capture.profile.disable()
+
+    return run_sync
+
+
+class ProfiledRoute(APIRoute):
+    """APIRoute whose endpoint can be profiled per request (router route_class)."""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, _profiled(endpoint) if PROFILING_ENABLED else endpoint, **kwargs)
+
+
+def _store(capture: _Capture) -> None:
+    if capture.profile is None:
+        return
+    out = io.StringIO()
+    stats = pstats.Stats(capture.profile, stream=out)
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    top = [
+        {"function": pstats.func_std_string(func), "calls": nc, "cumulative_ms": round(ct * 1000, 2)}
+        for func, (_cc, nc, _tt, ct, _callers) in sorted(
+            stats.stats.items(), key=lambda kv: kv[1][3], reverse=True
+        )[:10]
+    ]
+    with _CAPTURES_LOCK:
+        _CAPTURES.append({
+            "id": capture.id,
+            "method": capture.method,
+            "path": capture.path,
+            "trigger": capture.trigger,
+            "status": capture.status,
+            "wall_ms": capture.wall_ms,
+            "at": capture.at,
+            "top": top,
+            "report": out.getvalue(),
+        })
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that picks requests to profile and starts the lag probes."""
+
+    def __init__(self, app):
+        self.app = app
+        self._probes_started = False
+
+    def _trigger(self, scope) -> Optional[str]:
+        wants = token = None
+        for name, value in scope.get("headers") or ():
+            if name == PROFILE_HEADER.encode():
+                wants = value.decode("latin-1").strip()
+            elif name == ADMIN_TOKEN_HEADER.encode():
+                token = value.decode("latin-1").strip()
+        if wants == "1" and _token_ok(token):
+            return "header"
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            return "sampled"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if not self._probes_started:
+            self._probes_started = True
+            _LAG.start()
+
+        trigger = None if scope["path"].startswith("/admin/") else self._trigger(scope)
+        if trigger is None:
+            return await self.app(scope, receive, send)
+
+        capture = _Capture(scope.get("method", ""), scope["path"], trigger)
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                capture.status = message["status"]
+                headers = list(message.get("headers") or ())
+                headers.append((b"x-profile-id", capture.id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = _CAPTURE.set(capture)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _CAPTURE.reset(token)
+            capture.wall_ms = round((time.perf_counter() - started) * 1000, 2)
+            _store(capture)
+
+
+# ---------------------------
+# WHOLE-PROCESS SAMPLER
+# ---------------------------
+_SAMPLER_LOCK = threading.Lock()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_process(seconds: float, hz: int) -> Dict[str, Any]:
+    """
+    Sample every thread's stack `hz` times a second for `seconds`. Returns
+    collapsed stacks ("thread;outer;...;inner count" per line) and totals.
+    """
+    names = {t.ident: t.name for t in threading.enumerate()}
+    me = threading.get_ident()
+    stacks: Counter = Counter()
+    interval = 1.0 / max(1, hz)
+    samples = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            parts: List[str] = []
+            while frame is not None:
+                parts.append(_frame_label(frame))
+                frame = frame.f_back
+            parts.append(names.get(ident) or f"thread-{ident}")
+            stacks[";".join(reversed(parts))] += 1
+        samples += 1
+        time.sleep(interval)
+    return {
+        "samples": samples,
+        "collapsed": "\n".join(f"{stack} {n}" for stack, n in stacks.most_common()),
+    }
+
+
+# ---------------------------
+# LAG GAUGES
+# ---------------------------
+class LagProbe:
+    """
+    Event-loop lag (how late a timed sleep wakes up) and thread-pool start
+    delay (how long a no-op waits for a worker thread), over the last minute.
+    """
+
+    def __init__(self, interval_s: float = LAG_PROBE_INTERVAL_S):
+        self.interval_s = interval_s
+        window = max(1, int(60 / interval_s)) if interval_s > 0 else 1
+        self.loop_lag: Deque[float] = deque(maxlen=window)
+        self.pool_wait: Deque[float] = deque(maxlen=window)
+        self.pool_busy: Optional[int] = None
+        self.pool_size: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if not PROFILING_ENABLED or self.interval_s <= 0 or self._task is not None:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        from anyio import to_thread
+
+        while True:
+            try:
+                t0 = time.monotonic()
+                await asyncio.sleep(self.interval_s)
+                self.loop_lag.append(max(0.0, time.monotonic() - t0 - self.interval_s))
+                t1 = time.monotonic()
+                limiter = to_thread.current_default_thread_limiter()
+                self.pool_busy, self.pool_size = limiter.borrowed_tokens, int(limiter.total_tokens)
+                started = await to_thread.run_sync(time.monotonic)
+                self.pool_wait.append(max(0.0, started - t1))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("lag probe failed")
+
+    @staticmethod
+    def _summary(values: Deque[float]) -> Optional[Dict[str, float]]:
+        if not values:
+            return None
+        ordered = sorted(values)
+        return {
+            "last_ms": round(values[-1] * 1000, 2),
+            "p50_ms": round(ordered[len(ordered) // 2] * 1000, 2),
+            "max_ms": round(ordered[-1] * 1000, 2),
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "event_loop_lag": self._summary(self.loop_lag),
+            "threadpool_wait": self._summary(self.pool_wait),
+            "threadpool_busy": self.pool_busy,
+            "threadpool_size": self.pool_size,
+        }
+
+
+_LAG = LagProbe()
+
+
+def profiling_stats() -> Dict[str, Any]:
+    if not PROFILING_ENABLED:
+        return {"enabled": False}
+    with _CAPTURES_LOCK:
+        kept = len(_CAPTURES)
+    return {"enabled": True, "sample_rate": PROFILE_SAMPLE_RATE, "captures_kept": kept, **_LAG.stats()}
+
+
+register_metrics("profiling", profiling_stats)
+
+
+# ---------------------------
+# ADMIN ROUTES
+# ---------------------------
+admin_router = APIRouter(prefix="/admin", include_in_schema=False)
+
+
+def _require_admin(token: Optional[str]) -> None:
+    if not PROFILING_ENABLED:
+        raise HTTPException(404, "Not Found")
+    if not _token_ok(token):
+        raise HTTPException(403, "Invalid admin token")
+
+
+@admin_router.get("/profiles")
+def list_profiles(x_admin_token: Optional[str] = Header(None)):
+    _require_admin(x_admin_token)
+    with _CAPTURES_LOCK:
+        captures = list(_CAPTURES)
+    return {
+        "profiles": [{k: v for k, v in c.items() if k != "report"} for c in reversed(captures)],
+    }
+
+
+@admin_router.get("/profiles/{profile_id}", response_class=PlainTextResponse)
+def get_profile(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    _require_admin(x_admin_token)
+    with _CAPTURES_LOCK:
+        found = next((c for c in _CAPTURES if c["id"] == profile_id), None)
+    if found is None:
+        raise HTTPException(404, "Profile not found")
+    return found["report"]
+
+
+@admin_router.get("/profile/sample", response_class=PlainTextResponse)
+def sample_profile(
+    seconds: float = Query(10.0, gt=0),
+    hz: int = Query(PROFILE_SAMPLE_HZ, ge=1, le=1000),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """Collapsed stacks for the whole process; save as .folded for flamegraph.pl / speedscope."""
+    _require_admin(x_admin_token)
+    if not _SAMPLER_LOCK.acquire(blocking=False):
+        raise HTTPException(409, "A sampling run is already in progress")
+    try:
+        result = sample_process(min(seconds, PROFILE_SAMPLE_MAX_S), hz)
+    finally:
+        _SAMPLER_LOCK.release()
+    return PlainTextResponse(
+        result["collapsed"],
+        headers={
+            "X-Profile-Samples": str(result["samples"]),
+            "Content-Disposition": 'attachment; filename="profile.folded"',
+        },
+    )
+
+
+def install_profiling(app) -> None:
+    """Add the admin routes and, when enabled, the per-request profiling middleware."""
+    app.include_router(admin_router)
+    if PROFILING_ENABLED:
+        app.add_middleware(ProfilingMiddleware)
@@ -0,0 +1,265 @@
+# QueryCompiler.py
+# Rule/template compiler that turns simple captions ("best ramen", "vegan
+# brunch") into the one-sentence Yelp AI query Gemini would otherwise write.
+# Each result carries a confidence; only confident compilations skip Gemini.
+#
+# CAPTION_COMPILER_MODE:
+#   off    - always use Gemini
+#   shadow - always use Gemini, but compile too and log/measure agreement
+#   on     - serve confident compilations locally, send the rest to Gemini
+
+import os
+import re
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from BackendRuntime import register_metrics
+
+load_dotenv()
+
+logger = logging.getLogger("backend.query_compiler")
+
+
+# ---------------------------
+# CONFIG
+# ---------------------------
+CAPTION_COMPILER_MODE = os.environ.get("CAPTION_COMPILER_MODE", "shadow").strip().lower()
+CAPTION_COMPILER_MIN_CONFIDENCE = float(os.environ.get("CAPTION_COMPILER_MIN_CONFIDENCE", "0.9"))
+CAPTION_COMPILER_MAX_WORDS = int(os.environ.get("CAPTION_COMPILER_MAX_WORDS", "8"))
+
+
+# ---------------------------
+# VOCABULARY
+# ---------------------------
+_PHRASES = {
+    "ice cream": "ice_cream",
+    "dim sum": "dim_sum",
+    "hot pot": "hot_pot",
+    "fried chicken": "fried_chicken",
+    "food truck": "food_truck",
+    "food trucks": "food_truck",
+    "gluten free": "gluten_free",
+    "late night": "late_night",
+    "happy hour": "happy_hour",
+    "bubble tea": "bubble_tea",
+    "soul food": "soul_food",
+    "mac and cheese": "mac_and_cheese",
+    "fast food": "fast_food",
+}
+
+_DISHES = frozenset("""
+pizza burger burgers sushi ramen pho noodles dumplings tacos taco burrito burritos curry biryani
+bbq barbecue steak wings sandwich sandwiches salad soup pasta seafood oysters lobster crab shrimp
+bagels bagel donuts doughnuts cake cupcakes pastries croissants cookies gelato chocolate pie
+pancakes waffles poke boba coffee tea espresso smoothies juice cocktails beer wine falafel shawarma
+kebab gyro tapas brisket bao udon tempura kimchi bibimbap dosa tikka paneer empanadas tamales
+ceviche paella risotto gnocchi lasagna hotdogs cheesesteak chowder ice_cream dim_sum hot_pot
+fried_chicken bubble_tea soul_food fast_food mac_and_cheese
+""".split())
+
+_CUISINES = frozenset("""
+chinese thai indian italian mexican japanese korean vietnamese mediterranean greek french
+ethiopian lebanese turkish spanish american cajun caribbean peruvian brazilian filipino
+malaysian indonesian persian moroccan southern
+""".split())
+
+_MEALS = frozenset("breakfast brunch lunch dinner dessert desserts snacks happy_hour".split())
+
+_DIETS = frozenset("vegan vegetarian halal kosher gluten_free organic keto".split())
+
+_VENUES = {
+    "restaurant": "restaurants", "restaurants": "restaurants", "cafe": "cafes", "cafes": "cafes",
+    "bakery": "bakeries", "bakeries": "bakeries", "bar": "bars", "bars": "bars", "pub": "pubs",
+    "pubs": "pubs", "brewery": "breweries", "breweries": "breweries", "diner": "diners",
+    "diners": "diners", "steakhouse": "steakhouses", "food_truck": "food trucks",
+    "buffet": "buffets", "deli": "delis",
+}
+
+# Modifiers carried into the query ("cheap" -> "affordable")
+_MODIFIERS = {
+    "cheap": "affordable", "affordable": "affordable", "spicy": "spicy", "authentic": "authentic",
+    "late_night": "late-night", "cozy": "cozy", "romantic": "romantic", "fancy": "upscale",
+    "upscale": "upscale", "healthy": "healthy", "fresh": "fresh", "homemade": "homemade",
+}
+
+# Words that carry no constraint (popularity is always requested)
+_FILLER = frozenset("""
+i im i'm me my we want wanna need find show get give looking look for some a an the any good great
+best top popular trending famous nice tasty delicious yummy place places spot spots food eat eating
+grab where can to near nearby around here close by in at of with and please options recommendations
+""".split())
+
+# Words that make a caption something a template cannot express faithfully
+_HARD = frozenset("""
+not no without but except instead than unless if when who whose why how which like similar same
+this that these those picture photo image my friend mom dad birthday anniversary date kids dog
+""".split())
+
+_WORD_RE = re.compile(r"[a-z][a-z'\-]*")
+
+
+@dataclass(slots=True)
+class CompiledQuery:
+    query: str
+    confidence: float
+    terms: Tuple[str, ...]              # the constraint words the query must contain
+
+
+def _tokens(caption: str) -> List[str]:
+    text = " " + " ".join(_WORD_RE.findall((caption or "").lower().replace("-", " "))) + " "
+    for phrase, token in _PHRASES.items():
+        text = text.replace(f" {phrase} ", f" {token} ")
+    return text.split()
+
+
+def _where(location: str, latitude: str, longitude: str) -> str:
+    if location.strip():
+        return f"near {location.strip()}"
+    if latitude.strip() and longitude.strip():
+        return f"near latitude {latitude.strip()}, longitude {longitude.strip()}"
+    return "near me"
+
+
+def compile_caption(
+    user_query: str,
+    location: str,
+    latitude: str,
+    longitude: str,
+    date: str,
+    time: str,
+) -> CompiledQuery:
+    """
+    Compile a caption into a Yelp AI sentence. Confidence is 1.0 when every
+    word is recognised and the caption names something to eat or a venue, and
+    drops with each unrecognised word; hard constraints force 0.
+    """
+    tokens = _tokens(user_query)
+    if not tokens or len(tokens) > CAPTION_COMPILER_MAX_WORDS or any(t in _HARD for t in tokens):
+        return CompiledQuery("", 0.0, ())
+
+    modifiers: List[str] = []
+    subject: List[str] = []
+    venue: Optional[str] = None
+    dish = False
+    unknown = 0
+    for t in tokens:
+        if t in _FILLER:
+            continue
+        if t in _MODIFIERS:
+            modifiers.append(_MODIFIERS[t])
+        elif t in _DIETS or t in _CUISINES:
+            subject.append(t.replace("_", "-"))
+        elif t in _DISHES or t in _MEALS:
+            subject.append(t.replace("_", " "))
+            dish = True
+        elif t in _VENUES:
+            venue = _VENUES[t]
+        else:
+            unknown += 1
+
+    if not subject and venue is None:
+        return CompiledQuery("", 0.0, ())
+    known = len(modifiers) + len(subject) + (venue is not None)
+    confidence = known / (known + unknown)
+
+    # only words the user typed are required terms for shadow agreement
+    terms = tuple(w for part in subject for w in re.split(r"[ \-]", part) if w != "and")
+    if venue:
+        terms += (venue.split()[0],)
+    if not dish and venue is None:
+        venue = "restaurants"  # "thai", "vegan" -> thai / vegan restaurants
+
+    what = " ".join(dict.fromkeys(modifiers + subject))
+    if venue:
+        what = f"{what} {venue}".strip()
+    else:
+        what = f"places serving {what}"
+    when = " ".join(p for p in (f"on {date.strip()}" if date.strip() else "",
+                                f"at {time.strip()}" if time.strip() else "") if p)
+
+    query = (
+        f"I'm looking for many popular {what} {_where(location, latitude, longitude)}"
+        f"{' ' + when if when else ''}, sorted by popularity and reviews."
+    )
+    return CompiledQuery(query, round(confidence, 3), terms)
+
+
+# ---------------------------
+# SHADOW MEASUREMENT
+# ---------------------------
+_STATS_LOCK = threading.Lock()
+_STATS: Dict[str, Any] = {
+    "compiled": 0,
+    "confident": 0,
+    "served_locally": 0,
+    "sent_to_gemini": 0,
+    "shadow_compared": 0,
+    "shadow_agreed": 0,
+    "shadow_term_recall_sum": 0.0,
+}
+
+
+def _bump(key: str, by: float = 1) -> None:
+    with _STATS_LOCK:
+        _STATS[key] += by
+
+
+def term_recall(compiled: CompiledQuery, gemini_query: str) -> float:
+    """Share of the compiled constraint words that also appear in Gemini's sentence."""
+    if not compiled.terms:
+        return 0.0
+    text = (gemini_query or "").lower()
+    hits = sum(1 for t in compiled.terms if t.rstrip("s") in text)
+    return hits / len(compiled.terms)
+
+
+def choose_local(compiled: CompiledQuery) -> bool:
+    """Record a compilation and decide whether it replaces the Gemini call."""
+    _bump("compiled")
+    confident = bool(compiled.query) and compiled.confidence >= CAPTION_COMPILER_MIN_CONFIDENCE
+    if confident:
+        _bump("confident")
+    if CAPTION_COMPILER_MODE == "on" and confident:
+        _bump("served_locally")
+        return True
+    _bump("sent_to_gemini")
+    return False
+
+
+def record_shadow(user_query: str, compiled: CompiledQuery, gemini_query: str) -> None:
+    """Log both outputs for a confident compilation and track agreement with Gemini."""
+    if CAPTION_COMPILER_MODE != "shadow" or not compiled.query:
+        return
+    if compiled.confidence < CAPTION_COMPILER_MIN_CONFIDENCE:
+        return
+    recall = term_recall(compiled, gemini_query)
+    _bump("shadow_compared")
+    _bump("shadow_term_recall_sum", recall)
+    if recall == 1.0:
+        _bump("shadow_agreed")
+    logger.info(
+        "caption shadow recall=%.2f confidence=%.2f caption=%r compiled=%r gemini=%r",
+        recall, compiled.confidence, user_query, compiled.query, gemini_query,
+    )
+
+
+def compiler_stats() -> Dict[str, Any]:
+    with _STATS_LOCK:
+        stats = dict(_STATS)
+    compared = stats.pop("shadow_compared")
+    recall_sum = stats.pop("shadow_term_recall_sum")
+    stats.update(
+        mode=CAPTION_COMPILER_MODE,
+        min_confidence=CAPTION_COMPILER_MIN_CONFIDENCE,
+        shadow_compared=compared,
+        shadow_agreement=round(stats["shadow_agreed"] / compared, 3) if compared else None,
+        shadow_mean_term_recall=round(recall_sum / compared, 3) if compared else None,
+    )
+    return stats
+
+
+register_metrics("caption_compiler", compiler_stats)
@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+# The backend validates keys at import; benchmarks never reach the network.
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+os.environ.setdefault("YELP_API_KEY", "benchmark")
+
+from dataclasses import asdict
+from fastapi.encoders import jsonable_encoder
+
+import Pipeline1Backend as p1
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def synthetic_payload(n_businesses: int, seed: int = 7) -> dict:
+    """Yelp AI chat response shaped like a recorded one, with `n_businesses` entries."""
+    rng = random.Random(seed)
+    businesses = []
+
+    for i in range(n_businesses):
+        businesses.append({
+            "id": f"biz-{i:05d}",
+            "name": f"Restaurant {i}",
+            "url": f"https://www.yelp.com/biz/restaurant-{i}",
+            "rating": round(rng.uniform(2.5, 5.0), 1),
+            "review_count": rng.randint(0, 4000),
+            "price": rng.choice(["$", "$$", "$$$", None]),
+            "phone": rng.choice(["+13015550100", None]),
+            "location": {
+                "address1": f"{rng.randint(1, 9999)} Baltimore Ave",
+                "city": "College Park",
+                "state": "MD",
+                "zip_code": "20740",
+                "country": "US",
+            },
+            "coordinates": {
+                "latitude": 38.98 + rng.uniform(-0.05, 0.05),
+                "longitude": -76.93 + rng.uniform(-0.05, 0.05),
+            },
+            "summaries": {"short": "Casual spot known for noodles and dumplings."},
+            "contextual_info": {
+                "photos": [{"original_url": f"https://s3-media.fl.yelpcdn.com/bphoto/{i}/o.jpg"}],
+                "business_hours": [
+                    {
+                        "day_of_week": d,
+                        "business_hours": [{"open_time": "1100", "close_time": "2200"}],
+                    }
+                    for d in DAYS
+                ],
+            },
+            "reservation_availability": {
+                "openings": [
+                    {
+                        "date": "2025-12-11",
+                        "slots": [
+                            {"time": t, "seating_areas": []}
+                            for t in ["18:00", "18:30", "19:00", "19:30", "20:00"]
+                        ],
+                    }
+                ] if rng.random() < 0.3 else []
+            },
+        })
+
+    return {
+        "chat_id": "benchmark-chat",
+        "response": {"text": "Here are some popular options near College Park."},
+        "entities": [{"businesses": businesses}],
+    }
+
+
+def legacy_render(results: p1.SearchResults) -> bytes:
+    """What FastAPI did before: dict result through jsonable_encoder + json.dumps."""
+    as_dict = asdict(results, dict_factory=lambda kv: {k: v for k, v in kv if k != "hours_index"})
+    return json.dumps(jsonable_encoder(as_dict)).encode("utf-8")
+
+
+def compact_render(results: p1.SearchResults) -> bytes:
+    return p1.CompactJSONResponse(results).body
+
+
+def bench(label: str, fn, repeat: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    per_call = (time.perf_counter() - start) / repeat
+    print(f"  {label:<32} {per_call * 1000:9.3f} ms")
+    return per_call
+
+
+def bench_serialization(payload: dict, repeat: int) -> None:
+    n = sum(len(e.get("businesses") or []) for e in payload.get("entities") or [])
+    print(f"\n=== Extraction + serialization ({n} businesses, {repeat} runs) ===")
+
+    results = p1._extract_results(payload, "benchmark query")
+
+    legacy_bytes = legacy_render(results)
+    compact_bytes = compact_render(results)
+
+    bench("extract", lambda: p1._extract_results(payload, "q"), repeat)
+    t_old = bench("legacy encode", lambda: legacy_render(results), repeat)
+    t_new = bench("compact encode", lambda: compact_render(results), repeat)
+    bench("extract + compact encode", lambda: compact_render(p1._extract_results(payload, "q")), repeat)
+
+    print(f"  encode speedup                   {t_old / t_new:9.1f}x")
+    print(f"  body size legacy / compact       {len(legacy_bytes)} / {len(compact_bytes)} bytes")
+
+
+def bench_ranking(sizes, repeat: int, top_k: int) -> None:
+    print(f"\n=== Ranking (top_k={top_k}, {repeat} runs) ===")
+    for n in sizes:
+        businesses = p1._extract_results(synthetic_payload(n), "q").businesses
+
+        def full_sort():
+            # pre-ranking behaviour: sort the whole list by (rating, review_count)
+            return sorted(
+                businesses,
+                key=lambda b: (b.rating or -1, b.review_count or -1),
+                reverse=True,
+            )
+
+        def ranked():
+            return p1._rank_businesses(
+                businesses, "38.9897", "-76.9378", "12/11/2025", "8pm", top_k=top_k
+            )
+
+        print(f" {n} candidates")
+        t_sort = bench("legacy full sort", full_sort, repeat)
+        t_rank = bench("score + partial sort", ranked, repeat)
+        print(f"  per candidate                    {t_rank / n * 1e6:9.3f} us (legacy {t_sort / n * 1e6:.3f} us)")
+
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="Pipeline 1 micro-benchmarks")
+    ap.add_argument("--payload", help="Path to a recorded Yelp AI JSON response")
+    ap.add_argument("--businesses", type=int, default=500, help="Synthetic payload size")
+    ap.add_argument("--repeat", type=int, default=50)
+    ap.add_argument("--rank-sizes", default="1000,5000,20000", help="Candidate counts for the ranking benchmark")
+    ap.add_argument("--top-k", type=int, default=p1.RANK_TOP_K)
+    args = ap.parse_args(argv)
+
+    if args.payload:
+        with open(args.payload, "r", encoding="utf-8") as fp:
+            payload = json.load(fp)
+    else:
+        payload = synthetic_payload(args.businesses)
+
+    print(f"orjson: {'yes' if p1.orjson is not None else 'no (stdlib json)'}")
+    bench_serialization(payload, args.repeat)
+    bench_ranking([int(n) for n in args.rank_sizes.split(",") if n], args.repeat, args.top_k)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
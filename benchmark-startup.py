@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+from typing import Optional
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Upstream-free request used by default; --live uses a real search/analysis.
+DEFAULT_FIRST_REQUEST = {
+    "Pipeline1Backend": ("GET", "/search-nearby", {"Latitude": "38.9897", "Longitude": "-76.9378"}),
+    "Pipeline2Backend": ("GET", "/metrics", None),
+    "Gateway": ("GET", "/search-nearby", {"Latitude": "38.9897", "Longitude": "-76.9378"}),
+}
+LIVE_FIRST_REQUEST = {
+    "Pipeline1Backend": (
+        "POST", "/search-caption",
+        {"user_query": "best ramen", "Location": "College Park, Maryland"},
+    ),
+    "Pipeline2Backend": (
+        "POST", "/analyze-business",
+        {"business_url": "https://www.yelp.com/biz/northside-pizza-college-park"},
+    ),
+    "Gateway": (
+        "POST", "/search-caption",
+        {"user_query": "best ramen", "Location": "College Park, Maryland"},
+    ),
+}
+
+
+def _env(live: bool, **extra) -> dict:
+    env = dict(os.environ, **extra)
+    if not live:
+        # Import and /health must not depend on real keys; requests that need them 503.
+        env.setdefault("GEMINI_API_KEY", "benchmark")
+        env.setdefault("YELP_API_KEY", "benchmark")
+    return env
+
+
+def measure_import(module: str, runs: int, live: bool) -> float:
+    code = (
+        "import time; t = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - t)"
+    )
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=HERE, env=_env(live), capture_output=True, text=True, check=True,
+        )
+        samples.append(float(out.stdout.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_server(module: str, live: bool, timeout_s: float = 60.0) -> dict:
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    method, path, body = (LIVE_FIRST_REQUEST if live else DEFAULT_FIRST_REQUEST)[module]
+
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{module}:app", "--port", str(port), "--log-level", "warning"],
+        cwd=HERE, env=_env(live), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+
+    result = {"health_s": None, "first_request_s": None, "first_request_status": None}
+    try:
+        while time.perf_counter() - t0 < timeout_s:
+            try:
+                if requests.get(base + "/health", timeout=1).status_code == 200:
+                    result["health_s"] = time.perf_counter() - t0
+                    break
+            except requests.ConnectionError:
+                time.sleep(0.01)
+
+        if result["health_s"] is not None:
+            if method == "GET":
+                r = requests.get(base + path, params=body, timeout=timeout_s)
+            elif path == "/analyze-business":
+                r = requests.post(base + path, json=body, timeout=timeout_s)
+            else:
+                r = requests.post(base + path, data=body, timeout=timeout_s)
+            result["first_request_s"] = time.perf_counter() - t0
+            result["first_request_status"] = r.status_code
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+    return result
+
+
+def _rss_kb(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as fp:
+            for line in fp:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def measure_memory(module: str, live: bool, timeout_s: float = 60.0) -> Optional[int]:
+    """RSS (KiB) of one warmed-up instance: clients built, pools and catalog opened."""
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{module}:app", "--port", str(port), "--log-level", "warning"],
+        cwd=HERE, env=_env(live, BACKEND_WARMUP="1"),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < timeout_s:
+            try:
+                r = requests.get(base + "/health", timeout=1)
+                if r.status_code == 200 and r.json().get("warmup", {}).get("done"):
+                    break
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.05)
+
+        method, path, body = (LIVE_FIRST_REQUEST if live else DEFAULT_FIRST_REQUEST)[module]
+        if method == "GET":
+            requests.get(base + path, params=body, timeout=timeout_s)
+        requests.get(base + "/metrics", timeout=timeout_s)
+        return _rss_kb(proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def compare_memory(live: bool) -> None:
+    print("\n=== Memory per instance (RSS after warmup) ===")
+    rss = {m: measure_memory(m, live) for m in ("Pipeline1Backend", "Pipeline2Backend", "Gateway")}
+    if any(v is None for v in rss.values()):
+        print("  RSS unavailable on this platform (/proc not readable)")
+        return
+    for m, kb in rss.items():
+        print(f"  {m:<36}{kb / 1024:8.1f} MiB")
+    separate = rss["Pipeline1Backend"] + rss["Pipeline2Backend"]
+    print(f"  {'two standalone instances':<36}{separate / 1024:8.1f} MiB")
+    print(f"  {'gateway saves':<36}{(separate - rss['Gateway']) / 1024:8.1f} MiB")
+
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="Cold-start and memory benchmark for the backends")
+    ap.add_argument("--modules", default="Pipeline1Backend,Pipeline2Backend,Gateway")
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--live", action="store_true", help="Use real keys and a real first request")
+    ap.add_argument("--memory", action="store_true", help="Compare RSS of standalone apps vs Gateway")
+    args = ap.parse_args(argv)
+
+    for module in [m for m in args.modules.split(",") if m]:
+        print(f"\n=== {module} ===")
+        import_s = measure_import(module, args.runs, args.live)
+        print(f"  {'import time (median)':<36}{import_s * 1000:8.1f} ms")
+
+        runs = [measure_server(module, args.live) for _ in range(args.runs)]
+        health = [r["health_s"] for r in runs if r["health_s"] is not None]
+        first = [r["first_request_s"] for r in runs if r["first_request_s"] is not None]
+        statuses = sorted({r["first_request_status"] for r in runs})
+
+        if health:
+            print(f"  {'time to first /health (median)':<36}{statistics.median(health) * 1000:8.1f} ms")
+        if first:
+            print(f"  {'time to first request (median)':<36}{statistics.median(first) * 1000:8.1f} ms  status={statuses}")
+
+    if args.memory:
+        compare_memory(args.live)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,26 @@
+# gunicorn.conf.py
+# Multi-process deployment for either backend (or the combined gateway):
+#
+#   gunicorn -c gunicorn.conf.py Pipeline1Backend:app
+#   gunicorn -c gunicorn.conf.py Pipeline2Backend:app
+#
+# The app is imported once in the master (preload) and forked into workers.
+# Gemini key rate-limit counters, cooldowns and the Pipeline 1 result/session
+# stores live in one SQLite file so every worker shares the same budget.
+
+import os
+import multiprocessing
+
+# Must be set before the app module is imported by the preload below.
+os.environ.setdefault("SHARED_STATE_MODE", "sqlite")
+os.environ.setdefault("SHARED_STATE_PATH", "/tmp/wtf_shared_state.db")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn_worker.UvicornWorker"
+preload_app = True
+
+# Gemini/Yelp calls are slow; give in-flight requests time to finish on reload.
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "180"))
+graceful_timeout = 30
+keepalive = 5
@@ -0,0 +1,320 @@
+"""
+Precompute /analyze-business verdicts offline, e.g. for a campus area before a
+launch event. Verdicts are stored in the business catalog, which the live route
+reads first (see VERDICT_SERVE_FRESH_S).
+
+    python precompute-verdicts.py https://www.yelp.com/biz/northside-pizza-college-park
+    python precompute-verdicts.py --urls urls.txt --concurrency 4 --quota-ceiling 600
+    python precompute-verdicts.py --sweep "College Park, Maryland" --categories ramen,pizza,tacos
+
+Progress is appended to --state (JSON lines); rerunning the same command skips
+finished businesses and reuses earlier sweep results, so an interrupted run resumes.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+import Pipeline2Backend as p2
+from BackendRuntime import (
+    CircuitOpen,
+    KeyQuotaExhausted,
+    request_deadline,
+    request_priority,
+    yelp_quota_stats,
+)
+from BusinessCatalog import get_catalog
+
+DEFAULT_CATEGORIES = "pizza,burgers,ramen,sushi,tacos,thai,indian,coffee,bubble tea,brunch"
+
+# Upper bound on Yelp calls per analysis (details, reviews, AI fallback), used
+# to keep in-flight work under the quota ceiling
+YELP_CALLS_PER_ANALYSIS = 3
+
+
+# ---------------------------
+# STAGE TIMING
+# ---------------------------
+class StageTimer:
+    """Wall time per pipeline stage, collected across worker threads."""
+
+    STAGES = {
+        "business": "get_business_details",
+        "reviews": "get_business_reviews_from_fusion",
+        "ai_summary": "get_review_snippets_from_yelp_ai",
+        "gemini_agent": "run_agent",
+        "verdict": "refresh_verdict",
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {stage: [] for stage in self.STAGES}
+
+    def _wrap(self, stage: str, fn: Callable) -> Callable:
+        @wraps(fn)
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.samples[stage].append(time.perf_counter() - t0)
+
+        return timed
+
+    def install(self) -> None:
+        # analyze() looks these up as module globals, so wrapping them here times every call
+        for stage, name in self.STAGES.items():
+            setattr(p2, name, self._wrap(stage, getattr(p2, name)))
+
+    def report(self) -> List[str]:
+        lines = []
+        for stage, values in self.samples.items():
+            if not values:
+                continue
+            ordered = sorted(values)
+            p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            lines.append(
+                f"  {stage:<14}{len(values):6d} calls  mean {sum(values) / len(values) * 1000:8.1f} ms"
+                f"  p95 {p95 * 1000:8.1f} ms  total {sum(values):8.1f} s"
+            )
+        return lines
+
+
+# ---------------------------
+# STATE FILE
+# ---------------------------
+class RunState:
+    """Append-only JSON-lines log of finished businesses and sweep results."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.done: Dict[str, dict] = {}
+        self.sweeps: Dict[str, List[str]] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as fp:
+                for line in fp:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line from an interrupted run
+                    if "sweep" in rec:
+                        self.sweeps[rec["sweep"]] = rec["targets"]
+                    elif rec.get("status") in ("done", "fresh"):
+                        self.done[rec["key"]] = rec
+
+    def append(self, rec: dict) -> None:
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as fp:
+                fp.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            if "sweep" in rec:
+                self.sweeps[rec["sweep"]] = rec["targets"]
+            elif rec.get("status") in ("done", "fresh"):
+                self.done[rec["key"]] = rec
+
+
+# ---------------------------
+# TARGETS
+# ---------------------------
+def sweep_targets(location: str, categories: List[str], state: RunState) -> List[str]:
+    """Business URLs from one Yelp AI search per category (cached in the state file)."""
+    import Pipeline1Backend as p1
+    from QueryCompiler import compile_caption
+
+    targets: List[str] = []
+    for category in categories:
+        key = f"{location}|{category}"
+        if key not in state.sweeps:
+            query = compile_caption(category, location, "", "", "", "").query or (
+                f"I'm looking for many popular {category} places near {location}, "
+                f"sorted by popularity and reviews."
+            )
+            with request_priority("batch"):
+                results = p1._extract_results(p1._call_yelp_ai(query), query)
+            found = [b.yelp_url or b.id for b in results.businesses if b.yelp_url or b.id]
+            state.append({"sweep": key, "query": query, "targets": found})
+            print(f"  sweep {category!r}: {len(found)} businesses")
+        targets.extend(state.sweeps[key])
+    return targets
+
+
+def read_targets(args, state: RunState) -> List[Tuple[str, str]]:
+    """(alias or id, target) pairs, deduplicated, in input order."""
+    raw: List[str] = list(args.targets)
+    if args.urls:
+        fp = sys.stdin if args.urls == "-" else open(args.urls, "r", encoding="utf-8")
+        with fp:
+            raw.extend(line.strip() for line in fp if line.strip() and not line.startswith("#"))
+    if args.sweep:
+        categories = [c.strip() for c in args.categories.split(",") if c.strip()]
+        raw.extend(sweep_targets(args.sweep, categories, state))
+
+    out: Dict[str, str] = {}
+    for target in raw:
+        try:
+            key = p2.extract_business_id_or_alias_from_url(target)
+        except ValueError:
+            print(f"  skipping unrecognised target: {target}")
+            continue
+        out.setdefault(key, target)
+    return list(out.items())
+
+
+# ---------------------------
+# RUN
+# ---------------------------
+class StopRun(RuntimeError):
+    """Quota or upstream trouble that makes further work pointless right now."""
+
+
+def analyze_one(key: str, target: str, args) -> dict:
+    started = time.perf_counter()
+    rec = {"key": key, "target": target}
+
+    if not args.force and p2.stored_analysis(key, args.locale, args.max_age_s) is not None:
+        return {**rec, "status": "fresh", "seconds": 0.0}
+
+    req = p2.AnalyzeRequest(
+        business_url=target,
+        reviews_limit=args.reviews_limit,
+        ai_fallback=not args.no_ai_fallback,
+        locale=args.locale,
+    )
+    try:
+        with request_deadline(p2.JOB_DEADLINE_S), request_priority("batch"):
+            result = p2.analyze(req, use_stored=False)
+    except (KeyQuotaExhausted, CircuitOpen) as e:
+        raise StopRun(str(e)) from e
+    except HTTPException as e:
+        return {**rec, "status": "failed", "error": f"{e.status_code}: {str(e.detail)[:200]}",
+                "seconds": round(time.perf_counter() - started, 3)}
+    except Exception as e:
+        return {**rec, "status": "failed", "error": str(e)[:200],
+                "seconds": round(time.perf_counter() - started, 3)}
+
+    return {
+        **rec,
+        "status": "done",
+        "verdict_mode": result.get("verdict_mode"),
+        # only Fusion-review verdicts are stored for the live route
+        "stored": result.get("context_source") == "fusion_reviews",
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def yelp_calls_spent() -> int:
+    return sum(q["spent"] for q in yelp_quota_stats().values())
+
+
+def run(targets: List[Tuple[str, str]], args, state: RunState) -> Dict[str, int]:
+    counts = {"done": 0, "stored": 0, "fresh": 0, "failed": 0, "resumed": 0}
+    pending = []
+    for key, target in targets:
+        if key in state.done and not args.force:
+            counts["resumed"] += 1
+        else:
+            pending.append((key, target))
+    pending.reverse()  # pop() from the end keeps input order
+
+    stop: Optional[str] = None
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="precompute") as pool:
+        inflight = {}
+        while pending or inflight:
+            while pending and stop is None and len(inflight) < args.concurrency:
+                if args.quota_ceiling and (
+                    yelp_calls_spent() + YELP_CALLS_PER_ANALYSIS * (len(inflight) + 1) > args.quota_ceiling
+                ):
+                    stop = f"Yelp call ceiling ({args.quota_ceiling}) reached"
+                    break
+                key, target = pending.pop()
+                inflight[pool.submit(analyze_one, key, target, args)] = key
+            if not inflight:
+                break
+
+            finished, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                key = inflight.pop(fut)
+                try:
+                    rec = fut.result()
+                except StopRun as e:
+                    stop = stop or str(e)
+                    continue
+                state.append(rec)
+                counts[rec["status"]] += 1
+                counts["stored"] += bool(rec.get("stored"))
+                if rec["status"] == "failed":
+                    print(f"  failed {key}: {rec['error']}")
+
+    if stop:
+        print(f"\nStopped early: {stop}. Rerun the same command to resume.")
+    counts["left"] = len(pending)
+    return counts
+
+
+def main(argv=None) -> None:
+    ap = argparse.ArgumentParser(description="Precompute business verdicts into the catalog")
+    ap.add_argument("targets", nargs="*", help="Yelp business URLs, aliases or ids")
+    ap.add_argument("--urls", help="File with one business URL per line ('-' for stdin)")
+    ap.add_argument("--sweep", metavar="LOCATION", help="Discover businesses near LOCATION via Yelp AI")
+    ap.add_argument("--categories", default=DEFAULT_CATEGORIES, help="Comma-separated sweep categories")
+    ap.add_argument("--concurrency", type=int, default=4, help="Analyses in flight at once")
+    ap.add_argument("--quota-ceiling", type=int, default=0,
+                    help="Stop before this run spends more Yelp calls (0 = no ceiling)")
+    ap.add_argument("--state", default="precompute-state.jsonl", help="Resume log (JSON lines)")
+    ap.add_argument("--max-age-s", type=float, default=p2.VERDICT_SERVE_FRESH_S,
+                    help="Skip businesses whose stored verdict is younger than this")
+    ap.add_argument("--force", action="store_true", help="Recompute even finished or fresh businesses")
+    ap.add_argument("--reviews-limit", type=int, default=6)
+    ap.add_argument("--locale")
+    ap.add_argument("--no-ai-fallback", action="store_true", help="Skip businesses without Fusion reviews")
+    args = ap.parse_args(argv)
+
+    if not (args.targets or args.urls or args.sweep):
+        ap.error("give business URLs, --urls or --sweep")
+    args.concurrency = max(1, args.concurrency)
+
+    catalog = get_catalog()
+    if catalog is None:
+        sys.exit("The business catalog is disabled (CATALOG_ENABLED=0); nowhere to store verdicts.")
+
+    timer = StageTimer()
+    timer.install()
+    state = RunState(args.state)
+
+    t0 = time.perf_counter()
+    try:
+        targets = read_targets(args, state)
+    except (KeyQuotaExhausted, CircuitOpen, HTTPException) as e:
+        sys.exit(f"Sweep failed: {e}")
+    print(f"{len(targets)} businesses, concurrency {args.concurrency}")
+
+    try:
+        counts = run(targets, args, state)
+    finally:
+        catalog.flush(timeout=30)
+    elapsed = time.perf_counter() - t0
+
+    analysed = counts["done"] + counts["failed"]
+    print(f"\n=== precompute ({elapsed:.1f} s) ===")
+    print(f"  analysed {analysed}  (stored {counts['stored']}, failed {counts['failed']})")
+    print(f"  already fresh {counts['fresh']}, finished in earlier runs {counts['resumed']}, left {counts['left']}")
+    if analysed:
+        print(f"  throughput {analysed / elapsed * 60:.1f} businesses/min")
+    print(f"  Yelp calls {yelp_calls_spent()}")
+    stages = timer.report()
+    if stages:
+        print("  per stage:")
+        print("\n".join(stages))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])